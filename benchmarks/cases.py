@@ -0,0 +1,182 @@
+import itertools
+import random
+import sqlite3
+
+import db
+from benchmarks.data import CODES_PER_CHAT, address_name, chat_id, user_id
+from db.routing import routing_table
+from errors.query_errors import AddressExpiredError, AddressNotActiveError, AddressNotFoundError, UserNotFoundError
+from utils.timestamps import DAY_SECONDS, now
+
+# Errors the queries raise for codes that are expired, inactive or missing, which are expected results here
+EXPECTED_ERRORS = (AddressExpiredError, AddressNotActiveError, AddressNotFoundError, UserNotFoundError)
+
+# The benchmarks modify only rows of their own, which are removed after the run
+BENCH_CHAT = 'bench-chat'
+BENCH_CODES = 100
+BENCH_USERS = 100
+
+# Codes inserted before each run of the bulk expiry queries
+EXPIRED_BATCH = 50
+
+# Song requests in each batch written by the request buffer
+REQUEST_BATCH = 100
+
+class Case:
+    """
+    A query function and how to call it.
+
+    arguments returns the arguments of one call and may prepare rows for it,
+    which is not timed. Writers run on the read-write connection and readers
+    on a read-only one, like in the bot. Queries on the hot path run while
+    handling updates, the rest at startup or in scheduled jobs.
+    """
+
+    def __init__(self, name: str, function, arguments, writer: bool = False, hot_path: bool = True):
+        self.name = name
+        self.function = function
+        self.arguments = arguments
+        self.writer = writer
+        self.hot_path = hot_path
+
+def _bench_code(i: int) -> str:
+    return f"BENCH{i % BENCH_CODES}"
+
+def _bench_user(i: int) -> str:
+    return f"bench-user-{i % BENCH_USERS}"
+
+def prepare(conn: sqlite3.Connection) -> None:
+    """Create the chat, codes and users the writing benchmarks modify"""
+    cleanup(conn)
+    conn.execute("INSERT INTO D_RECIPIENT_CHAT (chat_id, chat_type) VALUES (?, 'group')", (BENCH_CHAT,))
+    conn.executemany('''
+        INSERT INTO R_CHAT_ADDRESS (address, chat_id, active, valid_until, expiry_notified)
+        VALUES (?, ?, 1, ?, 0)
+    ''', [(_bench_code(i), BENCH_CHAT, now() + DAY_SECONDS) for i in range(BENCH_CODES)])
+    conn.executemany("INSERT INTO D_USER (user_id, nickname, role) VALUES (?, 'bench', 'user')",
+                     [(_bench_user(i),) for i in range(BENCH_USERS)])
+    conn.commit()
+
+def cleanup(conn: sqlite3.Connection) -> None:
+    """Remove every row the benchmarks have created"""
+    # A range instead of LIKE 'BENCH%' lets the address indexes find the rows
+    for table in ('R_CHAT_ADDRESS', 'R_FORWARD_ADDRESS', 'F_SONG_REQUEST', 'A_REQUEST_HOURLY', 'A_SONG_COUNT'):
+        conn.execute(f"DELETE FROM {table} WHERE address >= 'BENCH' AND address < 'BENCI'")
+    conn.execute("DELETE FROM R_FORWARD_ADDRESS WHERE user_id LIKE 'bench-%'")
+    conn.execute("DELETE FROM R_BLOCKED_USER WHERE chat_id = ?", (BENCH_CHAT,))
+    conn.execute("DELETE FROM D_USER WHERE user_id LIKE 'bench-%'")
+    conn.execute("DELETE FROM D_RECIPIENT_CHAT WHERE chat_id LIKE 'bench-%'")
+    conn.commit()
+    routing_table.clear()
+
+def build_cases(writer: sqlite3.Connection, users: int, addresses: int, seed: int = 1) -> list:
+    """The benchmark cases for a database generated with the given amount of users and codes"""
+    rng = random.Random(seed)
+    counter = itertools.count()
+    chats = addresses // CODES_PER_CHAT + 1
+
+    def any_user():
+        return user_id(rng.randrange(users))
+
+    def any_code():
+        return address_name(rng.randrange(addresses))
+
+    def any_chat():
+        return chat_id(rng.randrange(chats))
+
+    def popular_code():
+        # Requests are skewed towards the first codes like in the generated data
+        i = int(addresses * rng.random() ** 2)
+        return address_name(i), chat_id(i // CODES_PER_CHAT)
+
+    def uncached_user():
+        routing_table.clear()
+        return (any_user(),)
+
+    def release_batch():
+        writer.executemany('''
+            INSERT INTO R_CHAT_ADDRESS (address, chat_id, valid_until, expiry_notified)
+            VALUES (?, ?, ?, 1)
+        ''', [(f"BENCHOLD{next(counter)}", BENCH_CHAT, now() - 11 * DAY_SECONDS) for _ in range(EXPIRED_BATCH)])
+        writer.commit()
+        return ()
+
+    def claim_batch():
+        # The codes claimed by the previous call would otherwise pile up
+        writer.execute("DELETE FROM R_CHAT_ADDRESS WHERE address >= 'BENCHEXPIRED' AND address < 'BENCHEXPIREE'")
+        writer.executemany('''
+            INSERT INTO R_CHAT_ADDRESS (address, chat_id, valid_until, expiry_notified)
+            VALUES (?, ?, ?, 0)
+        ''', [(f"BENCHEXPIRED{next(counter)}", BENCH_CHAT, now() - 60) for _ in range(EXPIRED_BATCH)])
+        writer.commit()
+        return ()
+
+    def released_code():
+        address = f"BENCHRELEASE{next(counter)}"
+        writer.execute("INSERT INTO R_CHAT_ADDRESS (address, chat_id, valid_until) VALUES (?, ?, ?)",
+                       (address, BENCH_CHAT, now()))
+        writer.execute("INSERT INTO R_FORWARD_ADDRESS (user_id, address) VALUES (?, ?)", (_bench_user(next(counter)), address))
+        writer.commit()
+        return (address,)
+
+    def request_batch():
+        timestamp = now()
+        return ([(any_user(), _bench_code(i), BENCH_CHAT, f"Song {rng.randrange(5000)}", "Artist", None, timestamp)
+                 for i in range(REQUEST_BATCH)],)
+
+    return [
+        # --- user_queries ---
+        Case('get_forward_address', db.get_forward_address, lambda: (any_user(),)),
+        Case('get_address_chat_id', db.get_address_chat_id, lambda: (any_code(),)),
+        Case('is_recipient_active', db.is_recipient_active, lambda: (any_user(),)),
+        Case('is_recipient_valid', db.is_recipient_valid, lambda: (any_user(),)),
+        Case('resolve_route', db.resolve_route, uncached_user),
+        Case('resolve_route (cached)', db.resolve_route, lambda: (user_id(0),)),
+        Case('get_recipient', db.get_recipient, uncached_user),
+        Case('get_nickname', db.get_nickname, lambda: (any_user(),)),
+        Case('address_exists', db.address_exists, lambda: (any_code(),)),
+        Case('user_exists', db.user_exists, lambda: (any_user(),)),
+        Case('check_password_match', db.check_password_match, lambda: (any_code(), 'x' * 64)),
+        Case('is_password_set', db.is_password_set, lambda: (any_code(),)),
+        Case('get_current_address', db.get_current_address, lambda: (any_user(),)),
+        Case('add_user', db.add_user, lambda: (f"bench-new-{next(counter)}", 'bench', 'user'), writer=True),
+        Case('update_nickname', db.update_nickname, lambda: (_bench_user(next(counter)), 'bench'), writer=True),
+        Case('set_user_forward_address', db.set_user_forward_address,
+             lambda: (_bench_user(next(counter)), _bench_code(next(counter))), writer=True),
+
+        # --- recipient_queries ---
+        Case('get_recipient_chat_id', db.get_recipient_chat_id, lambda: (any_chat(),)),
+        Case('get_address_attributes', db.get_address_attributes, lambda: (any_code(),)),
+        Case('get_amount_of_recipient_addresses', db.get_amount_of_recipient_addresses, lambda: (any_chat(),)),
+        Case('get_recipient_addresses', db.get_recipient_addresses, lambda: (any_chat(),)),
+        Case('list_recipient_addresses', db.list_recipient_addresses, lambda: (any_chat(),)),
+        Case('list_valid_recipient_addresses', db.list_valid_recipient_addresses, lambda: (any_chat(),)),
+        Case('get_expired_addresses', db.get_expired_addresses, lambda: (any_chat(),)),
+        Case('add_new_recipient', db.add_new_recipient, lambda: (f"bench-chat-{next(counter)}", 'group'), writer=True),
+        Case('create_new_address', db.create_new_address,
+             lambda: (f"BENCHNEW{next(counter)}", BENCH_CHAT, None, now() + DAY_SECONDS), writer=True),
+        Case('expire_address', db.expire_address, lambda: (_bench_code(next(counter)),), writer=True),
+        Case('renew_address', db.renew_address, lambda: (_bench_code(next(counter)), now() + DAY_SECONDS), writer=True),
+        Case('toggle_active', db.toggle_active, lambda: (_bench_code(next(counter)),), writer=True),
+        Case('set_digest_mode', db.set_digest_mode, lambda: (_bench_code(next(counter)), 'on'), writer=True),
+        Case('release_address_from_database', db.release_address_from_database, released_code, writer=True),
+
+        # --- block_queries ---
+        Case('get_recent_requesters', db.get_recent_requesters, lambda: (popular_code()[1],)),
+        Case('get_blocked_users', db.get_blocked_users, lambda: (BENCH_CHAT,)),
+        Case('block_user', db.block_user, lambda: (BENCH_CHAT, _bench_user(next(counter))), writer=True),
+        Case('unblock_user', db.unblock_user, lambda: (BENCH_CHAT, _bench_user(next(counter))), writer=True),
+        Case('get_all_blocked_users', db.get_all_blocked_users, lambda: (), hot_path=False),
+
+        # --- utils ---
+        Case('get_expiry_deadlines', db.get_expiry_deadlines, lambda: (), hot_path=False),
+        Case('release_expired_addresses', db.release_expired_addresses, release_batch, writer=True, hot_path=False),
+        Case('claim_expired_addresses', db.claim_expired_addresses, claim_batch, writer=True, hot_path=False),
+
+        # --- request_queries ---
+        Case('get_request_stats', db.get_request_stats, popular_code),
+        Case('get_hourly_request_counts', db.get_hourly_request_counts,
+             lambda: (*popular_code(), now() - DAY_SECONDS, now())),
+        Case('get_top_songs', db.get_top_songs, popular_code),
+        Case('insert_song_requests', db.insert_song_requests, request_batch, writer=True),
+    ]
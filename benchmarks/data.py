@@ -0,0 +1,101 @@
+import random
+import sqlite3
+import time
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Rows inserted per transaction while generating
+CHUNK_SIZE = 100000
+
+# Codes per recipient chat, the bot allows at most 5
+CODES_PER_CHAT = 4
+
+SONG_COUNT = 5000
+
+def _insert_chunked(conn: sqlite3.Connection, sql: str, rows) -> None:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            conn.executemany(sql, chunk)
+            conn.commit()
+            chunk = []
+    if chunk:
+        conn.executemany(sql, chunk)
+        conn.commit()
+
+def address_name(i: int) -> str:
+    return f"CODE{i}"
+
+def chat_id(i: int) -> str:
+    return str(-1000000 - i)
+
+def user_id(i: int) -> str:
+    return str(100000000 + i)
+
+def generate(conn: sqlite3.Connection, users: int, addresses: int, requests: int, seed: int = 1) -> None:
+    """
+    Fill a migrated database with synthetic users, codes and song requests.
+
+    Most codes are valid and the rest have expired during the last day, with
+    the expiry already notified. No code is old enough to be released, so the
+    destructive benchmarks see the same data on every run. Every user follows
+    a code, and requests are spread over the last 30 days with a few popular
+    codes receiving most of them.
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+    chats = addresses // CODES_PER_CHAT + 1
+    started = time.perf_counter()
+
+    _insert_chunked(conn, 'INSERT INTO D_USER (user_id, nickname, role) VALUES (?, ?, ?)',
+                    ((user_id(i), f"nick{i}", 'user') for i in range(users)))
+    _insert_chunked(conn, 'INSERT INTO D_RECIPIENT_CHAT (chat_id, chat_type) VALUES (?, ?)',
+                    ((chat_id(i), 'group') for i in range(chats)))
+
+    def code_row(i: int):
+        kind = rng.random()
+        if kind < 0.8:
+            valid_until = now + rng.randrange(3600, 30 * 86400)
+        else:
+            valid_until = now - rng.randrange(60, 86400)
+        password = 'x' * 64 if rng.random() < 0.2 else None
+        active = 1 if rng.random() < 0.9 else 0
+        return (address_name(i), chat_id(i // CODES_PER_CHAT), password, active, valid_until, int(valid_until <= now))
+    _insert_chunked(conn, '''
+        INSERT INTO R_CHAT_ADDRESS (address, chat_id, password, active, valid_until, expiry_notified)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (code_row(i) for i in range(addresses)))
+
+    _insert_chunked(conn, 'INSERT INTO R_FORWARD_ADDRESS (user_id, address) VALUES (?, ?)',
+                    ((user_id(i), address_name(rng.randrange(addresses))) for i in range(users)))
+
+    def request_row(_):
+        # Squaring skews the requests towards the first codes
+        address = int(addresses * rng.random() ** 2)
+        song = rng.randrange(SONG_COUNT)
+        return (user_id(rng.randrange(users)), address_name(address), chat_id(address // CODES_PER_CHAT),
+                f"Song {song}", f"Artist {song % 500}", None, now - rng.randrange(30 * 86400))
+    _insert_chunked(conn, '''
+        INSERT INTO F_SONG_REQUEST (user_id, address, chat_id, song_name, artist_name, notes, requested_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (request_row(i) for i in range(requests)))
+
+    # The rollups are built in SQL, the generated names are already normalized apart from case
+    conn.execute('''
+        INSERT INTO A_REQUEST_HOURLY (address, chat_id, hour, request_count)
+        SELECT address, chat_id, requested_at - requested_at % 3600, COUNT(*)
+        FROM F_SONG_REQUEST
+        GROUP BY address, chat_id, requested_at - requested_at % 3600
+    ''')
+    conn.execute('''
+        INSERT INTO A_SONG_COUNT (address, chat_id, song_key, artist_key, song_name, artist_name, request_count, last_requested)
+        SELECT address, chat_id, lower(song_name), lower(artist_name), song_name, artist_name, COUNT(*), MAX(requested_at)
+        FROM F_SONG_REQUEST
+        GROUP BY address, chat_id, song_name, artist_name
+    ''')
+    conn.commit()
+    logger.info(f"Generated {users} users, {addresses} codes and {requests} requests "
+                f"in {time.perf_counter() - started:.0f} seconds")
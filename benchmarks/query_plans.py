@@ -0,0 +1,48 @@
+import sqlite3
+
+from benchmarks.cases import EXPECTED_ERRORS
+from db.instrumented import normalize_statement
+
+# Statements that have a query plan, transaction control and pragmas do not
+PLANNED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+def full_scans(conn: sqlite3.Connection, sql: str, parameters) -> list:
+    """Tables the statement reads by scanning all of their rows, according to EXPLAIN QUERY PLAN"""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+    # Rows are (id, parent, notused, detail), searches use an index and scans read every row
+    return [detail for *_, detail in plan
+            if detail.startswith('SCAN ') and not detail.startswith('SCAN CONSTANT ROW')]
+
+def check_query_plans(cases: list, writer: sqlite3.Connection, reader: sqlite3.Connection) -> int:
+    """
+    Run every case once, capturing the statements its query executes, and
+    print the query plan problems. Returns the amount of hot path queries
+    with a full table scan, scans in startup and job queries are only shown.
+    """
+    failures = 0
+    print(f"\n{'Query':<36}Full scans")
+    for case in cases:
+        conn = writer if case.writer else reader
+        arguments = case.arguments()
+        conn.captured = []
+        try:
+            case.function(conn, *arguments)
+        except EXPECTED_ERRORS:
+            pass
+        finally:
+            captured, conn.captured = conn.captured, None
+
+        scans = {}
+        for sql, parameters in captured:
+            if not sql.lstrip().upper().startswith(PLANNED_STATEMENTS):
+                continue
+            for detail in full_scans(conn, sql, parameters):
+                scans.setdefault(detail, normalize_statement(sql))
+        if not scans:
+            print(f"{case.name:<36}-")
+            continue
+        if case.hot_path:
+            failures += 1
+        for detail, statement in scans.items():
+            print(f"{case.name:<36}{detail}{'' if case.hot_path else ' (not on the hot path)'}\n{'':<36}  {statement}")
+    return failures
@@ -0,0 +1,223 @@
+import os
+import tempfile
+
+from db.async_database import AsyncDatabase
+from db.pool import ConnectionPool
+from db.postgres_storage import PostgresStorage
+from db.routing import routing_table
+from db.storage import Storage
+from utils.timestamps import DAY_SECONDS, now
+
+class RecordingStorage:
+    """Passes the calls on to a storage backend and records the names of the methods called"""
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self.called = set()
+
+    def __getattr__(self, name: str):
+        self.called.add(name)
+        return getattr(self._storage, name)
+
+async def _outcome(call):
+    """The result of the call, or the name of the error it raised"""
+    try:
+        return await call
+    except Exception as e:
+        return f"raised {type(e).__name__}"
+
+async def _unordered(call):
+    """The rows of a query without an ORDER BY, sorted so backends returning them in another order compare equal"""
+    rows = await call
+    return sorted(rows) if rows is not None else None
+
+async def run_scenario(storage, started: int) -> list:
+    """
+    Call every query of the storage in the order a bot would, from an empty
+    database. Returns (step, result) pairs. Timestamps are relative to
+    started, so the results of backends run one after the other are equal.
+    """
+    results = []
+
+    async def step(name: str, call) -> None:
+        results.append((name, await _outcome(call)))
+
+    await storage.migrate()
+    # Running the migrations again must be a no-op
+    await storage.migrate()
+
+    # --- Users and recipients ---
+    await step('add_user', storage.add_user(1001, 'first', 'user'))
+    await step('add_user existing', storage.add_user(1001, 'first', 'user'))
+    await step('add_user second', storage.add_user(1002, 'second', 'user'))
+    await step('add_new_recipient', storage.add_new_recipient(-500, 'group'))
+    await step('add_new_recipient existing', storage.add_new_recipient(-500, 'group'))
+    await step('get_recipient_chat_id', storage.get_recipient_chat_id(-500))
+    await step('get_recipient_chat_id missing', storage.get_recipient_chat_id(-501))
+    await step('create_new_address', storage.create_new_address('PARITY', -500, 'secret', started + 5 * DAY_SECONDS))
+    await step('create_new_address old', storage.create_new_address('OLD', -500, None, started - 20 * DAY_SECONDS))
+    await step('create_new_address expired', storage.create_new_address('EXPIRED', -500, '', started - 5))
+    await step('get_address_attributes', storage.get_address_attributes('PARITY'))
+    await step('get_address_attributes missing', storage.get_address_attributes('MISSING'))
+    await step('get_amount_of_recipient_addresses', storage.get_amount_of_recipient_addresses(-500))
+
+    # --- Forward addresses and routes ---
+    await step('get_forward_address unset', storage.get_forward_address(1001))
+    await step('get_current_address unset', storage.get_current_address(1001))
+    await step('get_recipient unset', storage.get_recipient(1001))
+    await step('set_user_forward_address', storage.set_user_forward_address(1001, 'PARITY'))
+    await step('set_user_forward_address again', storage.set_user_forward_address(1001, 'PARITY'))
+    await step('set_user_forward_address no user', storage.set_user_forward_address(1999, 'PARITY'))
+    await step('set_user_forward_address no code', storage.set_user_forward_address(1001, 'MISSING'))
+    await step('get_forward_address', storage.get_forward_address(1001))
+    await step('get_address_chat_id', storage.get_address_chat_id('PARITY'))
+    await step('get_address_chat_id missing', storage.get_address_chat_id('MISSING'))
+    await step('is_recipient_active', storage.is_recipient_active(1001))
+    await step('is_recipient_valid', storage.is_recipient_valid(1001))
+    await step('resolve_route', storage.resolve_route(1001))
+    await step('resolve_route unset', storage.resolve_route(1002))
+    await step('get_recipient', storage.get_recipient(1001))
+    await step('get_nickname', storage.get_nickname(1001))
+    await step('update_nickname', storage.update_nickname(1001, 'renamed'))
+    await step('get_nickname updated', storage.get_nickname(1001))
+    await step('get_nickname missing', storage.get_nickname(1999))
+    await step('address_exists', storage.address_exists('PARITY'))
+    await step('address_exists missing', storage.address_exists('MISSING'))
+    await step('user_exists', storage.user_exists(1001))
+    await step('user_exists missing', storage.user_exists(1999))
+    await step('check_password_match', storage.check_password_match('PARITY', 'secret'))
+    await step('check_password_match wrong', storage.check_password_match('PARITY', 'wrong'))
+    await step('check_password_match missing', storage.check_password_match('MISSING', 'secret'))
+    await step('is_password_set', storage.is_password_set('PARITY'))
+    await step('is_password_set empty', storage.is_password_set('EXPIRED'))
+    await step('is_password_set none', storage.is_password_set('OLD'))
+    await step('get_current_address', storage.get_current_address(1001))
+
+    # --- Managing codes ---
+    await step('get_recipient_addresses', storage.get_recipient_addresses(-500))
+    await step('get_recipient_addresses none', storage.get_recipient_addresses(-501))
+    await step('list_recipient_addresses', _unordered(storage.list_recipient_addresses(-500)))
+    await step('list_recipient_addresses none', storage.list_recipient_addresses(-501))
+    await step('list_valid_recipient_addresses', _unordered(storage.list_valid_recipient_addresses(-500)))
+    await step('get_expired_addresses', _unordered(storage.get_expired_addresses(-500)))
+    await step('toggle_active', storage.toggle_active('PARITY'))
+    await step('get_recipient inactive', storage.get_recipient(1001))
+    await step('is_recipient_active inactive', storage.is_recipient_active(1001))
+    await step('toggle_active back', storage.toggle_active('PARITY'))
+    await step('toggle_active expired', storage.toggle_active('EXPIRED'))
+    await step('toggle_active missing', storage.toggle_active('MISSING'))
+    await step('set_digest_mode', storage.set_digest_mode('PARITY', 'on'))
+    await step('resolve_route digest', storage.resolve_route(1001))
+
+    # --- Song requests ---
+    requests = [
+        (1001, 'PARITY', -500, 'Song', 'Artist', None, started),
+        (1002, 'PARITY', -500, 'song ', 'artist', 'notes', started - 1),
+        (1001, 'PARITY', -500, 'Other', 'Band', None, started - 2 * 60 * 60),
+    ]
+    await step('insert_song_requests', storage.insert_song_requests(requests))
+    await step('insert_song_requests again', storage.insert_song_requests(requests[:1]))
+    await step('get_request_stats', storage.get_request_stats('PARITY', -500))
+    await step('get_request_stats empty', storage.get_request_stats('OLD', -500))
+    await step('get_hourly_request_counts', storage.get_hourly_request_counts('PARITY', -500, started - DAY_SECONDS, started))
+    await step('get_top_songs', storage.get_top_songs('PARITY', -500))
+    await step('get_top_songs limited', storage.get_top_songs('PARITY', -500, 1))
+
+    # --- Blocked senders ---
+    await step('get_recent_requesters', storage.get_recent_requesters(-500))
+    await step('block_user', storage.block_user(-500, 1002))
+    await step('block_user again', storage.block_user(-500, 1002))
+    await step('get_blocked_users', storage.get_blocked_users(-500))
+    await step('get_all_blocked_users', _unordered(storage.get_all_blocked_users()))
+    await step('unblock_user', storage.unblock_user(-500, 1002))
+    await step('unblock_user again', storage.unblock_user(-500, 1002))
+    await step('get_blocked_users none', storage.get_blocked_users(-500))
+
+    # --- Conversation states and user data ---
+    await step('save_persistence', storage.save_persistence(
+        {('request', (1001, 1001)): 21, ('request', (1002, 1002)): 22},
+        {1001: ({'song_name': 'Song', 'recipient': -500}, []), 1002: ({'nickname': 'second'}, [])}
+    ))
+    await step('save_persistence changes', storage.save_persistence(
+        {('request', (1002, 1002)): None},
+        {1001: ({'artist_name': 'Artist'}, ['song_name']), 1002: None}
+    ))
+    await step('load_conversations', storage.load_conversations('request'))
+    await step('load_conversations none', storage.load_conversations('missing'))
+    await step('load_user_data', storage.load_user_data())
+
+    # --- Expiry and release ---
+    await step('get_expiry_deadlines', _unordered(storage.get_expiry_deadlines()))
+    await step('claim_expired_addresses', storage.claim_expired_addresses())
+    await step('claim_expired_addresses again', storage.claim_expired_addresses())
+    await step('renew_address', storage.renew_address('EXPIRED', started + DAY_SECONDS))
+    await step('set_user_forward_address renewed', storage.set_user_forward_address(1002, 'EXPIRED'))
+    await step('expire_address', storage.expire_address('PARITY'))
+    await step('get_recipient expired', storage.get_recipient(1001))
+    await step('is_recipient_valid expired', storage.is_recipient_valid(1001))
+    await step('release_expired_addresses', storage.release_expired_addresses())
+    await step('release_address_from_database', storage.release_address_from_database('EXPIRED'))
+    await step('get_forward_address released', storage.get_forward_address(1002))
+    await step('resolve_route released', storage.resolve_route(1002))
+    return results
+
+async def _create_schema(database_url: str, schema: str) -> None:
+    import asyncpg
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        await conn.execute(f'CREATE SCHEMA {schema}')
+    finally:
+        await conn.close()
+
+async def _drop_schema(database_url: str, schema: str) -> None:
+    import asyncpg
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+    finally:
+        await conn.close()
+
+async def check_storage(database_url: str) -> int:
+    """
+    Run the scenario on a temporary SQLite database and in a temporary schema
+    of the PostgreSQL database, and print the steps whose results differ.
+    Returns the amount of differing steps and queries the scenario missed.
+    """
+    started = now()
+    sqlite = RecordingStorage(AsyncDatabase(ConnectionPool(
+        os.path.join(tempfile.mkdtemp(prefix='songrequestbot-parity-'), 'parity.db'), readers=2
+    )))
+    try:
+        routing_table.clear()
+        expected = await run_scenario(sqlite, started)
+    finally:
+        await sqlite.close()
+
+    schema = f"parity_{os.getpid()}"
+    separator = '&' if '?' in database_url else '?'
+    await _create_schema(database_url, schema)
+    postgres = RecordingStorage(PostgresStorage(f"{database_url}{separator}search_path={schema}"))
+    try:
+        routing_table.clear()
+        actual = await run_scenario(postgres, started)
+    finally:
+        await postgres.close()
+        await _drop_schema(database_url, schema)
+    routing_table.clear()
+
+    failures = 0
+    print(f"\n{'Step':<40}Result")
+    for (name, sqlite_result), (_, postgres_result) in zip(expected, actual):
+        # Tuples and lists are told apart, as are for example integers and booleans
+        if sqlite_result == postgres_result and type(sqlite_result) is type(postgres_result):
+            continue
+        failures += 1
+        print(f"{name:<40}SQLite {sqlite_result!r}\n{'':<40}PostgreSQL {postgres_result!r}")
+
+    missed = sorted(Storage.__abstractmethods__ - sqlite.called)
+    if missed:
+        failures += len(missed)
+        print(f"The scenario does not call {', '.join(missed)}")
+    print(f"\n{len(expected)} steps, {failures} differences between SQLite and PostgreSQL")
+    return failures
@@ -1,35 +1,112 @@
 from telegram import Update
-from telegram.ext import Application, CommandHandler, CommandHandler
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from telegram.ext import Application, CommandHandler, CommandHandler, TypeHandler
 import asyncio
-
-from utils.config import BOT_TOKEN, LANGUAGE, sql_connection
+import os
+import signal
+import sys
+
+from utils.config import (
+    BOT_TOKEN, LANGUAGE, BOT_API_URL, BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_PATH, WEBHOOK_LISTEN,
+    WEBHOOK_PORT, UPDATE_QUEUE_SIZE, UPDATE_CONCURRENCY, BOT_WORKERS, database, persistence, request_buffer, dispatcher
+)
 from utils.logger import get_logger
-from utils.cleaner import clean_expired_addresses, expiration_notification
+from utils.delivery import request_delivery
+from utils.block_list import block_list
+from utils.cluster import cluster
+from utils.ingress import ingress
+from utils.expiry_scheduler import expiry_scheduler
+from utils.metrics import instrument_handlers
+from utils.metrics_server import metrics_server
+from utils.update_processor import ChatUpdateProcessor
 import command_handlers as handlers
-from db.schema import create_tables
 
 logger = get_logger(__name__)
 
-async def scheduled_jobs(application):
-    # --- Add database cleaning jobs ---
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(clean_expired_addresses, 'interval', hours=1, args=[application, sql_connection])
-    scheduler.add_job(expiration_notification, 'interval', hours=1, args=[application, sql_connection])
-    scheduler.start()
-
-def main() -> None:
-    """Start the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    # Create database tables if they don't exist
-    create_tables(sql_connection)
+async def start(application):
+    # --- Senders blocked by recipients are checked from memory ---
+    await block_list.load()
+    # --- Notify and release expired codes as their deadlines pass ---
+    await expiry_scheduler.start(application)
+    # --- Serve runtime metrics for Prometheus ---
+    metrics_server.start(application)
+
+async def stop(application):
+    # --- Stop scheduled jobs, then send digests and queued messages while the bot can still reach Telegram ---
+    await expiry_scheduler.close()
+    await request_delivery.close()
+    await dispatcher.close()
+    metrics_server.close()
+
+async def shutdown(application):
+    # --- Write buffered song requests and finish pending queries before exiting ---
+    await request_buffer.close()
+    await database.close()
+
+async def start_ingress(application):
+    # --- Start the workers, which run this same file ---
+    await ingress.start([sys.executable, os.path.abspath(__file__)])
+    metrics_server.start(application)
+
+async def stop_ingress(application):
+    # --- Let the workers handle the updates they have received and exit ---
+    await ingress.close()
+    metrics_server.close()
+
+async def shutdown_ingress(application):
+    await database.close()
+
+async def run_worker(application):
+    """Handle the updates routed to this worker by the ingress until it tells the worker to stop"""
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, cluster.abort)
+    await application.initialize()
+    try:
+        await cluster.connect(application)
+        await start(application)
+        await application.start()
+        await cluster.wait_for_drain()
+        # Handles the updates already in the queue, song requests may still arrive from other workers
+        await application.stop()
+        await cluster.drained()
+        await stop(application)
+    finally:
+        await cluster.close()
+        await application.shutdown()
+        await shutdown(application)
+
+def build_application(builder):
+    """Finish the builder with the settings shared by every process"""
+    # The bounded update queue makes ingress wait instead of piling up updates when handlers fall behind.
+    builder = builder.token(BOT_TOKEN).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    return builder.build()
+
+def run(application) -> None:
+    """Receive updates until the user presses Ctrl-C"""
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL or not WEBHOOK_SECRET:
+            logger.error('WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode, exiting')
+            return
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    elif BOT_MODE == 'polling':
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        logger.error('Unsupported bot mode specified, exiting')
 
+def add_handlers(application) -> bool:
+    """Add the command and conversation handlers, returns False if the language is not supported"""
     # --- Add command handlers based on language ---
     if LANGUAGE == 'en':
         logger.error('Language not implemented')
-        return
+        return False
     elif LANGUAGE == 'fi':
         # Käyttäjän kommennot
         application.add_handler(CommandHandler("apua", handlers.help_message)) # Help message
@@ -38,13 +115,10 @@ def main() -> None:
         application.add_handler(CommandHandler("vastaanottaja", handlers.register_recipient)) # Luo uusi vastaanottajatunnus
         application.add_handler(CommandHandler("omat", handlers.list_addresses)) # Näytä kaikki omat luodut koodit
         application.add_handler(CommandHandler("jarjestaja_apu", handlers.recipient_help_message)) # Luo uusi koodi
-    
-        # TODO
-        # application.add_handler(CommandHandler("block", handlers.block_sender)) # Blokkaa lähettäjä (in case spam)
 
     else:
         logger.error('Unsupported language specified, exiting')
-        return
+        return False
 
     # --- Add conversation handlers to application ---
 
@@ -80,15 +154,77 @@ def main() -> None:
     renew_address_conv_handler = handlers.get_renew_address_conv_handler()
     application.add_handler(renew_address_conv_handler)
 
+    # Digest mode of an address
+    digest_mode_conv_handler = handlers.get_digest_mode_conv_handler()
+    application.add_handler(digest_mode_conv_handler)
+
+    # Request statistics of an address
+    stats_conv_handler = handlers.get_stats_conv_handler()
+    application.add_handler(stats_conv_handler)
+
+    # Hourly request graph of an address
+    graph_conv_handler = handlers.get_graph_conv_handler()
+    application.add_handler(graph_conv_handler)
+
+    # Most requested songs of an address
+    top_songs_conv_handler = handlers.get_top_songs_conv_handler()
+    application.add_handler(top_songs_conv_handler)
+
+    # Block and unblock senders
+    block_sender_conv_handler = handlers.get_block_sender_conv_handler()
+    application.add_handler(block_sender_conv_handler)
+    unblock_sender_conv_handler = handlers.get_unblock_sender_conv_handler()
+    application.add_handler(unblock_sender_conv_handler)
+
     # Update nickname
     update_nickname_conv_handler = handlers.get_change_nickname_conv_handler()
     application.add_handler(update_nickname_conv_handler)
 
-    # --- Run scheduled jobs ---
-    asyncio.get_event_loop().create_task(scheduled_jobs(application))
+    # Time every handler callback for the metrics
+    instrument_handlers(application)
 
-    # --- Run the bot until the user presses Ctrl-C ---
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return True
+
+def main() -> None:
+    """Start the bot."""
+    if cluster.enabled:
+        # A worker started by the ingress, which receives the updates and has already migrated the database
+        application = build_application(
+            Application.builder()
+            .updater(None)
+            .persistence(persistence)
+            .concurrent_updates(ChatUpdateProcessor(UPDATE_CONCURRENCY))
+        )
+        if add_handlers(application):
+            asyncio.run(run_worker(application))
+        return
+
+    # Create database tables and upgrade existing databases to the current schema
+    asyncio.run(database.migrate())
+
+    if BOT_WORKERS > 1:
+        # The ingress only receives updates and routes them to the workers by chat
+        application = build_application(
+            Application.builder()
+            .post_init(start_ingress)
+            .post_stop(stop_ingress)
+            .post_shutdown(shutdown_ingress)
+        )
+        application.add_handler(TypeHandler(Update, ingress.forward))
+        run(application)
+        return
+
+    # Create the Application and pass it your bot's token.
+    application = build_application(
+        Application.builder()
+        .persistence(persistence)
+        .concurrent_updates(ChatUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(start)
+        .post_stop(stop)
+        .post_shutdown(shutdown)
+    )
+    if add_handlers(application):
+        run(application)
 
 if __name__ == "__main__":
     main()
@@ -11,10 +11,13 @@ import random
 import string
 import hashlib
 
-from db.recipient_queries import *
-from utils.chatting import safe_chat
-from utils.config import sql_connection
-from datetime import datetime, timezone, timedelta
+from utils.block_list import block_list
+from utils.chatting import safe_chat, safe_photo
+from utils.logger import get_logger
+from utils.config import database, DIGEST_WINDOW_SECONDS
+from utils.expiry_scheduler import expiry_scheduler
+from utils.graphs import graph_cache
+from utils.timestamps import now, days_from_now, format_timestamp
 
 async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle conversation timeout"""
@@ -31,7 +34,7 @@ async def register_recipient(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # add_user(sql_connection, user_id, nickname='recipient' role='recipient')
 
     # Add recipient chat
-    result = add_new_recipient(sql_connection, chat_id, chat_type)
+    result = await database.add_new_recipient(chat_id, chat_type)
     if not result:
         await safe_chat(context, chat_id, f"This chat ({chat_name}) has already been registered as a recipient!")
         return
@@ -46,13 +49,13 @@ async def create_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # check if the recipient chat exists
-    recipient_exists = get_recipient_chat_id(sql_connection, chat_id)
+    recipient_exists = await database.get_recipient_chat_id(chat_id)
     if not recipient_exists:
         await safe_chat(context, chat_id, "You need to register before creating an address.")
         return ConversationHandler.END
     
     # check how many addresses the recipient owns already
-    address_count = get_amount_of_recipient_addresses(sql_connection, chat_id)
+    address_count = await database.get_amount_of_recipient_addresses(chat_id)
     if address_count >= 5:
         await safe_chat(context, chat_id, "You can only have 5 addresses at a time. Release some before creating new ones.")
         return ConversationHandler.END
@@ -77,14 +80,14 @@ async def type_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         while True:
             address = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-            if get_address_attributes(sql_connection, address) is None:
+            if await database.get_address_attributes(address) is None:
                 context.user_data['address'] = address
                 break
         return await ask_validity(update, context)
 
 async def handle_custom_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     address = update.message.text
-    if get_address_attributes(sql_connection, address) is not None:
+    if await database.get_address_attributes(address) is not None:
         await safe_chat(context, update.effective_chat.id,
                        "This code is already in use. Please choose another one:")
         return ENTER_CUSTOM
@@ -117,8 +120,7 @@ async def handle_validity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if validity_period == 'inf':
         context.user_data['valid_until'] = None
     else:
-        context.user_data['valid_until'] = (datetime.now(timezone.utc) + 
-                                          timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        context.user_data['valid_until'] = days_from_now(days)
     
     keyboard = [[
         InlineKeyboardButton("Yes", callback_data='yes_pwd'),
@@ -155,11 +157,12 @@ async def finalize_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     hashed_password = (hashlib.sha256(password.encode()).hexdigest() 
                       if password else None)
     
-    create_new_address(sql_connection, address, chat_id, hashed_password, valid_until)
+    await database.create_new_address(address, chat_id, hashed_password, valid_until)
+    expiry_scheduler.schedule(valid_until)
     
     msg = f"Address created successfully!\nCode: {address}\n"
     if valid_until:
-        msg += f"Valid until: {valid_until}"
+        msg += f"Valid until: {format_timestamp(valid_until)}"
     if password:
         msg += f"\nPassword: {password}"
     
@@ -184,7 +187,9 @@ def get_create_address_conv_handler():
         ],
         conversation_timeout=300,  # 5 minutes
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="create_address",
+        persistent=True
     )
 
 # Define states for remove address conversation
@@ -195,12 +200,12 @@ async def remove_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # check if the recipient chat exists
-    recipient_exists = get_recipient_chat_id(sql_connection, chat_id)
+    recipient_exists = await database.get_recipient_chat_id(chat_id)
     if not recipient_exists:
         await safe_chat(context, chat_id, "You need to register before removing an address.")
         return ConversationHandler.END
 
-    addresses = list_valid_recipient_addresses(sql_connection, chat_id)
+    addresses = await database.list_valid_recipient_addresses(chat_id)
     if not addresses:
         await safe_chat(context, chat_id, "You don't have any addresses set.")
         return ConversationHandler.END
@@ -237,7 +242,8 @@ async def handle_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TY
     
     if query.data == 'yes_delete':
         address = context.user_data['address_to_delete']
-        expire_address(sql_connection, address)
+        await database.expire_address(address)
+        expiry_scheduler.schedule(now())
         await safe_chat(context, update.effective_chat.id, f"Address {address} expired successfully.")
     else:
         await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
@@ -257,7 +263,9 @@ def get_remove_address_conv_handler():
         ],
         conversation_timeout=300,  # 5 minutes
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="remove_address",
+        persistent=True
     )
 
 async def list_addresses(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -265,13 +273,13 @@ async def list_addresses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # check if the recipient chat exists
-    recipient_chat_id = get_recipient_chat_id(sql_connection, chat_id)
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
     if not recipient_chat_id:
         await safe_chat(context, chat_id, "You need to register before listing addresses.")
         return
 
     # Get all addresses
-    addresses = get_recipient_addresses(sql_connection, chat_id)
+    addresses = await database.get_recipient_addresses(chat_id)
     if not addresses:
         await safe_chat(context, chat_id, "You don't have any addresses.")
         return
@@ -287,12 +295,12 @@ async def toggle_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # check if the recipient chat exists
-    recipient_chat_id = get_recipient_chat_id(sql_connection, chat_id)
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
     if not recipient_chat_id:
         await safe_chat(context, chat_id, "You need to register before toggling addresses.")
         return ConversationHandler.END
 
-    addresses = list_valid_recipient_addresses(sql_connection, chat_id)
+    addresses = await database.list_valid_recipient_addresses(chat_id)
     if not addresses:
         await safe_chat(context, chat_id, "You don't have any addresses set.")
         return ConversationHandler.END
@@ -313,7 +321,7 @@ async def handle_toggle_selection(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
     
     try:
-        toggle_success = toggle_active(sql_connection, query.data)
+        toggle_success = await database.toggle_active(query.data)
         if toggle_success:
             await safe_chat(context, update.effective_chat.id, 
                           f"Address {query.data} toggled successfully.")
@@ -337,7 +345,9 @@ def get_toggle_address_conv_handler():
         ],
         conversation_timeout=300,  # 5 minutes
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="toggle_address",
+        persistent=True
     )
 
 # Define states for release address conversation
@@ -348,12 +358,12 @@ async def release_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # check if the recipient chat exists
-    recipient_chat_id = get_recipient_chat_id(sql_connection, chat_id)
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
     if not recipient_chat_id:
         await safe_chat(context, chat_id, "You need to register before releasing addresses.")
         return ConversationHandler.END
 
-    addresses = list_recipient_addresses(sql_connection, chat_id)
+    addresses = await database.list_recipient_addresses(chat_id)
     if not addresses:
         await safe_chat(context, chat_id, "You don't have any addresses set.")
         return ConversationHandler.END
@@ -390,7 +400,7 @@ async def handle_release_confirm(update: Update, context: ContextTypes.DEFAULT_T
     
     if query.data == 'yes_delete':
         address = context.user_data['address_to_delete']
-        release_address_from_database(sql_connection, address)
+        await database.release_address_from_database(address)
         await safe_chat(context, update.effective_chat.id, f"Address {address} released successfully.")
     else:
         await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
@@ -410,7 +420,9 @@ def get_release_address_conv_handler():
         ],
         conversation_timeout=300,  # 5 minutes
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="release_address",
+        persistent=True
     )
 
 # Define states for renew address conversation
@@ -421,13 +433,13 @@ async def renew_address_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat_id = update.effective_chat.id
 
     # check if the recipient chat exists
-    recipient_chat_id = get_recipient_chat_id(sql_connection, chat_id)
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
     if not recipient_chat_id:
         await safe_chat(context, chat_id, "You need to register before renewing addresses.")
         return ConversationHandler.END
 
     
-    expired_addresses = get_expired_addresses(sql_connection, chat_id)
+    expired_addresses = await database.get_expired_addresses(chat_id)
     if not expired_addresses:
         await safe_chat(context, chat_id, "You don't have any expired addresses.")
         return ConversationHandler.END
@@ -466,11 +478,11 @@ async def handle_renew_validity(update: Update, context: ContextTypes.DEFAULT_TY
     days_map = {'1d': 1, '3d': 3, '7d': 7, '30d': 30}
     days = days_map[query.data]
     
-    new_valid_until = datetime.now(timezone.utc) + timedelta(days=days)
-    new_valid_until = new_valid_until.strftime('%Y-%m-%d %H:%M:%S')
+    new_valid_until = days_from_now(days)
     address = context.user_data['address_to_renew']
     
-    if renew_address(sql_connection, address, new_valid_until):
+    if await database.renew_address(address, new_valid_until):
+        expiry_scheduler.schedule(new_valid_until)
         await safe_chat(context, update.effective_chat.id, 
                         f"Address {address} renewed successfully!")
     else:
@@ -493,7 +505,413 @@ def get_renew_address_conv_handler():
         ],
         conversation_timeout=300,
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="renew_address",
+        persistent=True
+    )
+
+# Define states for digest mode conversation
+DIGEST_CHOOSE_ADDRESS, DIGEST_CHOOSE_MODE = 80, 81
+
+DIGEST_MODES = {
+    'off': "Off - every request is sent right away",
+    'on': "On - requests are collected into digests",
+    'auto': "Auto - digests when there are many requests",
+}
+
+async def digest_mode_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start choosing how requests to an address are delivered"""
+    chat_id = update.effective_chat.id
+
+    # check if the recipient chat exists
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
+    if not recipient_chat_id:
+        await safe_chat(context, chat_id, "You need to register before changing digest modes.")
+        return ConversationHandler.END
+
+    addresses = await database.list_valid_recipient_addresses(chat_id)
+    if not addresses:
+        await safe_chat(context, chat_id, "You don't have any addresses set.")
+        return ConversationHandler.END
+
+    keyboard = [[InlineKeyboardButton(addr, callback_data=addr)] for addr in addresses]
+    keyboard.append([InlineKeyboardButton("Exit", callback_data='exit')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, chat_id, "Select address to change the digest mode of:", reply_markup)
+    return DIGEST_CHOOSE_ADDRESS
+
+async def handle_digest_address_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == 'exit':
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    attributes = await database.get_address_attributes(query.data)
+    if attributes is None:
+        await safe_chat(context, update.effective_chat.id, "Address not found.")
+        return ConversationHandler.END
+
+    context.user_data['address_to_digest'] = query.data
+    keyboard = [[InlineKeyboardButton(label, callback_data=mode)] for mode, label in DIGEST_MODES.items()]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, update.effective_chat.id,
+                    f"Digest mode of {query.data} is {attributes['digest_mode']}. "
+                    f"Digests are sent {int(DIGEST_WINDOW_SECONDS)} seconds after the first collected request. Choose the mode:",
+                    reply_markup)
+    return DIGEST_CHOOSE_MODE
+
+async def handle_digest_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    if query.data not in DIGEST_MODES:
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    address = context.user_data['address_to_digest']
+    await database.set_digest_mode(address, query.data)
+    await safe_chat(context, update.effective_chat.id, f"Digest mode of {address} set to {query.data}.")
+    return ConversationHandler.END
+
+def get_digest_mode_conv_handler():
+    return ConversationHandler(
+        entry_points=[CommandHandler("kooste", digest_mode_start, filters.ChatType.GROUPS | filters.ChatType.PRIVATE)],
+        states={
+            DIGEST_CHOOSE_ADDRESS: [CallbackQueryHandler(handle_digest_address_selection)],
+            DIGEST_CHOOSE_MODE: [CallbackQueryHandler(handle_digest_mode)],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]
+        },
+        fallbacks=[
+            MessageHandler(filters.ALL, timeout),
+            CommandHandler("cancel", lambda _,__: ConversationHandler.END)
+        ],
+        conversation_timeout=300,
+        per_user=True,
+        per_chat=True,
+        name="digest_mode",
+        persistent=True
+    )
+
+# Define states for request statistics conversation
+STATS_CHOOSE_ADDRESS = 90
+
+def format_request_stats(address: str, stats: dict) -> str:
+    message = (f"Statistics for code {address}:\n"
+               f"Total requests: {stats['total']}\n"
+               f"Requests during the last 24 hours: {stats['last_day']}")
+    if stats['busiest_hour'] is not None:
+        hour, count = stats['busiest_hour']
+        message += f"\nBusiest hour: {format_timestamp(hour)} ({count} requests)"
+    message += f"\n\nRequests per hour during the last {len(stats['hourly'])} hours:"
+    for hour, count in stats['hourly']:
+        message += f"\n{format_timestamp(hour, '%H.%M')}  {count}"
+    return message
+
+async def stats_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start showing the request statistics of an address"""
+    chat_id = update.effective_chat.id
+
+    # check if the recipient chat exists
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
+    if not recipient_chat_id:
+        await safe_chat(context, chat_id, "You need to register before viewing statistics.")
+        return ConversationHandler.END
+
+    addresses = await database.list_recipient_addresses(chat_id)
+    if not addresses:
+        await safe_chat(context, chat_id, "You don't have any addresses set.")
+        return ConversationHandler.END
+
+    keyboard = [[InlineKeyboardButton(addr, callback_data=addr)] for addr in addresses]
+    keyboard.append([InlineKeyboardButton("Exit", callback_data='exit')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, chat_id, "Select address to show the statistics of:", reply_markup)
+    return STATS_CHOOSE_ADDRESS
+
+async def handle_stats_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == 'exit':
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    stats = await database.get_request_stats(query.data, update.effective_chat.id)
+    await safe_chat(context, update.effective_chat.id, format_request_stats(query.data, stats))
+    return ConversationHandler.END
+
+def get_stats_conv_handler():
+    return ConversationHandler(
+        entry_points=[CommandHandler("tilastot", stats_start, filters.ChatType.GROUPS | filters.ChatType.PRIVATE)],
+        states={
+            STATS_CHOOSE_ADDRESS: [CallbackQueryHandler(handle_stats_selection)],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]
+        },
+        fallbacks=[
+            MessageHandler(filters.ALL, timeout),
+            CommandHandler("cancel", lambda _,__: ConversationHandler.END)
+        ],
+        conversation_timeout=300,
+        per_user=True,
+        per_chat=True,
+        name="request_stats",
+        persistent=True
+    )
+
+# Define states for request graph conversation
+GRAPH_CHOOSE_ADDRESS = 100
+
+async def graph_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start sending the hourly request graph of an address"""
+    chat_id = update.effective_chat.id
+
+    # check if the recipient chat exists
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
+    if not recipient_chat_id:
+        await safe_chat(context, chat_id, "You need to register before viewing graphs.")
+        return ConversationHandler.END
+
+    addresses = await database.list_recipient_addresses(chat_id)
+    if not addresses:
+        await safe_chat(context, chat_id, "You don't have any addresses set.")
+        return ConversationHandler.END
+
+    keyboard = [[InlineKeyboardButton(addr, callback_data=addr)] for addr in addresses]
+    keyboard.append([InlineKeyboardButton("Exit", callback_data='exit')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, chat_id, "Select address to show the request graph of:", reply_markup)
+    return GRAPH_CHOOSE_ADDRESS
+
+async def handle_graph_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == 'exit':
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    graph = await graph_cache.get_graph(query.data, update.effective_chat.id)
+    await safe_photo(context, update.effective_chat.id, graph, f"Song requests per hour for code {query.data}")
+    return ConversationHandler.END
+
+def get_graph_conv_handler():
+    return ConversationHandler(
+        entry_points=[CommandHandler("kaavio", graph_start, filters.ChatType.GROUPS | filters.ChatType.PRIVATE)],
+        states={
+            GRAPH_CHOOSE_ADDRESS: [CallbackQueryHandler(handle_graph_selection)],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]
+        },
+        fallbacks=[
+            MessageHandler(filters.ALL, timeout),
+            CommandHandler("cancel", lambda _,__: ConversationHandler.END)
+        ],
+        conversation_timeout=300,
+        per_user=True,
+        per_chat=True,
+        name="request_graph",
+        persistent=True
+    )
+
+# Define states for top songs conversation
+TOP_CHOOSE_ADDRESS = 110
+
+# Songs listed by /top unless another amount is given, and the most it lists
+DEFAULT_TOP_SONGS, MAX_TOP_SONGS = 10, 50
+
+def format_top_songs(address: str, songs: list) -> str:
+    if not songs:
+        return f"No songs have been requested with code {address} yet."
+    lines = [f"{i}. {song_name} - {artist_name} ({count})"
+             for i, (song_name, artist_name, count) in enumerate(songs, start=1)]
+    return f"Most requested songs for code {address}:\n" + "\n".join(lines)
+
+async def top_songs_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start listing the most requested songs of an address, /top [amount]"""
+    chat_id = update.effective_chat.id
+
+    # check if the recipient chat exists
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
+    if not recipient_chat_id:
+        await safe_chat(context, chat_id, "You need to register before viewing the most requested songs.")
+        return ConversationHandler.END
+
+    addresses = await database.list_recipient_addresses(chat_id)
+    if not addresses:
+        await safe_chat(context, chat_id, "You don't have any addresses set.")
+        return ConversationHandler.END
+
+    try:
+        top_count = int(context.args[0]) if context.args else DEFAULT_TOP_SONGS
+    except ValueError:
+        top_count = DEFAULT_TOP_SONGS
+    context.user_data['top_count'] = min(max(top_count, 1), MAX_TOP_SONGS)
+
+    keyboard = [[InlineKeyboardButton(addr, callback_data=addr)] for addr in addresses]
+    keyboard.append([InlineKeyboardButton("Exit", callback_data='exit')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, chat_id, "Select address to show the most requested songs of:", reply_markup)
+    return TOP_CHOOSE_ADDRESS
+
+async def handle_top_songs_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == 'exit':
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    top_count = context.user_data.get('top_count', DEFAULT_TOP_SONGS)
+    songs = await database.get_top_songs(query.data, update.effective_chat.id, top_count)
+    await safe_chat(context, update.effective_chat.id, format_top_songs(query.data, songs))
+    return ConversationHandler.END
+
+def get_top_songs_conv_handler():
+    return ConversationHandler(
+        entry_points=[CommandHandler("top", top_songs_start, filters.ChatType.GROUPS | filters.ChatType.PRIVATE)],
+        states={
+            TOP_CHOOSE_ADDRESS: [CallbackQueryHandler(handle_top_songs_selection)],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]
+        },
+        fallbacks=[
+            MessageHandler(filters.ALL, timeout),
+            CommandHandler("cancel", lambda _,__: ConversationHandler.END)
+        ],
+        conversation_timeout=300,
+        per_user=True,
+        per_chat=True,
+        name="top_songs",
+        persistent=True
+    )
+
+# Define states for blocking and unblocking senders
+BLOCK_CHOOSE_USER, UNBLOCK_CHOOSE_USER = 120, 130
+
+# Longest button label, the rest of the latest song is cut
+MAX_BUTTON_LABEL = 60
+
+def format_sender(nickname) -> str:
+    return nickname or "Anonymous user"
+
+async def block_sender(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start blocking a sender, chosen from the latest requesters of the chat"""
+    chat_id = update.effective_chat.id
+
+    # check if the recipient chat exists
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
+    if not recipient_chat_id:
+        await safe_chat(context, chat_id, "You need to register before blocking senders.")
+        return ConversationHandler.END
+
+    requesters = [(user_id, nickname, song_name)
+                  for user_id, nickname, song_name in await database.get_recent_requesters(chat_id)
+                  if not block_list.is_blocked(chat_id, user_id)]
+    if not requesters:
+        await safe_chat(context, chat_id, "Nobody has sent song requests to this chat during the last day.")
+        return ConversationHandler.END
+
+    context.user_data['block_candidates'] = {user_id: nickname for user_id, nickname, _ in requesters}
+    keyboard = [[InlineKeyboardButton(f"{format_sender(nickname)}: {song_name}"[:MAX_BUTTON_LABEL], callback_data=user_id)]
+                for user_id, nickname, song_name in requesters]
+    keyboard.append([InlineKeyboardButton("Exit", callback_data='exit')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, chat_id, "Select the sender to block. The latest song they requested is shown:", reply_markup)
+    return BLOCK_CHOOSE_USER
+
+async def handle_block_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    candidates = context.user_data.pop('block_candidates', {})
+    if query.data == 'exit' or query.data not in candidates:
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    await block_list.block(update.effective_chat.id, query.data)
+    await safe_chat(context, update.effective_chat.id,
+                    f"{format_sender(candidates[query.data])} is blocked. Their song requests to this chat are dropped. "
+                    "Use /salli to allow them again.")
+    return ConversationHandler.END
+
+def get_block_sender_conv_handler():
+    return ConversationHandler(
+        entry_points=[CommandHandler("esta", block_sender, filters.ChatType.GROUPS | filters.ChatType.PRIVATE)],
+        states={
+            BLOCK_CHOOSE_USER: [CallbackQueryHandler(handle_block_selection)],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]
+        },
+        fallbacks=[
+            MessageHandler(filters.ALL, timeout),
+            CommandHandler("cancel", lambda _,__: ConversationHandler.END)
+        ],
+        conversation_timeout=300,
+        per_user=True,
+        per_chat=True,
+        name="block_sender",
+        persistent=True
+    )
+
+async def unblock_sender(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start allowing a blocked sender to send requests again"""
+    chat_id = update.effective_chat.id
+
+    # check if the recipient chat exists
+    recipient_chat_id = await database.get_recipient_chat_id(chat_id)
+    if not recipient_chat_id:
+        await safe_chat(context, chat_id, "You need to register before unblocking senders.")
+        return ConversationHandler.END
+
+    blocked = await database.get_blocked_users(chat_id)
+    if not blocked:
+        await safe_chat(context, chat_id, "No senders are blocked in this chat.")
+        return ConversationHandler.END
+
+    context.user_data['unblock_candidates'] = dict(blocked)
+    keyboard = [[InlineKeyboardButton(format_sender(nickname)[:MAX_BUTTON_LABEL], callback_data=user_id)]
+                for user_id, nickname in blocked]
+    keyboard.append([InlineKeyboardButton("Exit", callback_data='exit')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await safe_chat(context, chat_id, "Select the sender to allow again:", reply_markup)
+    return UNBLOCK_CHOOSE_USER
+
+async def handle_unblock_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    candidates = context.user_data.pop('unblock_candidates', {})
+    if query.data == 'exit' or query.data not in candidates:
+        await safe_chat(context, update.effective_chat.id, "Operation cancelled.")
+        return ConversationHandler.END
+
+    await block_list.unblock(update.effective_chat.id, query.data)
+    await safe_chat(context, update.effective_chat.id,
+                    f"{format_sender(candidates[query.data])} can send song requests to this chat again.")
+    return ConversationHandler.END
+
+def get_unblock_sender_conv_handler():
+    return ConversationHandler(
+        entry_points=[CommandHandler("salli", unblock_sender, filters.ChatType.GROUPS | filters.ChatType.PRIVATE)],
+        states={
+            UNBLOCK_CHOOSE_USER: [CallbackQueryHandler(handle_unblock_selection)],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.ALL, timeout)]
+        },
+        fallbacks=[
+            MessageHandler(filters.ALL, timeout),
+            CommandHandler("cancel", lambda _,__: ConversationHandler.END)
+        ],
+        conversation_timeout=300,
+        per_user=True,
+        per_chat=True,
+        name="unblock_sender",
+        persistent=True
     )
 
 async def recipient_help_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -508,6 +926,12 @@ async def recipient_help_message(update: Update, context: ContextTypes.DEFAULT_T
         "/vanhenna - Expire a code (expired codes get released after 10 days)\n"
         "/vapauta - Release a code. Anyone can claim the code when it is released\n"
         "/uudista - Renew an expired code\n"
+        "/kooste - Choose whether requests to a code are collected into digests\n"
+        "/tilastot - Show the amount of requests sent to a code per hour\n"
+        "/kaavio - Show a graph of the requests sent to a code per hour\n"
+        f"/top - List the most requested songs of a code. Give an amount to list up to {MAX_TOP_SONGS} songs, for example /top 20\n"
+        "/esta - Block a sender who has sent requests to this chat during the last day\n"
+        "/salli - Allow a blocked sender to send requests again\n"
         "/cancel - Cancel any operation\n"
     )
     await safe_chat(context, chat_id, help_message)
\ No newline at end of file
@@ -1,12 +1,18 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, MessageHandler, filters, ConversationHandler, CallbackQueryHandler, CommandHandler
 import hashlib
+import math
 
+from db.routing import routing_table
 from errors.query_errors import AddressExpiredError, AddressNotActiveError, AddressNotFoundError
-from utils.chatting import safe_chat
+from utils.block_list import block_list
+from utils.chatting import safe_chat, safe_edit
 from utils.logger import get_logger
-from utils.config import sql_connection
-from db import *
+from utils.config import (
+    database, request_buffer, user_request_limiter, address_request_limiter, code_attempt_limiter, password_lockout
+)
+from utils.delivery import request_delivery, SongRequest
+from utils.timestamps import now
 
 from warnings import filterwarnings
 from telegram.warnings import PTBUserWarning
@@ -20,6 +26,11 @@ async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_chat(context, update.effective_chat.id, "Operation cancelled or timed out.")
     return ConversationHandler.END
 
+async def reject_throttled(context: ContextTypes.DEFAULT_TYPE, chat_id: int, limiter, key, wait: float, message: str):
+    """Tell a throttled user when to try again, only once until they are allowed again"""
+    if limiter.should_warn(key):
+        await safe_chat(context, chat_id, f"{message} Try again in {math.ceil(wait)} seconds.")
+
 # States for recipient setting conversation
 CODE_INPUT, PASSWORD_INPUT, CHANGE_CODE = 0, 1, 2
 
@@ -32,13 +43,18 @@ async def set_recipient(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != 'private':
         await safe_chat(context, chat_id, "This command can only be used in private chats.")
         return ConversationHandler.END
+
+    wait = code_attempt_limiter.delay(user_id)
+    if wait:
+        await reject_throttled(context, chat_id, code_attempt_limiter, user_id, wait, "Too many codes tried.")
+        return ConversationHandler.END
     
     # Check if user exists
-    if not user_exists(sql_connection, user_id):
+    if not await database.user_exists(user_id):
         await safe_chat(context, user_id, "You need to register before using the bot!")
         return ConversationHandler.END
 
-    current_address = get_current_address(sql_connection, user_id)
+    current_address = await database.get_current_address(user_id)
     if current_address:
         await safe_chat(context, chat_id, f"Your current code is: {current_address}")
         keyboard = [
@@ -68,15 +84,21 @@ async def handle_change_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def handle_code_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the code input"""
+    user_id = update.effective_user.id
+    wait = code_attempt_limiter.acquire(user_id)
+    if wait:
+        await reject_throttled(context, update.effective_chat.id, code_attempt_limiter, user_id, wait, "Too many codes tried.")
+        return ConversationHandler.END
+
     context.user_data['address'] = update.message.text
     
-    if is_password_set(sql_connection, context.user_data['address']):
+    if await database.is_password_set(context.user_data['address']):
         context.user_data['password_attempts'] = 0
         await safe_chat(context, update.effective_chat.id, "Please enter the password:")
         return PASSWORD_INPUT
     
     try:
-        result = set_user_forward_address(sql_connection, update.effective_user.id, context.user_data['address'])
+        result = await database.set_user_forward_address(update.effective_user.id, context.user_data['address'])
         await safe_chat(context, update.effective_chat.id, "Code accepted! You can now start sending song requests using the /biisitoive command.")
         return ConversationHandler.END
     except Exception as e:
@@ -86,12 +108,19 @@ async def handle_code_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle password verification"""
+    user_id = update.effective_user.id
+    locked = password_lockout.remaining(user_id)
+    if locked:
+        await reject_throttled(context, update.effective_chat.id, password_lockout, user_id, locked, "Too many incorrect passwords.")
+        return PASSWORD_INPUT
+
     password = update.message.text
     hashed_password = hashlib.sha256(password.encode()).hexdigest()
     
-    if check_password_match(sql_connection, context.user_data['address'], hashed_password):
+    if await database.check_password_match(context.user_data['address'], hashed_password):
+        password_lockout.succeed(user_id)
         try:
-            result = set_user_forward_address(sql_connection, update.effective_user.id, context.user_data['address'])
+            result = await database.set_user_forward_address(update.effective_user.id, context.user_data['address'])
             await safe_chat(context, update.effective_chat.id, "Code accepted! You can now start sending song requests using the /biisitoive command.")
             return ConversationHandler.END
         except Exception as e:
@@ -99,12 +128,13 @@ async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await safe_chat(context, update.effective_chat.id, str(e))
             return ConversationHandler.END
     
+    lockout = password_lockout.fail(user_id)
     context.user_data['password_attempts'] = context.user_data.get('password_attempts', 0) + 1
     if context.user_data['password_attempts'] >= 3:
         await safe_chat(context, update.effective_chat.id, "Maximum password attempts reached.")
         return ConversationHandler.END
     
-    await safe_chat(context, update.effective_chat.id, "Incorrect password. Please try again.")
+    await safe_chat(context, update.effective_chat.id, f"Incorrect password. Please try again in {math.ceil(lockout)} seconds.")
     return PASSWORD_INPUT
 
 def get_set_recipient_conv_handler():
@@ -123,7 +153,9 @@ def get_set_recipient_conv_handler():
         ],
         conversation_timeout=300,  # 5 minutes timeout
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="set_recipient",
+        persistent=True
     )
 
 
@@ -139,11 +171,11 @@ async def change_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_chat(context, chat_id, "This command can only be used in private chats.")
         return ConversationHandler.END
     
-    if not user_exists(sql_connection, user_id):
+    if not await database.user_exists(user_id):
         await safe_chat(context, user_id, "You need to register before using the bot!")
         return ConversationHandler.END
 
-    current_nickname = get_nickname(sql_connection, user_id)
+    current_nickname = await database.get_nickname(user_id)
     if current_nickname:
         await safe_chat(context, chat_id, f"Your current nickname is: {current_nickname}")
         keyboard = [
@@ -174,7 +206,7 @@ async def handle_nickname_change(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_new_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the new nickname input"""
     new_nickname = update.message.text
-    update_nickname(sql_connection, update.effective_user.id, new_nickname)
+    await database.update_nickname(update.effective_user.id, new_nickname)
     await safe_chat(context, update.effective_chat.id, f"Your nickname has been updated to: {new_nickname}")
     return ConversationHandler.END
 
@@ -193,7 +225,9 @@ def get_change_nickname_conv_handler():
         ],
         conversation_timeout=300,
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="change_nickname",
+        persistent=True
     )
 
 
@@ -208,7 +242,7 @@ async def register_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_chat(context, chat_id, "This command can only be used in private chats.")
         return ConversationHandler.END
 
-    if user_exists(sql_connection, user_id):
+    if await database.user_exists(user_id):
         await safe_chat(context, user_id, "You are already registered!")
         return ConversationHandler.END
 
@@ -229,7 +263,7 @@ async def nickname_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_chat(context, query.message.chat_id, 'Please enter your nickname:')
         return ENTER_NICKNAME
     else:
-        add_user(sql_connection, update.effective_user.id, nickname=None, role='user')
+        await database.add_user(update.effective_user.id, nickname=None, role='user')
         await safe_chat(context, query.message.chat_id, "Welcome mysterious user!")
         await safe_chat(context, update.effective_chat.id, "⁉️ Here is some basic info ⁉️\n - Do you already know the code for the event? 👀 If you do, use the /koodi command to set the code.\nAfter this you can send song requests to the event organizer/DJ using the command /biisitoive\n - If you don't know the code, ask for it from the event organizer/DJ! 😊\n\n👀 Are you an event organizer or a DJ and want to setup your own code?\nFind out how using /jarjestaja_apu 🙌")
         return ConversationHandler.END
@@ -237,7 +271,7 @@ async def nickname_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def save_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nickname = update.message.text
     user_id = update.effective_user.id
-    add_user(sql_connection, user_id, nickname=nickname, role='user')
+    await database.add_user(user_id, nickname=nickname, role='user')
     await safe_chat(context, update.effective_chat.id, f"Welcome {nickname}!")
     await safe_chat(context, update.effective_chat.id, "⁉️ Here is some basic info ⁉️\n - Do you already know the code for the event? 👀 If you do, use the /koodi command to set the code.\nAfter this you can send song requests to the event organizer/DJ using the command /biisitoive\n - If you don't know the code, ask for it from the event organizer/DJ! 😊\n\n👀 Are you an event organizer or a DJ and want to setup your own code?\nFind out how using /jarjestaja_apu 🙌")
     return ConversationHandler.END
@@ -256,11 +290,15 @@ def get_register_conv_handler():
         ],
         conversation_timeout=300,
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="register",
+        persistent=True
     )
 
 SONG_NAME, ARTIST_NAME, NOTES, CONFIRMATION = 20, 21, 22, 23
 
+BLOCKED_MESSAGE = "The recipient is not accepting song requests from you."
+
 async def song_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Entry point for song request conversation"""
     chat_id = update.effective_chat.id
@@ -271,16 +309,34 @@ async def song_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_chat(context, chat_id, "This command can only be used in private chats.")
         return ConversationHandler.END
 
+    # Throttled before any database access
+    wait = user_request_limiter.acquire(user_id)
+    if wait:
+        await reject_throttled(context, chat_id, user_request_limiter, user_id, wait, "You are sending song requests too fast.")
+        return ConversationHandler.END
+
+    # Blocked senders are turned away without database access when their route is cached
+    route = routing_table.get(user_id)
+    if route is not None and route.chat_id is not None and block_list.is_blocked(route.chat_id, user_id):
+        await safe_chat(context, chat_id, BLOCKED_MESSAGE)
+        return ConversationHandler.END
+
     # Check if user exists
-    if not user_exists(sql_connection, user_id):
+    if not await database.user_exists(user_id):
         await safe_chat(context, user_id, "You need to register before using the bot!")
         return ConversationHandler.END
 
     # Check if the user has a forwarding address
     try:
-        recipient = get_recipient(sql_connection, user_id)
-        context.user_data['recipient'] = recipient
-        context.user_data['nickname'] = get_nickname(sql_connection, user_id)
+        route = await database.get_recipient(user_id)
+        # The route was not cached yet
+        if block_list.is_blocked(route.chat_id, user_id):
+            await safe_chat(context, chat_id, BLOCKED_MESSAGE)
+            return ConversationHandler.END
+        context.user_data['recipient'] = route.chat_id
+        context.user_data['recipient_address'] = route.address
+        context.user_data['recipient_digest_mode'] = route.digest_mode
+        context.user_data['nickname'] = await database.get_nickname(user_id)
     except (AddressExpiredError, AddressNotActiveError, AddressNotFoundError) as e:
         error_messages = {
             AddressExpiredError: "Code has expired.",
@@ -339,7 +395,8 @@ async def show_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         confirm_text += f"\nNotes: {context.user_data['notes']}"
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(confirm_text, reply_markup=reply_markup)
+        await safe_edit(context, update.effective_chat.id, update.callback_query.message.message_id, confirm_text,
+                        reply_markup=reply_markup)
     else:
         await safe_chat(context, update.effective_chat.id, confirm_text, reply_markup=reply_markup)
     return CONFIRMATION
@@ -350,12 +407,36 @@ async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     if query.data == 'yes':
-        message = (f"New song request from {context.user_data['nickname']}!\n"
-                  f"Song: {context.user_data['song_name']}\n"
-                  f"Artist: {context.user_data['artist_name']}\n"
-                  f"Notes: {context.user_data['notes']}")
-        await safe_chat(context, context.user_data['recipient'], message)
+        # The sender may have been blocked while writing the request
+        if block_list.is_blocked(context.user_data['recipient'], update.effective_user.id):
+            await safe_chat(context, update.effective_chat.id, BLOCKED_MESSAGE)
+            return ConversationHandler.END
+
+        # The recipient is protected from floods of requests, the user may confirm again later
+        wait = address_request_limiter.acquire(context.user_data['recipient_address'])
+        if wait:
+            await safe_chat(context, update.effective_chat.id,
+                            f"The recipient is receiving too many requests right now. Press Yes again in {math.ceil(wait)} seconds.")
+            return CONFIRMATION
+
+        request = SongRequest(update.effective_user.id,
+                              context.user_data['nickname'],
+                              context.user_data['song_name'],
+                              context.user_data['artist_name'],
+                              context.user_data['notes'])
+        await request_delivery.deliver(context,
+                                       context.user_data['recipient_address'],
+                                       context.user_data['recipient'],
+                                       context.user_data['recipient_digest_mode'],
+                                       request)
         await safe_chat(context, update.effective_chat.id, "Song request sent!")
+        request_buffer.add(update.effective_user.id,
+                           context.user_data['recipient_address'],
+                           context.user_data['recipient'],
+                           context.user_data['song_name'],
+                           context.user_data['artist_name'],
+                           context.user_data['notes'],
+                           now())
         logger.info(f"Song request from {update.effective_user.id} sent to {context.user_data['recipient']}")
     else:
         await safe_chat(context, update.effective_chat.id, "Song request cancelled.")
@@ -383,7 +464,9 @@ def get_song_request_conv_handler():
         ],
         conversation_timeout=300,
         per_user=True,
-        per_chat=True 
+        per_chat=True,
+        name="song_request",
+        persistent=True
     )
     
 async def help_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
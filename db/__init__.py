@@ -1,4 +1,7 @@
 from .recipient_queries import *
 from .user_queries import *
+from .request_queries import *
+from .block_queries import *
+from .persistence_queries import *
 from .schema import *
 from .utils import *
\ No newline at end of file
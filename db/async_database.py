@@ -0,0 +1,99 @@
+from db import block_queries, migrations, persistence_queries, recipient_queries, request_queries, user_queries, utils
+from db.pool import ConnectionPool
+from db.storage import Storage
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+def _reader(module, name: str):
+    """
+    Wrap a blocking read-only query function into a coroutine method of AsyncDatabase.
+    The function is looked up on call, as the query modules may still be
+    initializing when this module is imported.
+    """
+    async def wrapper(self, *args, **kwargs):
+        return await self.pool.read(getattr(module, name), *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+def _writer(module, name: str):
+    """Wrap a blocking query function that modifies the database, see _reader"""
+    async def wrapper(self, *args, **kwargs):
+        return await self.pool.write(getattr(module, name), *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+class AsyncDatabase(Storage):
+    """
+    Awaitable access to the query functions of the db package, the SQLite storage backend.
+
+    Lookups run on the read-only connections of the pool and modifications on
+    its single writer connection, so slow statements and commits never block
+    the asyncio event loop and readers do not wait on writers.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+
+    async def migrate(self) -> None:
+        await self.pool.write(migrations.migrate)
+
+    async def close(self) -> None:
+        """Wait for pending queries and close the connection pool"""
+        self.pool.close()
+
+    # --- User queries ---
+    get_forward_address = _reader(user_queries, 'get_forward_address')
+    get_address_chat_id = _reader(user_queries, 'get_address_chat_id')
+    is_recipient_active = _reader(user_queries, 'is_recipient_active')
+    is_recipient_valid = _reader(user_queries, 'is_recipient_valid')
+    resolve_route = _reader(user_queries, 'resolve_route')
+    get_recipient = _reader(user_queries, 'get_recipient')
+    add_user = _writer(user_queries, 'add_user')
+    get_nickname = _reader(user_queries, 'get_nickname')
+    update_nickname = _writer(user_queries, 'update_nickname')
+    address_exists = _reader(user_queries, 'address_exists')
+    user_exists = _reader(user_queries, 'user_exists')
+    set_user_forward_address = _writer(user_queries, 'set_user_forward_address')
+    check_password_match = _reader(user_queries, 'check_password_match')
+    is_password_set = _reader(user_queries, 'is_password_set')
+    get_current_address = _reader(user_queries, 'get_current_address')
+
+    # --- Recipient queries ---
+    add_new_recipient = _writer(recipient_queries, 'add_new_recipient')
+    get_recipient_chat_id = _reader(recipient_queries, 'get_recipient_chat_id')
+    get_address_attributes = _reader(recipient_queries, 'get_address_attributes')
+    get_amount_of_recipient_addresses = _reader(recipient_queries, 'get_amount_of_recipient_addresses')
+    create_new_address = _writer(recipient_queries, 'create_new_address')
+    expire_address = _writer(recipient_queries, 'expire_address')
+    get_recipient_addresses = _reader(recipient_queries, 'get_recipient_addresses')
+    list_recipient_addresses = _reader(recipient_queries, 'list_recipient_addresses')
+    list_valid_recipient_addresses = _reader(recipient_queries, 'list_valid_recipient_addresses')
+    toggle_active = _writer(recipient_queries, 'toggle_active')
+    release_address_from_database = _writer(recipient_queries, 'release_address_from_database')
+    get_expired_addresses = _reader(recipient_queries, 'get_expired_addresses')
+    renew_address = _writer(recipient_queries, 'renew_address')
+    set_digest_mode = _writer(recipient_queries, 'set_digest_mode')
+
+    # --- Song request queries ---
+    insert_song_requests = _writer(request_queries, 'insert_song_requests')
+    get_request_stats = _reader(request_queries, 'get_request_stats')
+    get_hourly_request_counts = _reader(request_queries, 'get_hourly_request_counts')
+    get_top_songs = _reader(request_queries, 'get_top_songs')
+
+    # --- Blocked sender queries ---
+    block_user = _writer(block_queries, 'block_user')
+    unblock_user = _writer(block_queries, 'unblock_user')
+    get_blocked_users = _reader(block_queries, 'get_blocked_users')
+    get_all_blocked_users = _reader(block_queries, 'get_all_blocked_users')
+    get_recent_requesters = _reader(block_queries, 'get_recent_requesters')
+
+    # --- Bot persistence queries ---
+    load_conversations = _reader(persistence_queries, 'load_conversations')
+    load_user_data = _reader(persistence_queries, 'load_user_data')
+    save_persistence = _writer(persistence_queries, 'save_persistence')
+
+    # --- Maintenance queries ---
+    release_expired_addresses = _writer(utils, 'release_expired_addresses')
+    get_expiry_deadlines = _reader(utils, 'get_expiry_deadlines')
+    claim_expired_addresses = _writer(utils, 'claim_expired_addresses')
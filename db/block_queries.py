@@ -0,0 +1,79 @@
+import sqlite3
+
+from utils.logger import get_logger
+from utils.timestamps import DAY_SECONDS, now
+
+logger = get_logger(__name__)
+
+def block_user(conn: sqlite3.Connection, chat_id: str, user_id: str):
+    """Block the user from sending song requests to the chat, returns False if already blocked"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO R_BLOCKED_USER (chat_id, user_id)
+        VALUES (?, ?)
+        ON CONFLICT (chat_id, user_id) DO NOTHING
+    ''', (str(chat_id), str(user_id)))
+    blocked = cursor.rowcount > 0
+    conn.commit()
+    cursor.close()
+
+    if blocked:
+        logger.info(f"User {user_id} blocked in chat {chat_id}")
+    return blocked
+
+def unblock_user(conn: sqlite3.Connection, chat_id: str, user_id: str):
+    """Allow a blocked user to send song requests to the chat again"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM R_BLOCKED_USER
+        WHERE chat_id = ? AND user_id = ?
+    ''', (str(chat_id), str(user_id)))
+    unblocked = cursor.rowcount > 0
+    conn.commit()
+    cursor.close()
+
+    if unblocked:
+        logger.info(f"User {user_id} unblocked in chat {chat_id}")
+    return unblocked
+
+def get_blocked_users(conn: sqlite3.Connection, chat_id: str):
+    """Users blocked in the chat as (user_id, nickname) rows"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT b.user_id, u.nickname
+        FROM R_BLOCKED_USER b
+        LEFT JOIN D_USER u ON u.user_id = b.user_id
+        WHERE b.chat_id = ?
+        ORDER BY b.idate DESC
+    ''', (str(chat_id),))
+    users = cursor.fetchall()
+    cursor.close()
+    return users
+
+def get_all_blocked_users(conn: sqlite3.Connection):
+    """Every block as (chat_id, user_id) rows, loaded into memory at startup"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT chat_id, user_id FROM R_BLOCKED_USER')
+    blocks = cursor.fetchall()
+    cursor.close()
+    return blocks
+
+def get_recent_requesters(conn: sqlite3.Connection, chat_id: str, days: int = 1, limit: int = 20):
+    """
+    Users who have sent song requests to the chat during the last days as
+    (user_id, nickname, song_name) rows with their latest song, latest first
+    """
+    cursor = conn.cursor()
+    # SQLite takes the bare song_name column from the row with the latest request
+    cursor.execute('''
+        SELECT r.user_id, u.nickname, r.song_name, MAX(r.requested_at) AS last_requested
+        FROM F_SONG_REQUEST r
+        LEFT JOIN D_USER u ON u.user_id = r.user_id
+        WHERE r.chat_id = ? AND r.requested_at >= ?
+        GROUP BY r.user_id
+        ORDER BY last_requested DESC
+        LIMIT ?
+    ''', (str(chat_id), now() - days * DAY_SECONDS, limit))
+    requesters = [(user_id, nickname, song_name) for user_id, nickname, song_name, _ in cursor.fetchall()]
+    cursor.close()
+    return requesters
@@ -0,0 +1,79 @@
+import functools
+import sqlite3
+import time
+
+from utils.logger import get_logger
+from utils.metrics import DB_STATEMENT_SECONDS
+
+logger = get_logger(__name__)
+slow_query_logger = get_logger('db.slow_query')
+
+@functools.lru_cache(maxsize=1024)
+def normalize_statement(sql: str) -> str:
+    """The statement on one line, as it is logged and labeled in the metrics"""
+    return ' '.join(sql.split())
+
+def parameters_shape(parameters) -> str:
+    """Types of the parameters without their values, which may contain user data"""
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+
+def record_statement(sql: str, parameters, seconds: float, slow_query_seconds: float = None, many: bool = False) -> None:
+    """Add the duration of a statement to the metrics and log it if it was slow"""
+    statement = normalize_statement(sql)
+    DB_STATEMENT_SECONDS.observe(seconds, statement=statement)
+    if slow_query_seconds is not None and seconds >= slow_query_seconds:
+        if many:
+            shape = f"{len(parameters)} x {parameters_shape(parameters[0])}" if parameters else "0 rows"
+        else:
+            shape = parameters_shape(parameters)
+        slow_query_logger.warning(f"Slow query ({seconds * 1000:.1f} ms): {statement} parameters {shape}")
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor timing every statement it executes"""
+
+    def execute(self, sql: str, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql: str, parameters):
+        parameters = parameters if isinstance(parameters, list) else list(parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self.connection.record(sql, parameters, time.perf_counter() - started, many=True)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection recording the duration of every statement.
+
+    The time covers running the statement up to its first result row. The
+    queries of the bot are lookups, aggregates and sorted lists, which do all
+    of their work before the first row, so this is nearly all of their cost.
+    Statements slower than slow_query_seconds are logged to the db.slow_query
+    logger with the types of their parameters. When captured is a list, the
+    statements and their parameters are also appended to it, which is used to
+    check the query plans of the queries.
+    """
+
+    slow_query_seconds = None
+    captured = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def record(self, sql: str, parameters, seconds: float, many: bool = False) -> None:
+        record_statement(sql, parameters, seconds, self.slow_query_seconds, many)
+        if self.captured is not None:
+            self.captured.append((sql, parameters[0] if many and parameters else parameters))
@@ -0,0 +1,305 @@
+import sqlite3
+from collections import Counter
+
+from db.schema import create_tables
+from utils.logger import get_logger
+from utils.text import normalize_song
+
+logger = get_logger(__name__)
+
+def add_chat_address_indexes(conn: sqlite3.Connection) -> None:
+    # Recipient listings filter by chat and the cleaning jobs by expiration time
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_CHAT_ADDRESS_CHAT_ID
+    ON R_CHAT_ADDRESS (chat_id);
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_CHAT_ADDRESS_VALID_UNTIL
+    ON R_CHAT_ADDRESS (valid_until);
+    ''')
+
+def add_forward_address_primary_key(conn: sqlite3.Connection) -> None:
+    # SQLite cannot add a primary key to an existing table, so the table is rebuilt.
+    # Should a user have several rows, the most recently inserted one is kept.
+    conn.execute('''
+    CREATE TABLE R_FORWARD_ADDRESS_NEW (
+        user_id TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        uby TEXT DEFAULT 'system',
+        idate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        udate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES D_USER(user_id),
+        FOREIGN KEY (address) REFERENCES R_CHAT_ADDRESS(address)
+    );
+    ''')
+    conn.execute('''
+    INSERT INTO R_FORWARD_ADDRESS_NEW (user_id, address, iby, uby, idate, udate)
+    SELECT user_id, address, iby, uby, idate, udate
+    FROM R_FORWARD_ADDRESS
+    WHERE rowid IN (
+        SELECT MAX(rowid)
+        FROM R_FORWARD_ADDRESS
+        GROUP BY user_id
+    );
+    ''')
+    conn.execute('DROP TABLE R_FORWARD_ADDRESS;')
+    conn.execute('ALTER TABLE R_FORWARD_ADDRESS_NEW RENAME TO R_FORWARD_ADDRESS;')
+
+    # Used when looking up the users of a code
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_FORWARD_ADDRESS_ADDRESS
+    ON R_FORWARD_ADDRESS (address);
+    ''')
+
+def create_song_request_table(conn: sqlite3.Connection) -> None:
+    # Confirmed song requests, written in batches by SongRequestBuffer
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS F_SONG_REQUEST (
+        request_id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        song_name TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        notes TEXT,
+        requested_at TIMESTAMP NOT NULL,
+        iby TEXT DEFAULT 'system',
+        idate TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_SONG_REQUEST_ADDRESS
+    ON F_SONG_REQUEST (address, requested_at);
+    ''')
+
+def add_digest_mode(conn: sqlite3.Connection) -> None:
+    # 'off' forwards every request, 'on' coalesces them into digests and
+    # 'auto' switches to digests when the chat receives many requests
+    conn.execute('''
+    ALTER TABLE R_CHAT_ADDRESS
+    ADD COLUMN digest_mode TEXT DEFAULT 'auto';
+    ''')
+
+def create_persistence_tables(conn: sqlite3.Connection) -> None:
+    # Conversation states and user_data of the bot, written by DatabasePersistence
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS P_CONVERSATION (
+        name TEXT NOT NULL,
+        conversation_key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        udate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (name, conversation_key)
+    );
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS P_USER_DATA (
+        user_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        udate TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+
+def add_expiry_notified(conn: sqlite3.Connection) -> None:
+    # Set once the owner has been notified of the expiration, so the notification
+    # is never repeated. Codes that have already expired were handled by the
+    # former hourly job.
+    conn.execute('''
+    ALTER TABLE R_CHAT_ADDRESS
+    ADD COLUMN expiry_notified INTEGER DEFAULT 0;
+    ''')
+    conn.execute('''
+    UPDATE R_CHAT_ADDRESS
+    SET expiry_notified = 1
+    WHERE valid_until <= datetime('now');
+    ''')
+
+def convert_timestamps_to_epoch(conn: sqlite3.Connection) -> None:
+    # valid_until and requested_at were stored as text in several formats. The
+    # tables are rebuilt with INTEGER columns holding UTC epoch seconds, so
+    # expiry checks are integer comparisons using the indexes.
+    conn.execute('''
+    CREATE TABLE R_CHAT_ADDRESS_NEW (
+        address TEXT PRIMARY KEY,
+        chat_id TEXT NOT NULL,
+        password TEXT,
+        active INTEGER DEFAULT 1,
+        valid_until INTEGER,
+        digest_mode TEXT DEFAULT 'auto',
+        expiry_notified INTEGER DEFAULT 0,
+        iby TEXT DEFAULT 'system',
+        uby TEXT DEFAULT 'system',
+        idate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        udate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (chat_id) REFERENCES D_RECIPIENT_CHAT(chat_id)
+    );
+    ''')
+    conn.execute('''
+    INSERT INTO R_CHAT_ADDRESS_NEW (address, chat_id, password, active, valid_until, digest_mode,
+                                    expiry_notified, iby, uby, idate, udate)
+    SELECT address, chat_id, password, active, CAST(strftime('%s', valid_until) AS INTEGER), digest_mode,
+           expiry_notified, iby, uby, idate, udate
+    FROM R_CHAT_ADDRESS;
+    ''')
+    conn.execute('DROP TABLE R_CHAT_ADDRESS;')
+    conn.execute('ALTER TABLE R_CHAT_ADDRESS_NEW RENAME TO R_CHAT_ADDRESS;')
+    add_chat_address_indexes(conn)
+
+    conn.execute('''
+    CREATE TABLE F_SONG_REQUEST_NEW (
+        request_id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        song_name TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        notes TEXT,
+        requested_at INTEGER NOT NULL,
+        iby TEXT DEFAULT 'system',
+        idate TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+    conn.execute('''
+    INSERT INTO F_SONG_REQUEST_NEW (request_id, user_id, address, chat_id, song_name, artist_name,
+                                    notes, requested_at, iby, idate)
+    SELECT request_id, user_id, address, chat_id, song_name, artist_name,
+           notes, CAST(strftime('%s', requested_at) AS INTEGER), iby, idate
+    FROM F_SONG_REQUEST;
+    ''')
+    conn.execute('DROP TABLE F_SONG_REQUEST;')
+    conn.execute('ALTER TABLE F_SONG_REQUEST_NEW RENAME TO F_SONG_REQUEST;')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_SONG_REQUEST_ADDRESS
+    ON F_SONG_REQUEST (address, requested_at);
+    ''')
+
+def create_hourly_request_table(conn: sqlite3.Connection) -> None:
+    # Requests per code and hour, kept up to date when requests are inserted so
+    # statistics never scan F_SONG_REQUEST. Existing requests are counted once.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS A_REQUEST_HOURLY (
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        hour INTEGER NOT NULL,
+        request_count INTEGER NOT NULL,
+        PRIMARY KEY (address, chat_id, hour)
+    );
+    ''')
+    conn.execute('''
+    INSERT INTO A_REQUEST_HOURLY (address, chat_id, hour, request_count)
+    SELECT address, chat_id, requested_at - requested_at % 3600, COUNT(*)
+    FROM F_SONG_REQUEST
+    GROUP BY address, chat_id, requested_at - requested_at % 3600;
+    ''')
+
+def create_song_count_table(conn: sqlite3.Connection) -> None:
+    # Requests per song of a code, kept up to date when requests are inserted
+    # so the most requested songs are read from an index instead of grouping
+    # F_SONG_REQUEST. Songs are matched by their normalized names.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS A_SONG_COUNT (
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        song_key TEXT NOT NULL,
+        artist_key TEXT NOT NULL,
+        song_name TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        request_count INTEGER NOT NULL,
+        last_requested INTEGER NOT NULL,
+        PRIMARY KEY (address, chat_id, song_key, artist_key)
+    );
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_SONG_COUNT_TOP
+    ON A_SONG_COUNT (address, chat_id, request_count DESC, last_requested DESC);
+    ''')
+
+    # Existing requests are normalized in Python, which SQLite cannot do
+    counts = Counter()
+    songs = {}
+    cursor = conn.execute('''
+    SELECT address, chat_id, song_name, artist_name, requested_at
+    FROM F_SONG_REQUEST
+    ORDER BY requested_at;
+    ''')
+    for address, chat_id, song_name, artist_name, requested_at in cursor:
+        key = (address, chat_id, *normalize_song(song_name, artist_name))
+        counts[key] += 1
+        first_names = songs[key][:2] if key in songs else (song_name, artist_name)
+        songs[key] = (*first_names, requested_at)
+    conn.executemany('''
+    INSERT INTO A_SONG_COUNT (address, chat_id, song_key, artist_key, song_name, artist_name, request_count, last_requested)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+    ''', [(*key, *songs[key][:2], count, songs[key][2]) for key, count in counts.items()])
+
+def create_blocked_user_table(conn: sqlite3.Connection) -> None:
+    # Senders a recipient chat has blocked, mirrored in memory by utils.block_list
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS R_BLOCKED_USER (
+        chat_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        idate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (chat_id, user_id)
+    );
+    ''')
+    # /esta lists the latest requesters of a chat
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS IX_SONG_REQUEST_CHAT
+    ON F_SONG_REQUEST (chat_id, requested_at);
+    ''')
+
+# Ordered migration steps, new steps are appended with the next version number.
+# Applied steps must never be modified as existing databases have already run them.
+MIGRATIONS = [
+    (1, 'Create base tables', create_tables),
+    (2, 'Index R_CHAT_ADDRESS chat_id and valid_until', add_chat_address_indexes),
+    (3, 'Primary key on R_FORWARD_ADDRESS user_id', add_forward_address_primary_key),
+    (4, 'Create F_SONG_REQUEST', create_song_request_table),
+    (5, 'Add digest_mode to R_CHAT_ADDRESS', add_digest_mode),
+    (6, 'Create P_CONVERSATION and P_USER_DATA', create_persistence_tables),
+    (7, 'Add expiry_notified to R_CHAT_ADDRESS', add_expiry_notified),
+    (8, 'Store valid_until and requested_at as UTC epoch seconds', convert_timestamps_to_epoch),
+    (9, 'Create A_REQUEST_HOURLY', create_hourly_request_table),
+    (10, 'Create A_SONG_COUNT', create_song_count_table),
+    (11, 'Create R_BLOCKED_USER and index F_SONG_REQUEST chat_id', create_blocked_user_table),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS SCHEMA_VERSION (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        idate TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(version) FROM SCHEMA_VERSION')
+    version = cursor.fetchone()
+    cursor.close()
+    return version[0] or 0
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Apply the migration steps the database has not yet run, each in its own transaction"""
+    current_version = get_schema_version(conn)
+
+    for version, description, step in MIGRATIONS:
+        if version <= current_version:
+            continue
+
+        logger.info(f'Applying migration {version}: {description}')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            step(conn)
+            conn.execute('''
+                INSERT INTO SCHEMA_VERSION (version, description)
+                VALUES (?, ?)
+            ''', (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f'Migration {version} failed, database left at version {current_version}')
+            raise
+        current_version = version
+
+    logger.info(f'Database schema at version {current_version}')
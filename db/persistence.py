@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+def _stored_form(data):
+    """The data as it reads back from the database, where for example keys are strings"""
+    return None if data is None else json.loads(json.dumps(data))
+
+class DatabasePersistence(BasePersistence):
+    """
+    Stores conversation states and user_data in the bot's database.
+
+    The application hands over changed entries every update_interval seconds.
+    They are only marked dirty here and written together in one transaction
+    once the application has handed over all of them, so persisting costs one
+    commit per interval instead of a write per message.
+
+    User data is written as the keys changed since it was last stored. Worker
+    processes handling a user's private and group chats keep separate copies
+    of the user's data, and this way they do not overwrite each other's keys.
+    """
+
+    def __init__(self, database, update_interval: float = 10):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._database = database
+        self._dirty_conversations = {}
+        self._dirty_user_data = {}
+        self._stored_user_data = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    def _schedule_flush(self) -> None:
+        # The application updates all changed entries before yielding to the event loop,
+        # so a task started now writes them in one batch
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_dirty())
+
+    async def _write_dirty(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty_conversations and not self._dirty_user_data:
+                return
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            user_data, self._dirty_user_data = self._dirty_user_data, {}
+            stored = {user_id: _stored_form(data) for user_id, data in user_data.items()}
+            changes = {user_id: self._changes(user_id, data) for user_id, data in stored.items()}
+            try:
+                await self._database.save_persistence(conversations, changes)
+            except Exception as e:
+                # Newer changes made meanwhile take precedence over the failed ones
+                logger.error(f"Failed to persist bot state: {e}")
+                self._dirty_conversations = {**conversations, **self._dirty_conversations}
+                self._dirty_user_data = {**user_data, **self._dirty_user_data}
+                return
+            for user_id, data in stored.items():
+                if data is None:
+                    self._stored_user_data.pop(user_id, None)
+                else:
+                    self._stored_user_data[user_id] = data
+            logger.debug(f"Persisted {len(conversations)} conversations and {len(user_data)} users")
+
+    def _changes(self, user_id: int, data: dict):
+        """The keys set and removed since the user's data was last stored, None to remove it all"""
+        if data is None:
+            return None
+        previous = self._stored_user_data.get(user_id, {})
+        changed = {key: value for key, value in data.items() if key not in previous or previous[key] != value}
+        removed = [key for key in previous if key not in data]
+        return changed, removed
+
+    # --- Conversations ---
+    async def get_conversations(self, name: str) -> dict:
+        return await self._database.load_conversations(name)
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._dirty_conversations[(name, key)] = new_state
+        self._schedule_flush()
+
+    # --- User data ---
+    async def get_user_data(self) -> dict:
+        user_data = await self._database.load_user_data()
+        self._stored_user_data = {user_id: _stored_form(data) for user_id, data in user_data.items()}
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._dirty_user_data[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty_user_data[user_id] = None
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Write everything that is still dirty, called on shutdown"""
+        await self._write_dirty()
+
+    # --- Not stored, see store_data ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
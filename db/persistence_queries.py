@@ -0,0 +1,90 @@
+import json
+import sqlite3
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+def load_conversations(conn: sqlite3.Connection, name: str):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT conversation_key, state
+        FROM P_CONVERSATION
+        WHERE name = ?
+    ''', (name,))
+    results = cursor.fetchall()
+    cursor.close()
+    return {tuple(json.loads(key)): json.loads(state) for key, state in results}
+
+def load_user_data(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user_id, data
+        FROM P_USER_DATA
+    ''')
+    results = cursor.fetchall()
+    cursor.close()
+    return {int(user_id): json.loads(data) for user_id, data in results}
+
+def save_persistence(conn: sqlite3.Connection, conversations: dict, user_data: dict):
+    """
+    Write changed conversation states and user data in one transaction.
+    conversations maps (name, key) to the new state, None removes the stored
+    row. user_data maps user ids to the keys set and removed from their data,
+    as a dict and a list, which are merged into the stored data. None removes
+    the whole row.
+    """
+    cursor = conn.cursor()
+    # Other processes may change the same user data between reading and writing it otherwise
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        for (name, key), state in conversations.items():
+            if state is None:
+                cursor.execute('''
+                    DELETE FROM P_CONVERSATION
+                    WHERE name = ? AND conversation_key = ?
+                ''', (name, json.dumps(key)))
+            else:
+                cursor.execute('''
+                    INSERT INTO P_CONVERSATION (name, conversation_key, state)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (name, conversation_key) DO UPDATE
+                    SET state = excluded.state,
+                        udate = CURRENT_TIMESTAMP
+                ''', (name, json.dumps(key), json.dumps(state)))
+
+        for user_id, changes in user_data.items():
+            if changes is not None:
+                changed, removed = changes
+                if not changed and not removed:
+                    continue
+                cursor.execute('''
+                    SELECT data
+                    FROM P_USER_DATA
+                    WHERE user_id = ?
+                ''', (str(user_id),))
+                row = cursor.fetchone()
+                data = json.loads(row[0]) if row else {}
+                for key in removed:
+                    data.pop(key, None)
+                data.update(changed)
+            # Empty user data is not worth a row
+            if changes is None or not data:
+                cursor.execute('''
+                    DELETE FROM P_USER_DATA
+                    WHERE user_id = ?
+                ''', (str(user_id),))
+            else:
+                cursor.execute('''
+                    INSERT INTO P_USER_DATA (user_id, data)
+                    VALUES (?, ?)
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET data = excluded.data,
+                        udate = CURRENT_TIMESTAMP
+                ''', (str(user_id), json.dumps(data)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
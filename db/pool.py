@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db.schema import connect
+from utils.logger import get_logger
+from utils.metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS
+
+logger = get_logger(__name__)
+
+class ConnectionPool:
+    """
+    One writer connection and N read-only connections to the same WAL database.
+
+    The writer has a dedicated thread, so writes are serialized and never wait
+    on each other inside SQLite. Each reader thread opens its own read-only
+    connection on first use, so lookups run in parallel with the writer.
+    """
+
+    def __init__(self, path: str, readers: int = 4, **pragmas):
+        self.path = path
+        self._pragmas = pragmas
+        self.writer = connect(path, **pragmas)
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._reader_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader',
+                                                   initializer=self._open_reader)
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _open_reader(self) -> None:
+        conn = connect(self.path, read_only=True, **self._pragmas)
+        self._local.conn = conn
+        with self._readers_lock:
+            self._readers.append(conn)
+
+    @staticmethod
+    def _run_timed(connection: str, conn: sqlite3.Connection, submitted: float, query, *args, **kwargs):
+        started = time.perf_counter()
+        DB_WAIT_SECONDS.observe(started - submitted, connection=connection)
+        try:
+            return query(conn, *args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, query=query.__name__, connection=connection)
+
+    def _run_reader(self, submitted: float, query, *args, **kwargs):
+        return self._run_timed('reader', self._local.conn, submitted, query, *args, **kwargs)
+
+    def _run_writer(self, submitted: float, query, *args, **kwargs):
+        return self._run_timed('writer', self.writer, submitted, query, *args, **kwargs)
+
+    async def read(self, query, *args, **kwargs):
+        """Run a read-only query function on one of the reader connections"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._reader_executor, functools.partial(self._run_reader, time.perf_counter(), query, *args, **kwargs)
+        )
+
+    async def write(self, query, *args, **kwargs):
+        """Run a query function that modifies the database on the writer connection"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._writer_executor, functools.partial(self._run_writer, time.perf_counter(), query, *args, **kwargs)
+        )
+
+    def close(self) -> None:
+        """Wait for pending queries and close all connections"""
+        logger.info('Closing database connection pool')
+        self._reader_executor.shutdown(wait=True)
+        self._writer_executor.shutdown(wait=True)
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        self.writer.close()
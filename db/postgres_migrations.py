@@ -0,0 +1,158 @@
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Held while migrating, so processes starting together do not run the same steps
+MIGRATION_LOCK_ID = 8113200
+
+async def create_schema(conn) -> None:
+    # The schema the SQLite migrations have arrived at. Like the SQLite
+    # database, which does not enforce foreign keys, the relations between the
+    # tables are kept by the queries instead of constraints.
+    await conn.execute('''
+    CREATE TABLE D_USER (
+        user_id TEXT PRIMARY KEY,
+        nickname TEXT,
+        role TEXT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        uby TEXT DEFAULT 'system',
+        idate TIMESTAMPTZ DEFAULT now(),
+        udate TIMESTAMPTZ DEFAULT now()
+    );
+
+    CREATE TABLE D_RECIPIENT_CHAT (
+        chat_id TEXT PRIMARY KEY,
+        chat_type TEXT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        uby TEXT DEFAULT 'system',
+        idate TIMESTAMPTZ DEFAULT now(),
+        udate TIMESTAMPTZ DEFAULT now()
+    );
+
+    CREATE TABLE R_CHAT_ADDRESS (
+        address TEXT PRIMARY KEY,
+        chat_id TEXT NOT NULL,
+        password TEXT,
+        active INTEGER DEFAULT 1,
+        valid_until BIGINT,
+        digest_mode TEXT DEFAULT 'auto',
+        expiry_notified INTEGER DEFAULT 0,
+        iby TEXT DEFAULT 'system',
+        uby TEXT DEFAULT 'system',
+        idate TIMESTAMPTZ DEFAULT now(),
+        udate TIMESTAMPTZ DEFAULT now()
+    );
+    CREATE INDEX IX_CHAT_ADDRESS_CHAT_ID ON R_CHAT_ADDRESS (chat_id);
+    CREATE INDEX IX_CHAT_ADDRESS_VALID_UNTIL ON R_CHAT_ADDRESS (valid_until);
+
+    CREATE TABLE R_FORWARD_ADDRESS (
+        user_id TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        uby TEXT DEFAULT 'system',
+        idate TIMESTAMPTZ DEFAULT now(),
+        udate TIMESTAMPTZ DEFAULT now()
+    );
+    CREATE INDEX IX_FORWARD_ADDRESS_ADDRESS ON R_FORWARD_ADDRESS (address);
+
+    CREATE TABLE F_SONG_REQUEST (
+        request_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        song_name TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        notes TEXT,
+        requested_at BIGINT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        idate TIMESTAMPTZ DEFAULT now()
+    );
+    CREATE INDEX IX_SONG_REQUEST_ADDRESS ON F_SONG_REQUEST (address, requested_at);
+    CREATE INDEX IX_SONG_REQUEST_CHAT ON F_SONG_REQUEST (chat_id, requested_at);
+
+    CREATE TABLE A_REQUEST_HOURLY (
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        hour BIGINT NOT NULL,
+        request_count INTEGER NOT NULL,
+        PRIMARY KEY (address, chat_id, hour)
+    );
+
+    CREATE TABLE A_SONG_COUNT (
+        address TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        song_key TEXT NOT NULL,
+        artist_key TEXT NOT NULL,
+        song_name TEXT NOT NULL,
+        artist_name TEXT NOT NULL,
+        request_count INTEGER NOT NULL,
+        last_requested BIGINT NOT NULL,
+        PRIMARY KEY (address, chat_id, song_key, artist_key)
+    );
+    CREATE INDEX IX_SONG_COUNT_TOP ON A_SONG_COUNT (address, chat_id, request_count DESC, last_requested DESC);
+
+    CREATE TABLE R_BLOCKED_USER (
+        chat_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        iby TEXT DEFAULT 'system',
+        idate TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (chat_id, user_id)
+    );
+
+    CREATE TABLE P_CONVERSATION (
+        name TEXT NOT NULL,
+        conversation_key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        udate TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (name, conversation_key)
+    );
+
+    CREATE TABLE P_USER_DATA (
+        user_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        udate TIMESTAMPTZ DEFAULT now()
+    );
+    ''')
+
+# Ordered migration steps of PostgreSQL databases, numbered separately from
+# the SQLite ones in db.migrations. New steps are appended with the next
+# version number and applied steps must never be modified.
+MIGRATIONS = [
+    (1, 'Create the schema', create_schema),
+]
+
+async def get_schema_version(conn) -> int:
+    await conn.execute('''
+    CREATE TABLE IF NOT EXISTS SCHEMA_VERSION (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        idate TIMESTAMPTZ DEFAULT now()
+    );
+    ''')
+    return await conn.fetchval('SELECT MAX(version) FROM SCHEMA_VERSION') or 0
+
+async def migrate(conn) -> None:
+    """Apply the migration steps the database has not yet run, each in its own transaction"""
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+    try:
+        current_version = await get_schema_version(conn)
+        for version, description, step in MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            logger.info(f'Applying PostgreSQL migration {version}: {description}')
+            try:
+                async with conn.transaction():
+                    await step(conn)
+                    await conn.execute('''
+                        INSERT INTO SCHEMA_VERSION (version, description)
+                        VALUES ($1, $2)
+                    ''', version, description)
+            except Exception:
+                logger.error(f'Migration {version} failed, database left at version {current_version}')
+                raise
+            current_version = version
+
+        logger.info(f'Database schema at version {current_version}')
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
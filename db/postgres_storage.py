@@ -0,0 +1,648 @@
+import functools
+import json
+import time
+
+from db import postgres_migrations
+from db.instrumented import record_statement
+from db.recipient_queries import format_recipient_addresses
+from db.request_queries import count_song_requests
+from db.routing import Route, routing_table
+from db.storage import Storage
+from errors.query_errors import AddressExpiredError, AddressNotActiveError, AddressNotFoundError, UserNotFoundError
+from utils.logger import get_logger
+from utils.metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS
+from utils.timestamps import DAY_SECONDS, HOUR_SECONDS, days_from_now, format_timestamp, hour_start, now
+
+logger = get_logger(__name__)
+
+def _affected(status: str) -> int:
+    """Rows affected by a statement, from a command status such as 'INSERT 0 1'"""
+    return int(status.rsplit(' ', 1)[-1])
+
+def _query(function):
+    """
+    Run the method on a connection of the pool, passed as its first argument.
+    The time spent waiting for a connection and running the query is recorded
+    like ConnectionPool does for SQLite.
+    """
+    @functools.wraps(function)
+    async def wrapper(self, *args, **kwargs):
+        pool = await self._open()
+        submitted = time.perf_counter()
+        async with pool.acquire() as conn:
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - submitted, connection='postgres')
+            try:
+                return await function(self, conn, *args, **kwargs)
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - started, query=function.__name__, connection='postgres')
+    return wrapper
+
+class PostgresStorage(Storage):
+    """
+    The PostgreSQL storage backend, for deployments that outgrow one SQLite file.
+
+    Queries run on an asyncpg connection pool of min_size to max_size
+    connections, opened on first use so it belongs to the event loop of the
+    bot. Every statement is timed like on the SQLite connections, and
+    statements slower than slow_query_ms are logged to the db.slow_query
+    logger. The queries return the same values as the query functions of the
+    db package, see Storage.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10, slow_query_ms: float = None):
+        self._dsn = dsn
+        self._min_size = min_size
+        self._max_size = max_size
+        self._slow_query_seconds = slow_query_ms / 1000 if slow_query_ms is not None else None
+        self._pool = None
+
+    async def _open(self):
+        if self._pool is None:
+            # Only needed with this backend
+            import asyncpg
+            self._pool = await asyncpg.create_pool(self._dsn, min_size=self._min_size, max_size=self._max_size,
+                                                   init=self._init_connection)
+            logger.info(f"Connected to PostgreSQL with a pool of {self._min_size} to {self._max_size} connections")
+        return self._pool
+
+    async def _init_connection(self, conn) -> None:
+        conn.add_query_logger(self._record)
+
+    def _record(self, query) -> None:
+        record_statement(query.query, query.args, query.elapsed, self._slow_query_seconds)
+
+    async def migrate(self) -> None:
+        # A connection of its own, as migrating may run on another event loop than the bot
+        import asyncpg
+        conn = await asyncpg.connect(self._dsn)
+        try:
+            await postgres_migrations.migrate(conn)
+        finally:
+            await conn.close()
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            logger.info('Closing PostgreSQL connection pool')
+            await self._pool.close()
+            self._pool = None
+
+    # --- User queries ---
+    @_query
+    async def get_forward_address(self, conn, user_id: str):
+        return await self._get_forward_address(conn, user_id)
+
+    async def _get_forward_address(self, conn, user_id: str):
+        row = await conn.fetchrow('''
+            SELECT address
+            FROM R_FORWARD_ADDRESS
+            WHERE user_id = $1
+        ''', str(user_id))
+        return tuple(row) if row is not None else None
+
+    @_query
+    async def get_address_chat_id(self, conn, address: str):
+        row = await conn.fetchrow('''
+            SELECT chat_id
+            FROM R_CHAT_ADDRESS
+            WHERE address = $1
+        ''', address)
+        return tuple(row) if row is not None else None
+
+    @_query
+    async def is_recipient_active(self, conn, user_id: str):
+        active = await conn.fetchrow('''
+            SELECT c.active
+            FROM R_FORWARD_ADDRESS f
+            JOIN R_CHAT_ADDRESS c ON c.address = f.address
+            WHERE f.user_id = $1
+        ''', str(user_id))
+        return active is not None and active[0] == 1
+
+    @_query
+    async def is_recipient_valid(self, conn, user_id: str):
+        address = await self._get_forward_address(conn, user_id)
+        if address is None:
+            return False
+        valid_until = await conn.fetchval('''
+            SELECT valid_until
+            FROM R_CHAT_ADDRESS
+            WHERE address = $1
+        ''', address[0])
+        if valid_until is None:
+            return True
+        return valid_until > now()
+
+    @_query
+    async def resolve_route(self, conn, user_id: str) -> Route:
+        return await self._resolve_route(conn, user_id)
+
+    async def _resolve_route(self, conn, user_id: str) -> Route:
+        route = routing_table.get(user_id)
+        if route is not None:
+            return route
+
+        generation = routing_table.generation
+        result = await conn.fetchrow('''
+            SELECT f.address, c.chat_id, c.active, c.valid_until, c.digest_mode
+            FROM R_FORWARD_ADDRESS f
+            LEFT JOIN R_CHAT_ADDRESS c ON c.address = f.address
+            WHERE f.user_id = $1
+        ''', str(user_id))
+
+        route = Route(*result) if result is not None else Route(None, None, None, None, None)
+        routing_table.put(user_id, route, generation)
+        return route
+
+    @_query
+    async def get_recipient(self, conn, user_id: str) -> Route:
+        route = await self._resolve_route(conn, user_id)
+        if route.address is None:
+            raise AddressNotFoundError("Forward address not found for user")
+
+        if route.active != 1:
+            raise AddressNotActiveError("Forward address is not active")
+
+        if route.valid_until is not None and route.valid_until <= now():
+            raise AddressExpiredError("Forward address has expired")
+
+        return route
+
+    @_query
+    async def add_user(self, conn, user_id: str, nickname: str, role: str):
+        status = await conn.execute('''
+            INSERT INTO D_USER (user_id, nickname, role)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO NOTHING
+        ''', str(user_id), nickname, role)
+        if not _affected(status):
+            logger.error("User exists in chat")
+            return
+        logger.info(f"New user {user_id} with nickname {nickname}")
+
+    @_query
+    async def get_nickname(self, conn, user_id: str):
+        return await conn.fetchval('''
+            SELECT nickname
+            FROM D_USER
+            WHERE user_id = $1
+        ''', str(user_id))
+
+    @_query
+    async def update_nickname(self, conn, user_id: str, nickname: str):
+        await conn.execute('''
+            UPDATE D_USER
+            SET nickname = $1
+            WHERE user_id = $2
+        ''', nickname, str(user_id))
+
+    @_query
+    async def address_exists(self, conn, address: str):
+        return await self._address_exists(conn, address)
+
+    async def _address_exists(self, conn, address: str) -> bool:
+        return await conn.fetchval('SELECT EXISTS (SELECT 1 FROM R_CHAT_ADDRESS WHERE address = $1)', address)
+
+    @_query
+    async def user_exists(self, conn, user_id: str):
+        return await self._user_exists(conn, user_id)
+
+    async def _user_exists(self, conn, user_id: str) -> bool:
+        return await conn.fetchval('SELECT EXISTS (SELECT 1 FROM D_USER WHERE user_id = $1)', str(user_id))
+
+    @_query
+    async def set_user_forward_address(self, conn, user_id: str, address: str):
+        if not await self._user_exists(conn, user_id):
+            raise UserNotFoundError("User not found")
+
+        if not await self._address_exists(conn, address):
+            raise AddressNotFoundError("Address not found")
+
+        await conn.execute('''
+            INSERT INTO R_FORWARD_ADDRESS (user_id, address)
+            VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE
+            SET address = excluded.address,
+                uby = 'system',
+                udate = now()
+        ''', str(user_id), address)
+        routing_table.invalidate_user(user_id)
+        return True
+
+    @_query
+    async def check_password_match(self, conn, address: str, password: str):
+        row = await conn.fetchrow('''
+            SELECT password
+            FROM R_CHAT_ADDRESS
+            WHERE address = $1
+        ''', address)
+        if row is None:
+            return False
+        return row[0] == password
+
+    @_query
+    async def is_password_set(self, conn, address: str):
+        password = await conn.fetchval('''
+            SELECT password
+            FROM R_CHAT_ADDRESS
+            WHERE address = $1
+        ''', address)
+        return password is not None and password != ""
+
+    @_query
+    async def get_current_address(self, conn, user_id: str):
+        address = await self._get_forward_address(conn, user_id)
+        if address is None:
+            return None
+        return address[0]
+
+    # --- Recipient queries ---
+    @_query
+    async def add_new_recipient(self, conn, chat_id: str, chat_type: str):
+        status = await conn.execute('''
+            INSERT INTO D_RECIPIENT_CHAT (chat_id, chat_type)
+            VALUES ($1, $2)
+            ON CONFLICT (chat_id) DO NOTHING
+        ''', str(chat_id), chat_type)
+        if not _affected(status):
+            logger.error("Recipient already exists")
+            return False
+        logger.info(f"New recipient created {chat_id}")
+        return True
+
+    @_query
+    async def get_recipient_chat_id(self, conn, chat_id: str):
+        return await conn.fetchval('SELECT EXISTS (SELECT 1 FROM D_RECIPIENT_CHAT WHERE chat_id = $1)', str(chat_id))
+
+    @_query
+    async def get_address_attributes(self, conn, address: str):
+        row = await conn.fetchrow('''
+            SELECT address, chat_id, password, active, valid_until, digest_mode
+            FROM R_CHAT_ADDRESS
+            WHERE address = $1
+        ''', address)
+        return dict(row) if row is not None else None
+
+    @_query
+    async def get_amount_of_recipient_addresses(self, conn, chat_id: str):
+        return await conn.fetchval('''
+            SELECT COUNT(*)
+            FROM R_CHAT_ADDRESS
+            WHERE chat_id = $1
+        ''', str(chat_id))
+
+    @_query
+    async def create_new_address(self, conn, address: str, chat_id: str, password: str = None, valid_until: int = None):
+        await conn.execute('''
+            INSERT INTO R_CHAT_ADDRESS (address, chat_id, password, valid_until)
+            VALUES ($1, $2, $3, $4)
+        ''', address, str(chat_id), password, valid_until)
+        # Users may still point at a released code of the same name
+        routing_table.invalidate_address(address)
+
+    @_query
+    async def expire_address(self, conn, address: str):
+        await conn.execute('''
+            UPDATE R_CHAT_ADDRESS
+            SET valid_until = $1,
+                uby = 'system',
+                udate = now()
+            WHERE address = $2
+        ''', now(), address)
+        routing_table.invalidate_address(address)
+
+        logger.info(f"Address {address} expired")
+
+    @_query
+    async def get_recipient_addresses(self, conn, chat_id: str):
+        addresses = await conn.fetch('''
+            SELECT address, active, valid_until
+            FROM R_CHAT_ADDRESS
+            WHERE chat_id = $1
+            AND (valid_until >= $2 OR valid_until IS NULL)
+        ''', str(chat_id), days_from_now(-30))
+        return format_recipient_addresses([tuple(row) for row in addresses])
+
+    @_query
+    async def list_recipient_addresses(self, conn, chat_id: str):
+        addresses = await conn.fetch('''
+            SELECT address
+            FROM R_CHAT_ADDRESS
+            WHERE chat_id = $1
+        ''', str(chat_id))
+        return [row[0] for row in addresses] or None
+
+    @_query
+    async def list_valid_recipient_addresses(self, conn, chat_id: str):
+        addresses = await conn.fetch('''
+            SELECT address
+            FROM R_CHAT_ADDRESS
+            WHERE chat_id = $1
+            AND (valid_until > $2 OR valid_until IS NULL)
+        ''', str(chat_id), now())
+        return [row[0] for row in addresses] or None
+
+    @_query
+    async def toggle_active(self, conn, address: str):
+        async with conn.transaction():
+            result = await conn.fetchrow('''
+                SELECT active, valid_until
+                FROM R_CHAT_ADDRESS
+                WHERE address = $1
+                FOR UPDATE
+            ''', address)
+
+            if not result:
+                raise AddressNotFoundError("Address not found")
+
+            active, valid_until = result
+            if valid_until is not None and valid_until <= now():
+                raise AddressExpiredError("Address has expired")
+
+            await conn.execute('''
+                UPDATE R_CHAT_ADDRESS
+                SET active = $1,
+                    uby = 'system',
+                    udate = now()
+                WHERE address = $2
+            ''', 1 if active == 0 else 0, address)
+        routing_table.invalidate_address(address)
+
+        logger.info(f"Address {address} active status toggled to {1 if active == 0 else 0}")
+        return True
+
+    @_query
+    async def release_address_from_database(self, conn, address: str):
+        async with conn.transaction():
+            await conn.execute('DELETE FROM R_CHAT_ADDRESS WHERE address = $1', address)
+            # Users must not follow a code of the same name created later by someone else
+            await conn.execute('DELETE FROM R_FORWARD_ADDRESS WHERE address = $1', address)
+        routing_table.invalidate_address(address)
+
+        logger.info(f"Address {address} released")
+
+    @_query
+    async def get_expired_addresses(self, conn, chat_id: str):
+        addresses = await conn.fetch('''
+            SELECT address
+            FROM R_CHAT_ADDRESS
+            WHERE chat_id = $1
+            AND valid_until < $2
+        ''', str(chat_id), now())
+        return [row[0] for row in addresses] or None
+
+    @_query
+    async def renew_address(self, conn, address: str, valid_until: int):
+        await conn.execute('''
+            UPDATE R_CHAT_ADDRESS
+            SET valid_until = $1,
+                expiry_notified = 0,
+                uby = 'renewal_process',
+                udate = now()
+            WHERE address = $2
+        ''', valid_until, address)
+        routing_table.invalidate_address(address)
+
+        logger.info(f"Address {address} renewed until {format_timestamp(valid_until)}")
+        return True
+
+    @_query
+    async def set_digest_mode(self, conn, address: str, digest_mode: str):
+        await conn.execute('''
+            UPDATE R_CHAT_ADDRESS
+            SET digest_mode = $1,
+                uby = 'system',
+                udate = now()
+            WHERE address = $2
+        ''', digest_mode, address)
+        routing_table.invalidate_address(address)
+
+        logger.info(f"Address {address} digest mode set to {digest_mode}")
+        return True
+
+    # --- Song request queries ---
+    @_query
+    async def insert_song_requests(self, conn, requests: list):
+        hourly, songs = count_song_requests(requests)
+        async with conn.transaction():
+            await conn.executemany('''
+                INSERT INTO F_SONG_REQUEST (user_id, address, chat_id, song_name, artist_name, notes, requested_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ''', [(str(user_id), address, str(chat_id), *rest) for user_id, address, chat_id, *rest in requests])
+            await conn.executemany('''
+                INSERT INTO A_REQUEST_HOURLY AS h (address, chat_id, hour, request_count)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (address, chat_id, hour)
+                DO UPDATE SET request_count = h.request_count + excluded.request_count
+            ''', [(address, str(chat_id), *rest) for address, chat_id, *rest in hourly])
+            await conn.executemany('''
+                INSERT INTO A_SONG_COUNT AS s (address, chat_id, song_key, artist_key, song_name, artist_name,
+                                               request_count, last_requested)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                ON CONFLICT (address, chat_id, song_key, artist_key)
+                DO UPDATE SET request_count = s.request_count + excluded.request_count,
+                              last_requested = GREATEST(s.last_requested, excluded.last_requested)
+            ''', [(address, str(chat_id), *rest) for address, chat_id, *rest in songs])
+        return len(requests)
+
+    @_query
+    async def get_request_stats(self, conn, address: str, chat_id: str, hours: int = 12):
+        current_hour = hour_start(now())
+        since_hours = current_hour - (hours - 1) * HOUR_SECONDS
+        total, last_day = await conn.fetchrow('''
+            SELECT COALESCE(SUM(request_count), 0),
+                   COALESCE(SUM(CASE WHEN hour >= $1 THEN request_count END), 0)
+            FROM A_REQUEST_HOURLY
+            WHERE address = $2 AND chat_id = $3
+        ''', current_hour - 23 * HOUR_SECONDS, address, str(chat_id))
+        busiest_hour = await conn.fetchrow('''
+            SELECT hour, request_count
+            FROM A_REQUEST_HOURLY
+            WHERE address = $1 AND chat_id = $2
+            ORDER BY request_count DESC, hour DESC
+            LIMIT 1
+        ''', address, str(chat_id))
+        counts = await self._get_hourly_request_counts(conn, address, chat_id, since_hours, current_hour)
+
+        return {
+            'total': total,
+            'last_day': last_day,
+            'busiest_hour': tuple(busiest_hour) if busiest_hour is not None else None,
+            'hourly': [(hour, counts.get(hour, 0)) for hour in range(since_hours, current_hour + 1, HOUR_SECONDS)]
+        }
+
+    @_query
+    async def get_hourly_request_counts(self, conn, address: str, chat_id: str, first_hour: int, last_hour: int):
+        return await self._get_hourly_request_counts(conn, address, chat_id, first_hour, last_hour)
+
+    async def _get_hourly_request_counts(self, conn, address: str, chat_id: str, first_hour: int, last_hour: int) -> dict:
+        rows = await conn.fetch('''
+            SELECT hour, request_count
+            FROM A_REQUEST_HOURLY
+            WHERE address = $1 AND chat_id = $2 AND hour BETWEEN $3 AND $4
+        ''', address, str(chat_id), first_hour, last_hour)
+        return {hour: count for hour, count in rows}
+
+    @_query
+    async def get_top_songs(self, conn, address: str, chat_id: str, limit: int = 10):
+        songs = await conn.fetch('''
+            SELECT song_name, artist_name, request_count
+            FROM A_SONG_COUNT
+            WHERE address = $1 AND chat_id = $2
+            ORDER BY request_count DESC, last_requested DESC
+            LIMIT $3
+        ''', address, str(chat_id), limit)
+        return [tuple(row) for row in songs]
+
+    # --- Blocked sender queries ---
+    @_query
+    async def block_user(self, conn, chat_id: str, user_id: str):
+        status = await conn.execute('''
+            INSERT INTO R_BLOCKED_USER (chat_id, user_id)
+            VALUES ($1, $2)
+            ON CONFLICT (chat_id, user_id) DO NOTHING
+        ''', str(chat_id), str(user_id))
+        blocked = _affected(status) > 0
+        if blocked:
+            logger.info(f"User {user_id} blocked in chat {chat_id}")
+        return blocked
+
+    @_query
+    async def unblock_user(self, conn, chat_id: str, user_id: str):
+        status = await conn.execute('''
+            DELETE FROM R_BLOCKED_USER
+            WHERE chat_id = $1 AND user_id = $2
+        ''', str(chat_id), str(user_id))
+        unblocked = _affected(status) > 0
+        if unblocked:
+            logger.info(f"User {user_id} unblocked in chat {chat_id}")
+        return unblocked
+
+    @_query
+    async def get_blocked_users(self, conn, chat_id: str):
+        users = await conn.fetch('''
+            SELECT b.user_id, u.nickname
+            FROM R_BLOCKED_USER b
+            LEFT JOIN D_USER u ON u.user_id = b.user_id
+            WHERE b.chat_id = $1
+            ORDER BY b.idate DESC
+        ''', str(chat_id))
+        return [tuple(row) for row in users]
+
+    @_query
+    async def get_all_blocked_users(self, conn):
+        return [tuple(row) for row in await conn.fetch('SELECT chat_id, user_id FROM R_BLOCKED_USER')]
+
+    @_query
+    async def get_recent_requesters(self, conn, chat_id: str, days: int = 1, limit: int = 20):
+        # The latest request of every user, then the users who requested latest
+        requesters = await conn.fetch('''
+            SELECT user_id, nickname, song_name
+            FROM (
+                SELECT DISTINCT ON (r.user_id) r.user_id, u.nickname, r.song_name, r.requested_at
+                FROM F_SONG_REQUEST r
+                LEFT JOIN D_USER u ON u.user_id = r.user_id
+                WHERE r.chat_id = $1 AND r.requested_at >= $2
+                ORDER BY r.user_id, r.requested_at DESC
+            ) latest
+            ORDER BY requested_at DESC
+            LIMIT $3
+        ''', str(chat_id), now() - days * DAY_SECONDS, limit)
+        return [tuple(row) for row in requesters]
+
+    # --- Bot persistence queries ---
+    @_query
+    async def load_conversations(self, conn, name: str):
+        results = await conn.fetch('''
+            SELECT conversation_key, state
+            FROM P_CONVERSATION
+            WHERE name = $1
+        ''', name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in results}
+
+    @_query
+    async def load_user_data(self, conn):
+        results = await conn.fetch('SELECT user_id, data FROM P_USER_DATA')
+        return {int(user_id): json.loads(data) for user_id, data in results}
+
+    @_query
+    async def save_persistence(self, conn, conversations: dict, user_data: dict):
+        """See db.persistence_queries.save_persistence"""
+        async with conn.transaction():
+            # Other processes may change the same user data between reading and writing it otherwise
+            await conn.execute('LOCK TABLE P_USER_DATA IN SHARE ROW EXCLUSIVE MODE')
+            for (name, key), state in conversations.items():
+                if state is None:
+                    await conn.execute('''
+                        DELETE FROM P_CONVERSATION
+                        WHERE name = $1 AND conversation_key = $2
+                    ''', name, json.dumps(key))
+                else:
+                    await conn.execute('''
+                        INSERT INTO P_CONVERSATION (name, conversation_key, state)
+                        VALUES ($1, $2, $3)
+                        ON CONFLICT (name, conversation_key) DO UPDATE
+                        SET state = excluded.state,
+                            udate = now()
+                    ''', name, json.dumps(key), json.dumps(state))
+
+            for user_id, changes in user_data.items():
+                if changes is not None:
+                    changed, removed = changes
+                    if not changed and not removed:
+                        continue
+                    stored = await conn.fetchval('SELECT data FROM P_USER_DATA WHERE user_id = $1', str(user_id))
+                    data = json.loads(stored) if stored is not None else {}
+                    for key in removed:
+                        data.pop(key, None)
+                    data.update(changed)
+                # Empty user data is not worth a row
+                if changes is None or not data:
+                    await conn.execute('DELETE FROM P_USER_DATA WHERE user_id = $1', str(user_id))
+                else:
+                    await conn.execute('''
+                        INSERT INTO P_USER_DATA (user_id, data)
+                        VALUES ($1, $2)
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET data = excluded.data,
+                            udate = now()
+                    ''', str(user_id), json.dumps(data))
+
+    # --- Maintenance queries ---
+    @_query
+    async def release_expired_addresses(self, conn):
+        async with conn.transaction():
+            results = await conn.fetch('''
+                DELETE FROM R_CHAT_ADDRESS
+                WHERE valid_until <= $1
+                RETURNING address, chat_id
+            ''', days_from_now(-10))
+            await conn.execute('''
+                DELETE FROM R_FORWARD_ADDRESS
+                WHERE address = ANY($1::TEXT[])
+            ''', [address for address, _ in results])
+
+        for address, _ in results:
+            routing_table.invalidate_address(address)
+        return {address: chat_id for address, chat_id in results}
+
+    @_query
+    async def get_expiry_deadlines(self, conn):
+        deadlines = await conn.fetch('''
+            SELECT valid_until, expiry_notified
+            FROM R_CHAT_ADDRESS
+            WHERE valid_until IS NOT NULL
+        ''')
+        return [tuple(row) for row in deadlines]
+
+    @_query
+    async def claim_expired_addresses(self, conn):
+        # Rows claimed by a concurrent call are skipped, so every owner is notified once
+        results = await conn.fetch('''
+            UPDATE R_CHAT_ADDRESS
+            SET expiry_notified = 1
+            WHERE expiry_notified = 0
+            AND valid_until <= $1
+            RETURNING address, chat_id
+        ''', now())
+        return {address: chat_id for address, chat_id in results}
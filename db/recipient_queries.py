@@ -1,7 +1,8 @@
 import sqlite3
-from datetime import timezone, datetime
 
+from db.routing import routing_table
 from utils.logger import get_logger
+from utils.timestamps import now, days_from_now, format_timestamp
 from errors.query_errors import AddressNotFoundError, AddressExpiredError
 
 logger = get_logger(__name__)
@@ -43,7 +44,7 @@ def get_recipient_chat_id(conn: sqlite3.Connection, chat_id: str):
 def get_address_attributes(conn: sqlite3.Connection, address: str):
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT address, chat_id, password, active, valid_until 
+        SELECT address, chat_id, password, active, valid_until, digest_mode 
         FROM R_CHAT_ADDRESS 
         WHERE address = ?
     ''', (address,))
@@ -56,7 +57,8 @@ def get_address_attributes(conn: sqlite3.Connection, address: str):
             'chat_id': result[1],
             'password': result[2],
             'active': result[3],
-            'valid_until': result[4]
+            'valid_until': result[4],
+            'digest_mode': result[5]
         }
     return None
 
@@ -71,7 +73,7 @@ def get_amount_of_recipient_addresses(conn: sqlite3.Connection, chat_id: str):
     cursor.close()
     return amount[0]
 
-def create_new_address(conn: sqlite3.Connection, address: str, chat_id: str, password: str = None, valid_until: datetime = None):
+def create_new_address(conn: sqlite3.Connection, address: str, chat_id: str, password: str = None, valid_until: int = None):
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO R_CHAT_ADDRESS (address, chat_id, password, valid_until)
@@ -79,59 +81,42 @@ def create_new_address(conn: sqlite3.Connection, address: str, chat_id: str, pas
     ''', (address, chat_id, password, valid_until))
     conn.commit()
     cursor.close()
+    # Users may still point at a released code of the same name
+    routing_table.invalidate_address(address)
 
 def expire_address(conn: sqlite3.Connection, address: str):
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE R_CHAT_ADDRESS 
-        SET valid_until = datetime('now'),
+        SET valid_until = ?,
             uby = 'system',
             udate = datetime('now')
         WHERE address = ?
-    ''', (address,))
+    ''', (now(), address))
     conn.commit()
     cursor.close()
+    routing_table.invalidate_address(address)
 
     logger.info(f"Address {address} expired")
 
 
-def get_recipient_addresses(conn: sqlite3.Connection, chat_id: str):
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT address, active, valid_until
-        FROM R_CHAT_ADDRESS 
-        WHERE chat_id = ?
-        AND (valid_until >= datetime('now', '-30 days') OR valid_until IS NULL)
-    ''', (chat_id,))
-    addresses = cursor.fetchall()
-    cursor.close()
-
+def format_recipient_addresses(addresses: list):
+    """The (address, active, valid_until) rows of a chat as the listing shown by /omat, None without rows"""
     if not addresses:
         return None
 
-    now = datetime.now(timezone.utc)
+    current_time = now()
     active_addresses = []
     inactive_addresses = []
 
     for addr in addresses:
         address, is_active, valid_until = addr
-        infinity = False
-        try:
-            try:
-                parsed_date = datetime.strptime(valid_until, '%Y-%m-%d %H:%M:%S.%f')
-            except ValueError:
-                parsed_date = datetime.strptime(valid_until, '%Y-%m-%d %H:%M:%S')
-            valid_date = valid_until is None or parsed_date.replace(tzinfo=timezone.utc) > now
-        except TypeError: # valid_until is None --> infinite validity
-            valid_date = True
-            infinity = True
+        # valid_until is None --> infinite validity
+        valid_date = valid_until is None or valid_until > current_time
         
         if is_active and valid_date:
-            if not infinity:
-                utc_time = parsed_date.replace(tzinfo=timezone.utc) if valid_until else None
-                local_time = utc_time.astimezone() if utc_time else None
-                display_date = f" (expires at {local_time.strftime('%d.%m.%Y %H.%M')})" if local_time else ""
-                active_addresses.append(f"{address}{display_date}")
+            if valid_until is not None:
+                active_addresses.append(f"{address} (expires at {format_timestamp(valid_until)})")
             else:
                 active_addresses.append(f"{address} (always valid)")
         else:
@@ -146,6 +131,19 @@ def get_recipient_addresses(conn: sqlite3.Connection, chat_id: str):
     
     return result
 
+def get_recipient_addresses(conn: sqlite3.Connection, chat_id: str):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT address, active, valid_until
+        FROM R_CHAT_ADDRESS 
+        WHERE chat_id = ?
+        AND (valid_until >= ? OR valid_until IS NULL)
+    ''', (chat_id, days_from_now(-30)))
+    addresses = cursor.fetchall()
+    cursor.close()
+
+    return format_recipient_addresses(addresses)
+
 def list_recipient_addresses(conn: sqlite3.Connection, chat_id: str):
     # Returns a list of all addresses for the recipient in R_CHAT_ADDRESS
     cursor = conn.cursor()
@@ -169,8 +167,8 @@ def list_valid_recipient_addresses(conn: sqlite3.Connection, chat_id: str):
         SELECT address
         FROM R_CHAT_ADDRESS 
         WHERE chat_id = ?
-        AND (valid_until > datetime('now') OR valid_until IS NULL)
-    ''', (chat_id,))
+        AND (valid_until > ? OR valid_until IS NULL)
+    ''', (chat_id, now()))
     addresses = cursor.fetchall()
     cursor.close()
 
@@ -196,13 +194,8 @@ def toggle_active(conn: sqlite3.Connection, address: str):
     active, valid_until = result
     
     # Check if address has expired
-    if valid_until:
-        try:
-            parsed_date = datetime.strptime(valid_until, '%Y-%m-%d %H:%M:%S.%f')
-        except ValueError:
-            parsed_date = datetime.strptime(valid_until, '%Y-%m-%d %H:%M:%S')
-        if parsed_date.replace(tzinfo=timezone.utc) <= datetime.now(timezone.utc):
-            raise AddressExpiredError("Address has expired")
+    if valid_until is not None and valid_until <= now():
+        raise AddressExpiredError("Address has expired")
 
     # Toggle active status and update uby/udate
     cursor = conn.cursor()
@@ -215,6 +208,7 @@ def toggle_active(conn: sqlite3.Connection, address: str):
     ''', (1 if active == 0 else 0, address))
     conn.commit() 
     cursor.close()
+    routing_table.invalidate_address(address)
     
     logger.info(f"Address {address} active status toggled to {1 if active == 0 else 0}")
 
@@ -226,8 +220,14 @@ def release_address_from_database(conn: sqlite3.Connection, address: str):
         DELETE FROM R_CHAT_ADDRESS 
         WHERE address = ?
     ''', (address,))
+    # Users must not follow a code of the same name created later by someone else
+    cursor.execute('''
+        DELETE FROM R_FORWARD_ADDRESS
+        WHERE address = ?
+    ''', (address,))
     conn.commit()
     cursor.close()
+    routing_table.invalidate_address(address)
 
     logger.info(f"Address {address} released")
 
@@ -239,8 +239,8 @@ def get_expired_addresses(conn: sqlite3.Connection, chat_id: str):
         SELECT address
         FROM R_CHAT_ADDRESS 
         WHERE chat_id = ?
-        AND valid_until < datetime('now')
-    ''', (chat_id,))
+        AND valid_until < ?
+    ''', (chat_id, now()))
     addresses = cursor.fetchall()
     cursor.close()
 
@@ -249,17 +249,36 @@ def get_expired_addresses(conn: sqlite3.Connection, chat_id: str):
 
     return [addr[0] for addr in addresses]
 
-def renew_address(conn: sqlite3.Connection, address: str, valid_until: datetime):
+def renew_address(conn: sqlite3.Connection, address: str, valid_until: int):
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE R_CHAT_ADDRESS 
         SET valid_until = ?,
+            expiry_notified = 0,
             uby = 'renewal_process',
             udate = datetime('now')
         WHERE address = ?
     ''', (valid_until, address))
     conn.commit()
     cursor.close()
+    routing_table.invalidate_address(address)
+
+    logger.info(f"Address {address} renewed until {format_timestamp(valid_until)}")
+    return True
+
+def set_digest_mode(conn: sqlite3.Connection, address: str, digest_mode: str):
+    """Set how requests to the address are delivered: 'off', 'on' or 'auto'"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE R_CHAT_ADDRESS
+        SET digest_mode = ?,
+            uby = 'system',
+            udate = datetime('now')
+        WHERE address = ?
+    ''', (digest_mode, address))
+    conn.commit()
+    cursor.close()
+    routing_table.invalidate_address(address)
 
-    logger.info(f"Address {address} renewed until {valid_until}")
+    logger.info(f"Address {address} digest mode set to {digest_mode}")
     return True
\ No newline at end of file
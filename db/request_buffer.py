@@ -0,0 +1,109 @@
+import asyncio
+
+from utils.logger import get_logger
+from utils.metrics import SONG_REQUESTS_DROPPED
+
+logger = get_logger(__name__)
+
+# How long requests that failed to be written wait before the next attempt
+RETRY_DELAY_SECONDS = 5
+
+# Failed flushes in a row before the requests are written one at a time and the failing ones dropped
+MAX_FLUSH_ATTEMPTS = 5
+
+# Requests kept while writes fail, the oldest are dropped beyond this
+MAX_BUFFERED_ROWS = 10000
+
+class SongRequestBuffer:
+    """
+    Write-behind buffer for confirmed song requests.
+
+    Requests are collected in memory and written with one executemany in a
+    single transaction, either when flush_interval has passed since the first
+    buffered request or as soon as max_rows requests are waiting. Adding a
+    request never touches the database. Requests that fail to be written are
+    kept and written again after RETRY_DELAY_SECONDS.
+    """
+
+    def __init__(self, database, flush_interval: float = 0.25, max_rows: int = 100):
+        self._database = database
+        self._flush_interval = flush_interval
+        self._max_rows = max_rows
+        self._rows = []
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._tasks = set()
+        self._closing = False
+        self._failures = 0
+
+    @property
+    def pending(self) -> int:
+        """Amount of requests waiting to be written"""
+        return len(self._rows)
+
+    def add(self, user_id, address: str, chat_id, song_name: str, artist_name: str, notes: str, requested_at: int) -> None:
+        self._rows.append((str(user_id), address, str(chat_id), song_name, artist_name, notes, requested_at))
+
+        if len(self._rows) >= self._max_rows:
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later(self._flush_interval))
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write all buffered requests to the database"""
+        async with self._flush_lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            try:
+                await self._database.insert_song_requests(rows)
+            except Exception as e:
+                self._failures += 1
+                logger.error(f"Failed to write {len(rows)} song requests ({self._failures}/{MAX_FLUSH_ATTEMPTS}): {e}")
+                if self._failures < MAX_FLUSH_ATTEMPTS:
+                    # Keep the requests for the next flush instead of losing them
+                    self._rows = rows + self._rows
+                    if len(self._rows) > MAX_BUFFERED_ROWS:
+                        self._drop(len(self._rows) - MAX_BUFFERED_ROWS, "the buffer is full")
+                        self._rows = self._rows[-MAX_BUFFERED_ROWS:]
+                else:
+                    self._failures = 0
+                    await self._write_one_by_one(rows)
+                # Nothing else flushes them until the next request is added
+                if self._rows and not self._closing and (self._flush_task is None or self._flush_task.done()
+                                          or self._flush_task is asyncio.current_task()):
+                    self._flush_task = asyncio.get_running_loop().create_task(self._flush_later(RETRY_DELAY_SECONDS))
+                return
+            self._failures = 0
+            logger.debug(f"Wrote {len(rows)} song requests")
+
+    async def _write_one_by_one(self, rows: list) -> None:
+        failed = 0
+        error = None
+        for row in rows:
+            try:
+                await self._database.insert_song_requests([row])
+            except Exception as e:
+                failed += 1
+                error = e
+        if failed:
+            self._drop(failed, error)
+
+    @staticmethod
+    def _drop(count: int, reason) -> None:
+        SONG_REQUESTS_DROPPED.inc(count)
+        logger.error(f"Dropped {count} song requests that could not be written: {reason}")
+
+    async def close(self) -> None:
+        """Flush the remaining requests, called on shutdown"""
+        self._closing = True
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
@@ -0,0 +1,116 @@
+import sqlite3
+from collections import Counter
+
+from utils.logger import get_logger
+from utils.text import normalize_song
+from utils.timestamps import HOUR_SECONDS, hour_start, now
+
+logger = get_logger(__name__)
+
+def count_song_requests(requests: list):
+    """
+    The (address, chat_id, hour, request_count) and (address, chat_id, song_key,
+    artist_key, song_name, artist_name, request_count, last_requested) rows a
+    batch of song requests adds to the hourly and per song request counts
+    """
+    hourly = Counter((address, chat_id, hour_start(requested_at))
+                     for _, address, chat_id, _, _, _, requested_at in requests)
+    songs = {}
+    for _, address, chat_id, song_name, artist_name, _, requested_at in requests:
+        key = (address, chat_id, *normalize_song(song_name, artist_name))
+        if key in songs:
+            songs[key][2] += 1
+            songs[key][3] = max(songs[key][3], requested_at)
+        else:
+            songs[key] = [song_name, artist_name, 1, requested_at]
+    return [(*key, count) for key, count in hourly.items()], [(*key, *song) for key, song in songs.items()]
+
+def insert_song_requests(conn: sqlite3.Connection, requests: list):
+    """
+    Insert a batch of (user_id, address, chat_id, song_name, artist_name, notes, requested_at)
+    rows and add them to the hourly and per song request counts in one transaction
+    """
+    hourly, songs = count_song_requests(requests)
+    cursor = conn.cursor()
+    try:
+        cursor.executemany('''
+            INSERT INTO F_SONG_REQUEST (user_id, address, chat_id, song_name, artist_name, notes, requested_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', requests)
+        cursor.executemany('''
+            INSERT INTO A_REQUEST_HOURLY (address, chat_id, hour, request_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (address, chat_id, hour)
+            DO UPDATE SET request_count = request_count + excluded.request_count
+        ''', hourly)
+        cursor.executemany('''
+            INSERT INTO A_SONG_COUNT (address, chat_id, song_key, artist_key, song_name, artist_name, request_count, last_requested)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (address, chat_id, song_key, artist_key)
+            DO UPDATE SET request_count = request_count + excluded.request_count,
+                          last_requested = MAX(last_requested, excluded.last_requested)
+        ''', songs)
+        conn.commit()
+    except Exception:
+        # A half written batch must not be committed by the next write, nor hold the write lock
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return len(requests)
+
+def get_request_stats(conn: sqlite3.Connection, address: str, chat_id: str, hours: int = 12):
+    """Request statistics of an address in the chat, read from the hourly request counts"""
+    current_hour = hour_start(now())
+    since_hours = current_hour - (hours - 1) * HOUR_SECONDS
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT COALESCE(SUM(request_count), 0),
+               COALESCE(SUM(CASE WHEN hour >= ? THEN request_count END), 0)
+        FROM A_REQUEST_HOURLY
+        WHERE address = ? AND chat_id = ?
+    ''', (current_hour - 23 * HOUR_SECONDS, address, str(chat_id)))
+    total, last_day = cursor.fetchone()
+    cursor.execute('''
+        SELECT hour, request_count
+        FROM A_REQUEST_HOURLY
+        WHERE address = ? AND chat_id = ?
+        ORDER BY request_count DESC, hour DESC
+        LIMIT 1
+    ''', (address, str(chat_id)))
+    busiest_hour = cursor.fetchone()
+    cursor.close()
+    counts = get_hourly_request_counts(conn, address, chat_id, since_hours, current_hour)
+
+    return {
+        'total': total,
+        'last_day': last_day,
+        'busiest_hour': busiest_hour,
+        'hourly': [(hour, counts.get(hour, 0)) for hour in range(since_hours, current_hour + 1, HOUR_SECONDS)]
+    }
+
+def get_hourly_request_counts(conn: sqlite3.Connection, address: str, chat_id: str, first_hour: int, last_hour: int):
+    """Requests to an address in the chat per hour from first_hour to last_hour, hours without requests are left out"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT hour, request_count
+        FROM A_REQUEST_HOURLY
+        WHERE address = ? AND chat_id = ? AND hour BETWEEN ? AND ?
+    ''', (address, str(chat_id), first_hour, last_hour))
+    counts = dict(cursor.fetchall())
+    cursor.close()
+    return counts
+
+def get_top_songs(conn: sqlite3.Connection, address: str, chat_id: str, limit: int = 10):
+    """The most requested songs of an address in the chat as (song_name, artist_name, request_count) rows"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT song_name, artist_name, request_count
+        FROM A_SONG_COUNT
+        WHERE address = ? AND chat_id = ?
+        ORDER BY request_count DESC, last_requested DESC
+        LIMIT ?
+    ''', (address, str(chat_id), limit))
+    songs = cursor.fetchall()
+    cursor.close()
+    return songs
@@ -0,0 +1,76 @@
+import threading
+from collections import namedtuple
+
+# Where the song requests of a user are forwarded to. Address is None when the
+# user has not set a code, chat_id is None when the code no longer exists.
+Route = namedtuple('Route', ['address', 'chat_id', 'active', 'valid_until', 'digest_mode'])
+
+class RoutingTable:
+    """
+    In-memory cache of user_id -> Route.
+
+    Routes are filled by the reader connections and invalidated by the queries
+    modifying forward addresses or codes. Every invalidation bumps a generation
+    counter, so a route resolved before a concurrent modification was committed
+    is never stored. The listener, when set, is called with the kind and key of
+    every invalidation so other processes can drop their copies of the routes.
+    """
+
+    listener = None
+
+    def __init__(self):
+        self._routes = {}
+        self._users_by_address = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id):
+        """Return the cached route of the user, or None if it has not been resolved"""
+        return self._routes.get(str(user_id))
+
+    def put(self, user_id, route: Route, generation: int) -> None:
+        """Cache a route resolved when the table was at the given generation"""
+        user_id = str(user_id)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._discard(user_id)
+            self._routes[user_id] = route
+            if route.address is not None:
+                self._users_by_address.setdefault(route.address, set()).add(user_id)
+
+    def invalidate_user(self, user_id, notify: bool = True) -> None:
+        with self._lock:
+            self._generation += 1
+            self._discard(str(user_id))
+        if notify and self.listener is not None:
+            self.listener('user', str(user_id))
+
+    def invalidate_address(self, address: str, notify: bool = True) -> None:
+        with self._lock:
+            self._generation += 1
+            for user_id in self._users_by_address.pop(address, ()):
+                self._routes.pop(user_id, None)
+        if notify and self.listener is not None:
+            self.listener('address', address)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._routes.clear()
+            self._users_by_address.clear()
+
+    def _discard(self, user_id: str) -> None:
+        route = self._routes.pop(user_id, None)
+        if route is not None and route.address is not None:
+            users = self._users_by_address.get(route.address)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._users_by_address[route.address]
+
+routing_table = RoutingTable()
@@ -1,11 +1,26 @@
 import sqlite3
+from db.instrumented import InstrumentedConnection
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-def connect(db: str = '/app/database/songrequestbot.db') -> sqlite3.Connection:
-    conn = sqlite3.connect(db)
-    logger.info(f'Connected to database at {db}')
+def connect(db: str = '/app/database/songrequestbot.db', read_only: bool = False,
+            synchronous: str = 'NORMAL', cache_size_kb: int = 8192,
+            mmap_size: int = 67108864, busy_timeout_ms: int = 5000, slow_query_ms: float = None) -> sqlite3.Connection:
+    # The connection is owned by a thread of ConnectionPool, not the thread creating it
+    if read_only:
+        conn = sqlite3.connect(f'file:{db}?mode=ro', uri=True, check_same_thread=False, factory=InstrumentedConnection)
+    else:
+        conn = sqlite3.connect(db, check_same_thread=False, factory=InstrumentedConnection)
+        # WAL lets the read-only connections read while the writer commits
+        conn.execute('PRAGMA journal_mode=WAL')
+    if slow_query_ms is not None:
+        conn.slow_query_seconds = slow_query_ms / 1000
+    conn.execute(f'PRAGMA synchronous={synchronous}')
+    conn.execute(f'PRAGMA cache_size=-{int(cache_size_kb)}')
+    conn.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+    conn.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+    logger.info(f'Connected to database at {db}{" (read-only)" if read_only else ""}')
     return conn
 
 def close_connection(conn: sqlite3.Connection) -> None:
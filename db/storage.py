@@ -0,0 +1,174 @@
+from abc import ABC, abstractmethod
+
+from db.routing import Route
+
+class Storage(ABC):
+    """
+    The queries of the bot, implemented by every storage backend.
+
+    AsyncDatabase runs the query functions of the db package on a pool of
+    SQLite connections and PostgresStorage runs the same queries on a pool of
+    PostgreSQL connections. Both return the same values and raise the same
+    errors of errors.query_errors, rows are returned as tuples. Ids are stored
+    as text, and timestamps as UTC epoch seconds. Queries modifying codes or
+    forward addresses invalidate the routes cached in db.routing.
+    """
+
+    @abstractmethod
+    async def migrate(self) -> None:
+        """Create the tables and upgrade an existing database to the current schema"""
+
+    @abstractmethod
+    async def close(self) -> None:
+        """Wait for pending queries and close the connections"""
+
+    # --- User queries ---
+    @abstractmethod
+    async def get_forward_address(self, user_id: str):
+        """The (address,) row of the code the user sends requests to, or None"""
+
+    @abstractmethod
+    async def get_address_chat_id(self, address: str):
+        """The (chat_id,) row of the chat owning the code, or None"""
+
+    @abstractmethod
+    async def is_recipient_active(self, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def is_recipient_valid(self, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def resolve_route(self, user_id: str) -> Route:
+        """Where the requests of the user are forwarded to, from the routing table when cached"""
+
+    @abstractmethod
+    async def get_recipient(self, user_id: str) -> Route:
+        """The route of the user, raises AddressNotFoundError, AddressNotActiveError or AddressExpiredError if it cannot be used"""
+
+    @abstractmethod
+    async def add_user(self, user_id: str, nickname: str, role: str) -> None: ...
+
+    @abstractmethod
+    async def get_nickname(self, user_id: str): ...
+
+    @abstractmethod
+    async def update_nickname(self, user_id: str, nickname: str) -> None: ...
+
+    @abstractmethod
+    async def address_exists(self, address: str) -> bool: ...
+
+    @abstractmethod
+    async def user_exists(self, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def set_user_forward_address(self, user_id: str, address: str) -> bool:
+        """Raises UserNotFoundError or AddressNotFoundError if either does not exist"""
+
+    @abstractmethod
+    async def check_password_match(self, address: str, password: str) -> bool: ...
+
+    @abstractmethod
+    async def is_password_set(self, address: str) -> bool: ...
+
+    @abstractmethod
+    async def get_current_address(self, user_id: str): ...
+
+    # --- Recipient queries ---
+    @abstractmethod
+    async def add_new_recipient(self, chat_id: str, chat_type: str) -> bool:
+        """Returns False if the chat already is a recipient"""
+
+    @abstractmethod
+    async def get_recipient_chat_id(self, chat_id: str) -> bool:
+        """Whether the chat is a recipient"""
+
+    @abstractmethod
+    async def get_address_attributes(self, address: str):
+        """The columns of the code as a dict, or None"""
+
+    @abstractmethod
+    async def get_amount_of_recipient_addresses(self, chat_id: str) -> int: ...
+
+    @abstractmethod
+    async def create_new_address(self, address: str, chat_id: str, password: str = None, valid_until: int = None) -> None: ...
+
+    @abstractmethod
+    async def expire_address(self, address: str) -> None: ...
+
+    @abstractmethod
+    async def get_recipient_addresses(self, chat_id: str):
+        """The codes of the chat formatted for /omat, or None"""
+
+    @abstractmethod
+    async def list_recipient_addresses(self, chat_id: str): ...
+
+    @abstractmethod
+    async def list_valid_recipient_addresses(self, chat_id: str): ...
+
+    @abstractmethod
+    async def toggle_active(self, address: str) -> bool:
+        """Raises AddressNotFoundError or AddressExpiredError"""
+
+    @abstractmethod
+    async def release_address_from_database(self, address: str) -> None: ...
+
+    @abstractmethod
+    async def get_expired_addresses(self, chat_id: str): ...
+
+    @abstractmethod
+    async def renew_address(self, address: str, valid_until: int) -> bool: ...
+
+    @abstractmethod
+    async def set_digest_mode(self, address: str, digest_mode: str) -> bool: ...
+
+    # --- Song request queries ---
+    @abstractmethod
+    async def insert_song_requests(self, requests: list) -> int:
+        """Insert (user_id, address, chat_id, song_name, artist_name, notes, requested_at) rows and count them"""
+
+    @abstractmethod
+    async def get_request_stats(self, address: str, chat_id: str, hours: int = 12) -> dict: ...
+
+    @abstractmethod
+    async def get_hourly_request_counts(self, address: str, chat_id: str, first_hour: int, last_hour: int) -> dict: ...
+
+    @abstractmethod
+    async def get_top_songs(self, address: str, chat_id: str, limit: int = 10) -> list: ...
+
+    # --- Blocked sender queries ---
+    @abstractmethod
+    async def block_user(self, chat_id: str, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def unblock_user(self, chat_id: str, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def get_blocked_users(self, chat_id: str) -> list: ...
+
+    @abstractmethod
+    async def get_all_blocked_users(self) -> list: ...
+
+    @abstractmethod
+    async def get_recent_requesters(self, chat_id: str, days: int = 1, limit: int = 20) -> list: ...
+
+    # --- Bot persistence queries ---
+    @abstractmethod
+    async def load_conversations(self, name: str) -> dict: ...
+
+    @abstractmethod
+    async def load_user_data(self) -> dict: ...
+
+    @abstractmethod
+    async def save_persistence(self, conversations: dict, user_data: dict) -> None: ...
+
+    # --- Maintenance queries ---
+    @abstractmethod
+    async def release_expired_addresses(self) -> dict:
+        """Delete the codes expired for over 10 days, returns their chat ids by code"""
+
+    @abstractmethod
+    async def get_expiry_deadlines(self) -> list: ...
+
+    @abstractmethod
+    async def claim_expired_addresses(self) -> dict:
+        """Mark the expired codes whose owners have not been notified, returns their chat ids by code"""
@@ -1,8 +1,10 @@
 import sqlite3
-from datetime import datetime, timezone
+from datetime import datetime
 
+from db.routing import Route, routing_table
 from errors.query_errors import *
 from utils.logger import get_logger
+from utils.timestamps import now
 
 logger = get_logger(__name__)
 
@@ -62,22 +64,42 @@ def is_recipient_valid(conn: sqlite3.Connection, user_id: str):
     
     if valid_until[0] is None:
         return True
-    valid_until_datetime = datetime.fromisoformat(str(valid_until[0])).replace(tzinfo=timezone.utc)
-    return valid_until_datetime > datetime.now(timezone.utc)
+    return valid_until[0] > now()
 
-def get_recipient(conn: sqlite3.Connection, user_id: str):
-    address = get_forward_address(conn, user_id)
-    if address is None:
+def resolve_route(conn: sqlite3.Connection, user_id: str) -> Route:
+    """Resolve where the requests of the user are forwarded to, using the routing table when possible"""
+    route = routing_table.get(user_id)
+    if route is not None:
+        return route
+
+    generation = routing_table.generation
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT f.address, c.chat_id, c.active, c.valid_until, c.digest_mode
+        FROM R_FORWARD_ADDRESS f
+        LEFT JOIN R_CHAT_ADDRESS c ON c.address = f.address
+        WHERE f.user_id = ?
+    ''', (user_id,))
+    result = cursor.fetchone()
+    cursor.close()
+
+    route = Route(*result) if result is not None else Route(None, None, None, None, None)
+    routing_table.put(user_id, route, generation)
+    return route
+
+def get_recipient(conn: sqlite3.Connection, user_id: str) -> Route:
+    """Return the route of the user if requests can currently be sent through it"""
+    route = resolve_route(conn, user_id)
+    if route.address is None:
         raise AddressNotFoundError("Forward address not found for user")
     
-    if not is_recipient_active(conn, user_id):
+    if route.active != 1:
         raise AddressNotActiveError("Forward address is not active")
     
-    if not is_recipient_valid(conn, user_id):
+    if route.valid_until is not None and route.valid_until <= now():
         raise AddressExpiredError("Forward address has expired")
     
-    chat_id = get_address_chat_id(conn, address[0])
-    return chat_id[0]
+    return route
 
 def add_user(conn: sqlite3.Connection, user_id: str, nickname: str, role: str):
     cursor = conn.cursor()
@@ -182,6 +204,7 @@ def set_user_forward_address(conn: sqlite3.Connection, user_id: str, address: st
 
     conn.commit()
     cursor.close()
+    routing_table.invalidate_user(user_id)
     return True
 
 def check_password_match(conn: sqlite3.Connection, address: str, password: str):
@@ -1,31 +1,63 @@
 import sqlite3
+
+from db.routing import routing_table
 from utils.logger import get_logger
-from datetime import datetime, timedelta, timezone
+from utils.timestamps import now, days_from_now
 
 logger = get_logger(__name__)
 
-def get_release_ready_addresses(conn: sqlite3.Connection):
+def release_expired_addresses(conn: sqlite3.Connection):
+    """
+    Delete addresses that have been expired for over 10 days, and the forward
+    addresses pointing at them, in one transaction. Returns the released
+    addresses and their chat ids.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            DELETE FROM R_CHAT_ADDRESS
+            WHERE valid_until <= ?
+            RETURNING address, chat_id
+        """, (days_from_now(-10),))
+        results = cursor.fetchall()
+        cursor.executemany("""
+            DELETE FROM R_FORWARD_ADDRESS
+            WHERE address = ?
+        """, [(addr,) for addr, _ in results])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    for addr, _ in results:
+        routing_table.invalidate_address(addr)
+    return {addr: chat_id for addr, chat_id in results}
+
+def get_expiry_deadlines(conn: sqlite3.Connection):
+    """Get the expiration time of every code and whether its owner has been notified"""
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT address, chat_id 
-        FROM R_CHAT_ADDRESS 
-        WHERE valid_until < datetime('now', 'utc', '-10 days')
+        SELECT valid_until, expiry_notified
+        FROM R_CHAT_ADDRESS
+        WHERE valid_until IS NOT NULL
     """)
     results = cursor.fetchall()
     cursor.close()
-    return {addr: chat_id for addr, chat_id in results}
+    return results
 
-def get_just_expired_addresses(conn: sqlite3.Connection):
-    """Get addresses that have expired in the last hour"""
+def claim_expired_addresses(conn: sqlite3.Connection):
+    """Mark expired addresses whose owners have not been notified yet as notified and return them"""
     cursor = conn.cursor()
-    now = datetime.now(timezone.utc)
-    one_hour_ago = now - timedelta(hours=1)
     cursor.execute("""
-        SELECT address, chat_id 
-        FROM R_CHAT_ADDRESS 
-        WHERE valid_until > ? 
+        UPDATE R_CHAT_ADDRESS
+        SET expiry_notified = 1
+        WHERE expiry_notified = 0
         AND valid_until <= ?
-    """, (one_hour_ago, now))
+        RETURNING address, chat_id
+    """, (now(),))
     results = cursor.fetchall()
+    conn.commit()
     cursor.close()
-    return {addr: chat_id for addr, chat_id in results}
\ No newline at end of file
+    return {addr: chat_id for addr, chat_id in results}
@@ -0,0 +1,180 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.web import Application, RequestHandler
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Load test bot', 'username': 'loadtest_bot'}
+
+# Form parameters the bot sends JSON encoded, the rest are plain strings
+JSON_PARAMETERS = {'reply_markup', 'allowed_updates', 'commands'}
+
+class FloodBucket:
+    """Token bucket deciding whether the fake server answers a call with a flood control error"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, returns 0 or the seconds to wait when the bucket is empty"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class FakeBotAPI:
+    """
+    Local stand-in for the Telegram Bot API.
+
+    The bot is pointed at it with BOT_API_URL. Updates injected by the virtual
+    users are handed to the bot through getUpdates long polling, or posted to
+    the webhook the bot registers. Messages the bot sends or edits are queued
+    per chat for the virtual users to wait on. Sends over Telegram's limits
+    are answered with flood control errors, like the real API does.
+    """
+
+    def __init__(self, flood_limits: bool = True):
+        self.flood_limits = flood_limits
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._inboxes = defaultdict(asyncio.Queue)
+        self._global_bucket = FloodBucket(30, 30)
+        self._chat_buckets = {}
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.ready = asyncio.Event()
+        self.calls = defaultdict(int)
+        self.flood_errors = 0
+
+    def application(self) -> Application:
+        return Application([(r'/bot[^/]+/(\w+)', BotAPIHandler, {'api': self})])
+
+    # --- Updates sent to the bot ---
+    async def push_update(self, update: dict) -> None:
+        update['update_id'] = next(self._update_ids)
+        if self.webhook_url is None:
+            self._updates.append(update)
+            self._new_updates.set()
+            return
+
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret or ''}
+        try:
+            await AsyncHTTPClient().fetch(self.webhook_url, method='POST', headers=headers, body=json.dumps(update))
+        except HTTPClientError as e:
+            raise RuntimeError(f"Webhook rejected update: {e}")
+
+    async def get_updates(self, offset: int, limit: int, timeout: float) -> list:
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def close(self) -> None:
+        """Answer pending long polls so no request is left open"""
+        self._updates.clear()
+        self._new_updates.set()
+        await asyncio.sleep(0.1)
+
+    # --- Messages sent by the bot ---
+    def _flood_wait(self, chat_id: int) -> float:
+        if not self.flood_limits:
+            return 0
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Groups may receive 20 messages per minute, private chats about one per second
+            bucket = FloodBucket(20 / 60, 20) if chat_id < 0 else FloodBucket(1, 3)
+            self._chat_buckets[chat_id] = bucket
+        return max(bucket.take(), self._global_bucket.take())
+
+    def send(self, method: str, chat_id: int, text: str, reply_markup=None, message_id: int = None):
+        """Record a message sent or edited by the bot, returns the message or the seconds to wait"""
+        retry_after = self._flood_wait(chat_id)
+        if retry_after:
+            self.flood_errors += 1
+            return retry_after
+
+        message = {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'},
+            'from': BOT_USER,
+            'text': text
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        self._inboxes[chat_id].put_nowait((time.perf_counter(), method, message))
+        return message
+
+    async def receive(self, chat_id: int, timeout: float):
+        """Wait for the next message the bot sends or edits in the chat, as (received_at, method, message)"""
+        return await asyncio.wait_for(self._inboxes[chat_id].get(), timeout)
+
+class BotAPIHandler(RequestHandler):
+    def initialize(self, api: FakeBotAPI):
+        self.api = api
+
+    def _parameters(self) -> dict:
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(self.request.body or b'{}')
+        parameters = {}
+        for name in self.request.body_arguments:
+            value = self.get_body_argument(name)
+            parameters[name] = json.loads(value) if name in JSON_PARAMETERS else value
+        # Files are only counted, their content does not matter here
+        for name in self.request.files:
+            parameters[name] = None
+        return parameters
+
+    def _reply(self, result) -> None:
+        self.write({'ok': True, 'result': result})
+
+    async def post(self, method: str):
+        api = self.api
+        api.calls[method] += 1
+        parameters = self._parameters()
+
+        if method == 'getMe':
+            return self._reply(BOT_USER)
+        if method == 'getUpdates':
+            api.ready.set()
+            updates = await api.get_updates(int(parameters.get('offset') or 0),
+                                            int(parameters.get('limit') or 100),
+                                            float(parameters.get('timeout') or 0))
+            return self._reply(updates)
+        if method == 'setWebhook':
+            api.webhook_url = parameters['url']
+            api.webhook_secret = parameters.get('secret_token')
+            api.ready.set()
+            return self._reply(True)
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            text = parameters.get('text', parameters.get('caption', ''))
+            result = api.send(method, int(parameters['chat_id']), text,
+                              parameters.get('reply_markup'), int(parameters.get('message_id') or 0))
+            if isinstance(result, float):
+                retry_after = int(result) + 1
+                self.set_status(429)
+                self.write({'ok': False, 'error_code': 429,
+                            'description': f"Too Many Requests: retry after {retry_after}",
+                            'parameters': {'retry_after': retry_after}})
+                return
+            return self._reply(result)
+
+        # answerCallbackQuery, deleteWebhook and the other calls only need to succeed
+        return self._reply(True)
+
+    get = post
@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import defaultdict
+
+from loadtest.fake_bot_api import FakeBotAPI
+
+# Seconds a virtual user waits for an answer before the flow is counted as failed
+REPLY_TIMEOUT = 60
+
+SONGS = [
+    ("Sandstorm", "Darude"), ("Levan Polkka", "Loituma"), ("Dancing Queen", "ABBA"),
+    ("Mr. Brightside", "The Killers"), ("Ievan Polkka", "Hatsune Miku"), ("Freed from Desire", "Gala"),
+    ("Bad Romance", "Lady Gaga"), ("Cha Cha Cha", "Käärijä"), ("Around the World", "Daft Punk"),
+    ("Rasputin", "Boney M."), ("Titanium", "David Guetta"), ("Satisfaction", "Benny Benassi"),
+]
+
+class FlowFailed(Exception):
+    pass
+
+class Metrics:
+    """Latencies of the steps and flows of the virtual users"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+
+    def record(self, name: str, seconds: float) -> None:
+        self.latencies[name].append(seconds)
+
+class Chat:
+    """A Telegram chat driven by a virtual user, sending updates to the bot and waiting for its answers"""
+
+    _ids = itertools.count(1000)
+
+    def __init__(self, api: FakeBotAPI, metrics: Metrics, chat_id: int, user_id: int):
+        self.api = api
+        self.metrics = metrics
+        self.chat_id = chat_id
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+        self.chat = {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'}
+        if chat_id < 0:
+            self.chat['title'] = f"Group {-chat_id}"
+        self.last_message = None
+
+    async def send_text(self, text: str) -> None:
+        message = {'message_id': next(self._ids), 'date': int(time.time()), 'chat': self.chat, 'from': self.user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        await self.api.push_update({'message': message})
+
+    async def press(self, data: str) -> None:
+        """Press an inline keyboard button of the last message the bot sent"""
+        await self.api.push_update({'callback_query': {
+            'id': str(next(self._ids)),
+            'from': self.user,
+            'chat_instance': str(self.chat_id),
+            'message': self.last_message,
+            'data': data
+        }})
+
+    async def expect(self, prefix: str) -> float:
+        """Wait for a message starting with prefix, returns when it was received"""
+        deadline = time.perf_counter() + REPLY_TIMEOUT
+        while True:
+            try:
+                received_at, method, message = await self.api.receive(self.chat_id, deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                raise FlowFailed(f"No '{prefix}' in chat {self.chat_id}")
+            if message['text'].startswith(prefix):
+                self.last_message = message
+                return received_at
+
+    async def step(self, name: str, action, prefix: str) -> None:
+        """Send an update and record the time until the bot answered"""
+        started = time.perf_counter()
+        await action
+        self.metrics.record(name, await self.expect(prefix) - started)
+
+async def create_recipient(api: FakeBotAPI, metrics: Metrics, group_id: int, code: str) -> None:
+    """Register a group chat as a recipient and create a code for it"""
+    chat = Chat(api, metrics, group_id, -group_id)
+    await chat.step('recipient register', chat.send_text('/vastaanottaja'), "Success!")
+    await chat.step('recipient /uusi', chat.send_text('/uusi'), "Do you want to use a custom code")
+    await chat.step('recipient code type', chat.press('custom'), "Please send your preferred code")
+    await chat.step('recipient code', chat.send_text(code), "How long should the code be valid?")
+    await chat.step('recipient validity', chat.press('1d'), "Would you like to set a password?")
+    await chat.step('recipient password', chat.press('no_pwd'), "Address created successfully!")
+
+async def register_user(api: FakeBotAPI, metrics: Metrics, user_id: int, code: str) -> Chat:
+    """Register a user with a nickname and set the code they send requests to"""
+    chat = Chat(api, metrics, user_id, user_id)
+    await chat.step('user /start', chat.send_text('/start'), "Hello there!")
+    await chat.step('user nickname choice', chat.press('yes'), "Please enter your nickname")
+    await chat.step('user nickname', chat.send_text(f"nick{user_id}"), "Welcome")
+    await chat.step('user /koodi', chat.send_text('/koodi'), "Please provide the code")
+    await chat.step('user code', chat.send_text(code), "Code accepted!")
+    return chat
+
+async def song_request(chat: Chat) -> None:
+    """Send one song request through the whole /biisitoive conversation"""
+    song_name, artist_name = random.choice(SONGS)
+    started = time.perf_counter()
+    await chat.step('/biisitoive', chat.send_text('/biisitoive'), "What's the name of the song?")
+    await chat.step('song name', chat.send_text(song_name), "Who's the artist?")
+    await chat.step('artist name', chat.send_text(artist_name), "Add any notes")
+    await chat.step('skip notes', chat.press('skip_notes'), "Confirm song request")
+    await chat.step('confirm', chat.press('yes'), "Song request sent!")
+    chat.metrics.record('song request flow', time.perf_counter() - started)
+
+async def virtual_user(api: FakeBotAPI, metrics: Metrics, user_id: int, code: str,
+                       requests: int, think_time: float, completed: list) -> None:
+    """A user who registers, sets a code and sends song requests, pausing about think_time seconds between actions"""
+    try:
+        chat = await register_user(api, metrics, user_id, code)
+    except FlowFailed:
+        metrics.failures['registration'] += 1
+        return
+
+    for _ in range(requests):
+        await asyncio.sleep(random.expovariate(1 / think_time) if think_time else 0)
+        try:
+            await song_request(chat)
+            completed.append(time.perf_counter())
+        except FlowFailed:
+            metrics.failures['song request'] += 1
+            return
@@ -0,0 +1,51 @@
+from utils.cluster import cluster
+from utils.config import database
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+class BlockList:
+    """
+    Senders blocked by recipient chats.
+
+    The blocks are stored in R_BLOCKED_USER and mirrored into a set of
+    (chat_id, user_id) pairs loaded at startup, so the song request path
+    checks them with one set lookup and never queries the database for them.
+    Changes are broadcast to the other workers, which apply them to their sets.
+    """
+
+    def __init__(self, database):
+        self._database = database
+        self._blocked = set()
+
+    async def load(self) -> None:
+        self._blocked = {(int(chat_id), int(user_id)) for chat_id, user_id in await self._database.get_all_blocked_users()}
+        logger.info(f"Loaded {len(self._blocked)} blocked senders")
+
+    def is_blocked(self, chat_id, user_id) -> bool:
+        return (int(chat_id), int(user_id)) in self._blocked
+
+    async def block(self, chat_id, user_id) -> bool:
+        """Block the user from sending requests to the chat, returns False if already blocked"""
+        blocked = await self._database.block_user(chat_id, user_id)
+        self._blocked.add((int(chat_id), int(user_id)))
+        cluster.broadcast({'type': 'block', 'chat_id': int(chat_id), 'user_id': int(user_id), 'blocked': True})
+        return blocked
+
+    async def unblock(self, chat_id, user_id) -> bool:
+        """Allow the user to send requests to the chat again, returns False if they were not blocked"""
+        unblocked = await self._database.unblock_user(chat_id, user_id)
+        self._blocked.discard((int(chat_id), int(user_id)))
+        cluster.broadcast({'type': 'block', 'chat_id': int(chat_id), 'user_id': int(user_id), 'blocked': False})
+        return unblocked
+
+    def apply(self, application, message: dict) -> None:
+        """Apply a block or unblock made by another worker"""
+        key = (message['chat_id'], message['user_id'])
+        if message['blocked']:
+            self._blocked.add(key)
+        else:
+            self._blocked.discard(key)
+
+block_list = BlockList(database)
+cluster.register('block', block_list.apply)
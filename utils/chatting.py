@@ -1,20 +1,68 @@
-from telegram.error import BadRequest, RetryAfter, Forbidden
 import asyncio
+from collections import Counter, namedtuple
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, Forbidden
 from telegram.ext import ContextTypes
+from utils.config import dispatcher, FANOUT_CONCURRENCY
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-async def safe_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message: str, reply_markup=None):
+FanOutResult = namedtuple('FanOutResult', ['sent', 'failed', 'forbidden'])
+
+async def _safe_call(chat_id: int, method, /, **kwargs):
     try:
-        await context.bot.send_message(chat_id=chat_id, text=message, reply_markup=reply_markup)
-    except RetryAfter as e:
-        logger.info(f"Caught flood control, retrying after {e.retry_after+1} seconds")
-        await asyncio.sleep(e.retry_after+1)
-        await safe_chat(context, chat_id, message, reply_markup)
+        return await dispatcher.send(chat_id, method, **kwargs)
+    except RetryAfter as e: # Flood control did not clear within the allowed retries
+        logger.warning(f"Message to {chat_id} dropped: {e}")
+        return e
     except Forbidden as e: # Player has not initiated a private chat with the bot
         logger.info(e)
         return e
     except BadRequest as e:
         logger.info(e)
-        return e
\ No newline at end of file
+        return e
+
+async def safe_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message: str, reply_markup=None):
+    """Send a message, returns the sent Message or the error if it could not be sent"""
+    return await _safe_call(chat_id, context.bot.send_message, chat_id=chat_id, text=message, reply_markup=reply_markup)
+
+async def safe_edit(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, message: str, reply_markup=None):
+    """Replace the text of a sent message, returns the edited Message or the error if it could not be edited"""
+    return await _safe_call(chat_id, context.bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=message,
+                            reply_markup=reply_markup)
+
+async def safe_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, photo: bytes, caption: str = None):
+    """Send an image, returns the sent Message or the error if it could not be sent"""
+    return await _safe_call(chat_id, context.bot.send_photo, chat_id=chat_id, photo=photo, caption=caption)
+
+async def fan_out(context: ContextTypes.DEFAULT_TYPE, messages: dict, description: str = "messages",
+                  concurrency: int = FANOUT_CONCURRENCY) -> FanOutResult:
+    """
+    Send each chat_id its message from the dict, at most `concurrency` chats at a time.
+    A chat that fails or waits for flood control does not hold up the others.
+    """
+    counts = Counter()
+    chats = iter(messages.items())
+
+    async def worker():
+        # The workers share the iterator, so each chat is sent to once
+        for chat_id, message in chats:
+            try:
+                result = await safe_chat(context, chat_id, message)
+            except Exception as e:
+                logger.error(f"Failed to send {description} to {chat_id}: {e}")
+                result = e
+            if isinstance(result, Message):
+                counts['sent'] += 1
+            elif isinstance(result, Forbidden):
+                counts['forbidden'] += 1
+            else:
+                counts['failed'] += 1
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(messages)))))
+    result = FanOutResult(counts['sent'], counts['failed'], counts['forbidden'])
+    logger.info(f"Sent {description} to {len(messages)} chats: "
+                f"{result.sent} sent, {result.failed} failed, {result.forbidden} forbidden")
+    return result
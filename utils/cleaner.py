@@ -1,39 +1,35 @@
-from db import *
-from utils.chatting import safe_chat
+from utils.chatting import fan_out
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-async def clean_expired_addresses(context, sql_connection):
+async def clean_expired_addresses(context, database):
     """
     Cleans addresses that have been expired for more than 10 days and notifies owners.
     
     Args:
         context: Telegram context for sending messages
-        sql_connection: Database connection object
+        database: AsyncDatabase used for the queries
     """
-    # Get addresses that are ready to be released
-    expired_addresses = get_release_ready_addresses(sql_connection)
+    # Release the addresses in one transaction
+    expired_addresses = await database.release_expired_addresses()
     
     if not expired_addresses:
         logger.info("Finished expired address cleaning process")
         return
 
-    logger.info(f"Found {len(expired_addresses)} expired addresses")
+    logger.info(f"Released {len(expired_addresses)} expired addresses")
     # Create a dictionary to group addresses by chat_id
     notifications = {}
     
-    # Process each expired address
     for address, chat_id in expired_addresses.items():
-        # Remove the address from database
-        release_address_from_database(sql_connection, address)
-        
         # Group addresses by chat_id for notifications
         if chat_id not in notifications:
             notifications[chat_id] = []
         notifications[chat_id].append(address)
 
-    # Send notifications to users
+    # Send notifications to users concurrently
+    messages = {}
     for chat_id, addresses in notifications.items():
         if len(addresses) == 1:
             message = (f"Hello! Just letting you know that your expired code "
@@ -44,22 +40,20 @@ async def clean_expired_addresses(context, sql_connection):
             message = (f"Hello! Just letting you know that your expired codes have "
                       f"been automatically removed from the system as they have been "
                       f"expired for over 10 days:\n{addresses_str}")
-        
-        await safe_chat(context, chat_id, message)
+        messages[chat_id] = message
 
+    await fan_out(context, messages, "release notifications")
     logger.info("Finished expired address cleaning process")
 
-async def expiration_notification(context, sql_connection):
+async def expiration_notification(context, database):
     """
-    Notifies the user that their address is about to expire in 3 days.
+    Notifies the owners of addresses that have expired since the last notification.
     
     Args:
         context: Telegram context for sending messages
-        sql_connection: Database connection object
-        address: Address to notify about
-        chat_id: Chat ID to send the notification to
+        database: AsyncDatabase used for the queries
     """
-    just_expired_addresses = get_just_expired_addresses(sql_connection)
+    just_expired_addresses = await database.claim_expired_addresses()
 
     if not just_expired_addresses:
         return
@@ -73,7 +67,8 @@ async def expiration_notification(context, sql_connection):
             notifications[chat_id] = []
         notifications[chat_id].append(address)
     
-    # Send notifications to users
+    # Send notifications to users concurrently
+    messages = {}
     for chat_id, addresses in notifications.items():
         if len(addresses) == 1:
             message = (f"Hello! Just letting you know that your code "
@@ -82,7 +77,7 @@ async def expiration_notification(context, sql_connection):
             addresses_str = "\n".join(addresses)
             message = (f"Hello! Just letting you know that your codes "
                       f"{addresses_str} have just expired. They will be released automatically in 10 days.")
-        
-        await safe_chat(context, chat_id, message)
+        messages[chat_id] = message
 
+    await fan_out(context, messages, "expiration notifications")
     logger.info("Finished expiration notification process")
\ No newline at end of file
@@ -0,0 +1,171 @@
+import asyncio
+import inspect
+import json
+
+from telegram import Update
+
+from db.routing import routing_table
+from utils.config import BOT_WORKERS, WORKER_INDEX, WORKER_SOCKET
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Longest line accepted on the worker socket, updates are a few kilobytes
+MAX_LINE = 2 ** 20
+
+def worker_for(chat_id, workers: int) -> int:
+    """Index of the worker handling the chat, the same in every process"""
+    return int(chat_id) % workers
+
+def encode(message: dict) -> bytes:
+    return (json.dumps(message) + '\n').encode()
+
+class Cluster:
+    """
+    This process as one of the workers started by the ingress process.
+
+    The ingress routes every update to the worker owning its chat, so a chat
+    is always handled by the same worker in the order its updates arrived and
+    its conversations stay in that worker's memory. The workers and the
+    ingress exchange JSON lines over a Unix socket. Messages sent by a worker
+    are routed by the ingress to the worker owning a chat, or to every other
+    worker. Song requests are delivered by the worker owning the recipient
+    chat, so duplicates and digests are collected in one place, and changes to
+    the in-memory routes and blocks are broadcast to keep the workers in sync.
+
+    Without WORKER_INDEX the process handles every chat itself and sends nothing.
+    """
+
+    def __init__(self, workers: int, index: int = None, socket_path: str = None):
+        self.workers = workers
+        self.index = index
+        self._socket_path = socket_path
+        self._handlers = {}
+        self._tasks = set()
+        self._loop = None
+        self._writer = None
+        self._outbox = None
+        self._send_task = None
+        self._receive_task = None
+        self._drain = asyncio.Event()
+        self._stop = asyncio.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.index is not None
+
+    def owns(self, chat_id) -> bool:
+        return not self.enabled or worker_for(chat_id, self.workers) == self.index
+
+    def register(self, kind: str, handler) -> None:
+        """Handle messages of the kind from other workers with handler(application, message)"""
+        self._handlers[kind] = handler
+
+    def send_to_owner(self, chat_id, message: dict) -> None:
+        self._send({**message, 'route': 'chat', 'chat_id': int(chat_id)})
+
+    def broadcast(self, message: dict) -> None:
+        """Send the message to every other worker, does nothing without workers"""
+        if self.enabled:
+            self._send({**message, 'route': 'others'})
+
+    def _send(self, message: dict) -> None:
+        # Routes are invalidated on the database threads
+        self._loop.call_soon_threadsafe(self._outbox.put_nowait, encode(message))
+
+    async def connect(self, application) -> None:
+        """Connect to the ingress and start handling what it sends"""
+        self._loop = asyncio.get_running_loop()
+        self._outbox = asyncio.Queue()
+        reader, self._writer = await asyncio.open_unix_connection(self._socket_path, limit=MAX_LINE)
+        self._writer.write(encode({'type': 'hello', 'worker': self.index}))
+        self._send_task = self._loop.create_task(self._send_outbox())
+        self._receive_task = self._loop.create_task(self._receive(reader, application))
+        routing_table.listener = self._routes_invalidated
+        logger.info(f"Worker {self.index} of {self.workers} connected to the ingress")
+
+    async def _send_outbox(self) -> None:
+        while True:
+            line = await self._outbox.get()
+            self._writer.write(line)
+            await self._writer.drain()
+            self._outbox.task_done()
+
+    async def _receive(self, reader, application) -> None:
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                kind = message['type']
+                if kind == 'update':
+                    # Waiting for room in the queue makes the ingress wait too
+                    await application.update_queue.put(Update.de_json(message['update'], application.bot))
+                elif kind == 'drain':
+                    self._drain.set()
+                elif kind == 'stop':
+                    self._stop.set()
+                else:
+                    self._handle(application, kind, message)
+        except Exception as e:
+            logger.error(f"Lost the connection to the ingress: {e}")
+        finally:
+            # Without the ingress there are no more updates to handle
+            self.abort()
+
+    def _handle(self, application, kind: str, message: dict) -> None:
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.warning(f"No handler for messages of type {kind}")
+            return
+        try:
+            result = handler(application, message)
+        except Exception as e:
+            logger.error(f"Handling a {kind} message failed: {e}")
+            return
+        # Slow handlers such as deliveries must not hold up the updates behind them
+        if inspect.isawaitable(result):
+            task = self._loop.create_task(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _routes_invalidated(self, kind: str, key) -> None:
+        self.broadcast({'type': 'invalidate_routes', 'kind': kind, 'key': key})
+
+    def abort(self) -> None:
+        """Stop without waiting for the ingress, when it is gone or the worker is terminated"""
+        self._drain.set()
+        self._stop.set()
+
+    async def wait_for_drain(self) -> None:
+        """Wait until the ingress stops sending updates"""
+        await self._drain.wait()
+
+    async def drained(self) -> None:
+        """Tell the ingress the received updates have been handled and wait until every worker has done so"""
+        if not self._stop.is_set():
+            self._outbox.put_nowait(encode({'type': 'drained', 'route': 'ingress'}))
+        await self._stop.wait()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        routing_table.listener = None
+        try:
+            await asyncio.wait_for(self._outbox.join(), timeout=5)
+        except (asyncio.TimeoutError, ConnectionError):
+            logger.warning(f"Worker {self.index} closed with unsent messages")
+        self._send_task.cancel()
+        self._receive_task.cancel()
+        self._writer.close()
+        self._writer = None
+
+def _invalidate_routes(application, message: dict) -> None:
+    # Not broadcast again, the worker that changed the route already did
+    if message['kind'] == 'address':
+        routing_table.invalidate_address(message['key'], notify=False)
+    else:
+        routing_table.invalidate_user(message['key'], notify=False)
+
+cluster = Cluster(BOT_WORKERS, WORKER_INDEX, WORKER_SOCKET)
+cluster.register('invalidate_routes', _invalidate_routes)
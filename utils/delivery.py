@@ -0,0 +1,289 @@
+import asyncio
+import time
+from collections import deque, namedtuple
+
+from telegram import Message
+from telegram.ext import CallbackContext
+
+from utils.chatting import safe_chat, safe_edit
+from utils.cluster import cluster
+from utils.config import (
+    DIGEST_WINDOW_SECONDS,
+    DIGEST_AUTO_THRESHOLD,
+    DUPLICATE_WINDOW_SECONDS,
+    DUPLICATE_EDIT_DELAY_SECONDS
+)
+from utils.logger import get_logger
+from utils.text import normalize_song
+
+logger = get_logger(__name__)
+
+SongRequest = namedtuple('SongRequest', ['user_id', 'nickname', 'song_name', 'artist_name', 'notes'])
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+# Nicknames listed for a song before the rest are only counted
+MAX_LISTED_NICKNAMES = 10
+
+class RequestedSong:
+    """All requests of one song to one address within the duplicate window"""
+
+    def __init__(self, request: SongRequest):
+        self.song_name = request.song_name
+        self.artist_name = request.artist_name
+        self.requests = [request]
+        self.first_requested = time.monotonic()
+        self.message_id = None
+        self.sending = False
+        self.edit_task = None
+        self.edit_context = None
+
+    @property
+    def count(self) -> int:
+        return len(self.requests)
+
+def format_nicknames(requests: list) -> str:
+    nicknames = list(dict.fromkeys(str(request.nickname) for request in requests))
+    listed = ", ".join(nicknames[:MAX_LISTED_NICKNAMES])
+    if len(nicknames) > MAX_LISTED_NICKNAMES:
+        listed += f" and {len(nicknames) - MAX_LISTED_NICKNAMES} others"
+    return listed
+
+def format_notes(requests: list) -> list:
+    return [f"{request.nickname}: {request.notes}" for request in requests if request.notes]
+
+def format_request(request: SongRequest) -> str:
+    return (f"New song request from {request.nickname}!\n"
+            f"Song: {request.song_name}\n"
+            f"Artist: {request.artist_name}\n"
+            f"Notes: {request.notes}")
+
+def format_song(song: RequestedSong) -> str:
+    """Message of a song, updated in place as duplicate requests arrive"""
+    if song.count == 1:
+        return format_request(song.requests[0])
+
+    message = (f"Song requested {song.count} times!\n"
+               f"Song: {song.song_name}\n"
+               f"Artist: {song.artist_name}\n"
+               f"Requested by: {format_nicknames(song.requests)}")
+    notes = format_notes(song.requests)
+    if notes:
+        message += "\nNotes:\n" + "\n".join(notes)
+    return message[:MAX_MESSAGE_LENGTH]
+
+def format_digest(address: str, songs: list) -> list:
+    """Format buffered songs into as few messages as fit the message length limit"""
+    header = f"{len(songs)} requested songs for code {address}:\n"
+    lines = []
+    for i, song in enumerate(songs, start=1):
+        line = f"\n{i}. {song.song_name} - {song.artist_name} ({format_nicknames(song.requests)})"
+        if song.count > 1:
+            line += f"\n    Requested {song.count} times"
+        for note in format_notes(song.requests):
+            line += f"\n    Notes: {note}"
+        lines.append(line[:MAX_MESSAGE_LENGTH])
+
+    messages = []
+    message = header
+    for line in lines:
+        if len(message) + len(line) > MAX_MESSAGE_LENGTH:
+            messages.append(message)
+            message = ""
+        message += line
+    messages.append(message)
+    return messages
+
+class RequestDelivery:
+    """
+    Delivers confirmed song requests to the recipient chats.
+
+    Requests of the same song to an address within duplicate_window seconds are
+    coalesced: the first request sends a message and later duplicates edit that
+    message to show the request count and nicknames, or are counted on one line
+    of the digest. Edits are delayed by edit_delay seconds so a burst of
+    duplicates costs a single API call.
+
+    Addresses in digest mode 'on', and addresses in mode 'auto' whose chat has
+    received more than auto_threshold requests during the last minute, have
+    their songs buffered and sent as one digest message `window` seconds
+    after the first buffered request. Other requests are forwarded right away,
+    in the background, so a recipient chat waiting for its rate limit never
+    holds up the handlers of the senders.
+
+    With several workers, requests are handed over to the worker owning the
+    recipient chat, which holds the chat's songs, digests and message rates.
+    """
+
+    def __init__(self, window: float = 60, auto_threshold: int = 10,
+                 duplicate_window: float = 1800, edit_delay: float = 5):
+        self._window = window
+        self._auto_threshold = auto_threshold
+        self._duplicate_window = duplicate_window
+        self._edit_delay = edit_delay
+        self._recent = {}
+        self._songs = {}
+        self._digests = {}
+        self._flush_tasks = {}
+        self._send_tasks = set()
+        self._pruned = time.monotonic()
+
+    # Quiet chats and expired songs are forgotten, checked at most this often
+    PRUNE_INTERVAL_SECONDS = 60
+
+    def _prune(self) -> None:
+        """Forget the request rates of chats without requests during the last minute and the expired songs"""
+        now = time.monotonic()
+        if now - self._pruned < self.PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned = now
+        for chat_id in [chat_id for chat_id, recent in self._recent.items() if recent[-1] < now - 60]:
+            del self._recent[chat_id]
+
+        expired_before = now - self._duplicate_window
+        for key, songs in list(self._songs.items()):
+            # Songs still being sent or waiting for an edit are kept until they are done
+            for song_key in [song_key for song_key, song in songs.items()
+                             if song.first_requested < expired_before and song.edit_task is None and not song.sending]:
+                del songs[song_key]
+            if not songs:
+                del self._songs[key]
+
+    def _request_rate(self, chat_id) -> int:
+        """Record a request to the chat and return the amount received during the last minute"""
+        now = time.monotonic()
+        recent = self._recent.setdefault(chat_id, deque())
+        recent.append(now)
+        while recent[0] < now - 60:
+            recent.popleft()
+        return len(recent)
+
+    def _use_digest(self, chat_id, digest_mode: str) -> bool:
+        rate = self._request_rate(chat_id)
+        if digest_mode == 'on':
+            return True
+        if digest_mode == 'off':
+            return False
+        return rate > self._auto_threshold
+
+    def _register(self, key, request: SongRequest) -> RequestedSong:
+        """Add the request to the song it duplicates, or start a new song"""
+        songs = self._songs.setdefault(key, {})
+        expired_before = time.monotonic() - self._duplicate_window
+        for song_key in [song_key for song_key, song in songs.items() if song.first_requested < expired_before]:
+            del songs[song_key]
+
+        song_key = normalize_song(request.song_name, request.artist_name)
+        song = songs.get(song_key)
+        if song is None:
+            song = songs[song_key] = RequestedSong(request)
+        else:
+            song.requests.append(request)
+        return song
+
+    async def deliver(self, context, address: str, chat_id, digest_mode: str, request: SongRequest) -> None:
+        chat_id = int(chat_id)
+        if not cluster.owns(chat_id):
+            cluster.send_to_owner(chat_id, {'type': 'deliver', 'address': address,
+                                            'digest_mode': digest_mode, 'request': request._asdict()})
+            return
+        self._prune()
+        key = (address, chat_id)
+        song = self._register(key, request)
+        use_digest = self._use_digest(chat_id, digest_mode)
+
+        if song.message_id is not None:
+            self._schedule_edit(context, chat_id, song)
+            return
+
+        if use_digest:
+            pending = self._digests.setdefault(key, [])
+            if song not in pending:
+                pending.append(song)
+            if key not in self._flush_tasks:
+                task = asyncio.get_running_loop().create_task(self._flush_later(context, key))
+                self._flush_tasks[key] = (task, context)
+            return
+
+        if song.sending:
+            # The message is edited once the first request has been sent
+            return
+
+        # The recipient chat may be waiting for its rate limit, which must not hold up the sender
+        song.sending = True
+        task = asyncio.get_running_loop().create_task(self._send(context, chat_id, song))
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, context, chat_id: int, song: RequestedSong) -> None:
+        """Send the message of a new song, edited later as duplicates arrive"""
+        try:
+            sent_count = song.count
+            result = await safe_chat(context, chat_id, format_song(song))
+        except Exception as e:
+            logger.error(f"Failed to send song request to {chat_id}: {e}")
+            return
+        finally:
+            song.sending = False
+        if isinstance(result, Message):
+            song.message_id = result.message_id
+            if song.count > sent_count:
+                self._schedule_edit(context, chat_id, song)
+
+    async def deliver_forwarded(self, application, message: dict) -> None:
+        """Deliver a request handed over by another worker"""
+        await self.deliver(CallbackContext(application), message['address'], message['chat_id'],
+                           message['digest_mode'], SongRequest(**message['request']))
+
+    def _schedule_edit(self, context, chat_id: int, song: RequestedSong) -> None:
+        if song.edit_task is None:
+            song.edit_context = context
+            song.edit_task = asyncio.get_running_loop().create_task(self._edit_later(chat_id, song))
+
+    async def _edit_later(self, chat_id: int, song: RequestedSong) -> None:
+        await asyncio.sleep(self._edit_delay)
+        song.edit_task = None
+        context, song.edit_context = song.edit_context, None
+        await safe_edit(context, chat_id, song.message_id, format_song(song))
+
+    async def _flush_later(self, context, key) -> None:
+        await asyncio.sleep(self._window)
+        del self._flush_tasks[key]
+        await self._flush(context, key)
+
+    async def _flush(self, context, key) -> None:
+        address, chat_id = key
+        songs = self._digests.pop(key, None)
+        if not songs:
+            return
+        if len(songs) == 1:
+            result = await safe_chat(context, chat_id, format_song(songs[0]))
+            if isinstance(result, Message):
+                songs[0].message_id = result.message_id
+            return
+        logger.info(f"Sending digest of {len(songs)} songs for {address} to {chat_id}")
+        for message in format_digest(address, songs):
+            await safe_chat(context, chat_id, message)
+
+    async def close(self) -> None:
+        """Send the buffered digests and pending edits right away, called on shutdown"""
+        for key, (task, context) in list(self._flush_tasks.items()):
+            task.cancel()
+            del self._flush_tasks[key]
+            await self._flush(context, key)
+
+        for (address, chat_id), songs in list(self._songs.items()):
+            for song in list(songs.values()):
+                if song.edit_task is not None:
+                    song.edit_task.cancel()
+                    song.edit_task = None
+                    await safe_edit(song.edit_context, chat_id, song.message_id, format_song(song))
+
+request_delivery = RequestDelivery(
+    window=DIGEST_WINDOW_SECONDS,
+    auto_threshold=DIGEST_AUTO_THRESHOLD,
+    duplicate_window=DUPLICATE_WINDOW_SECONDS,
+    edit_delay=DUPLICATE_EDIT_DELAY_SECONDS
+)
+cluster.register('deliver', request_delivery.deliver_forwarded)
@@ -0,0 +1,139 @@
+import asyncio
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from utils.logger import get_logger
+from utils.metrics import OUTBOUND_CALLS
+from utils.rate_limit import TokenBucket
+
+logger = get_logger(__name__)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Flood control wait of a RetryAfter error in seconds"""
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return error.retry_after
+
+class OutboundDispatcher:
+    """
+    Central queue for all outbound Bot API calls.
+
+    Each chat has its own FIFO queue drained by a runner task, which waits on
+    the global token bucket and the bucket of the chat before every call, so
+    sends stay under Telegram's limits and one rate limited chat never holds
+    up the others. RetryAfter pauses the bucket of the chat and the call is
+    retried at most max_retries times. The amount of queued calls is bounded,
+    so callers wait for a free slot when the bot falls behind.
+    """
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, private_burst: float = 2,
+                 group_per_minute: float = 20, max_pending: int = 1000, max_retries: int = 3):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._private_rate = private_rate
+        self._private_burst = private_burst
+        self._group_per_minute = group_per_minute
+        self._max_retries = max_retries
+        self._slots = asyncio.Semaphore(max_pending)
+        self._chat_buckets = {}
+        self._queues = {}
+        self._runners = {}
+
+    # Buckets are forgotten once they are full again, which is checked when this many exist
+    MAX_IDLE_BUCKETS = 10000
+
+    def _prune_buckets(self) -> None:
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._runners and bucket.idle:
+                del self._chat_buckets[chat_id]
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_IDLE_BUCKETS:
+                self._prune_buckets()
+            # Group and channel ids are negative
+            if chat_id < 0:
+                bucket = TokenBucket(self._group_per_minute / 60, self._group_per_minute)
+            else:
+                bucket = TokenBucket(self._private_rate, self._private_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    @property
+    def pending(self) -> int:
+        """Amount of calls waiting to be sent"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def send(self, chat_id, method, /, *args, **kwargs):
+        """Queue a Bot API call targeting the chat and wait for its result"""
+        # Chat ids read from the database are strings
+        chat_id = int(chat_id)
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append((method, args, kwargs, future))
+        if chat_id not in self._runners:
+            self._runners[chat_id] = asyncio.get_running_loop().create_task(self._run_chat(chat_id))
+        return await future
+
+    async def _run_chat(self, chat_id) -> None:
+        queue = self._queues[chat_id]
+        bucket = self._chat_bucket(chat_id)
+        try:
+            while queue:
+                method, args, kwargs, future = queue.popleft()
+                try:
+                    result = await self._deliver(chat_id, bucket, method, args, kwargs)
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                except BaseException:
+                    # Cancelled on shutdown while sending, the caller must not wait forever
+                    future.cancel()
+                    raise
+                finally:
+                    self._slots.release()
+        finally:
+            # Calls are only left over when the runner was cancelled on shutdown
+            for *_, future in queue:
+                future.cancel()
+                self._slots.release()
+            del self._runners[chat_id]
+            del self._queues[chat_id]
+
+    async def _deliver(self, chat_id, bucket: TokenBucket, method, args, kwargs):
+        name = getattr(method, '__name__', 'unknown')
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                result = await method(*args, **kwargs)
+            except RetryAfter as e:
+                OUTBOUND_CALLS.inc(method=name, result='retry_after')
+                retry_after = retry_after_seconds(e)
+                bucket.pause(retry_after + 1)
+                if attempt >= self._max_retries:
+                    logger.warning(f"Giving up on chat {chat_id} after {attempt + 1} flood control errors")
+                    raise
+                attempt += 1
+                logger.info(f"Caught flood control in chat {chat_id}, retrying after {retry_after + 1} seconds")
+            except Exception:
+                OUTBOUND_CALLS.inc(method=name, result='error')
+                raise
+            else:
+                OUTBOUND_CALLS.inc(method=name, result='ok')
+                return result
+
+    async def close(self, timeout: float = 10) -> None:
+        """Wait for queued calls to be sent, called on shutdown"""
+        runners = list(self._runners.values())
+        if not runners:
+            return
+        logger.info(f"Waiting for {self.pending} outbound messages to be sent")
+        done, not_done = await asyncio.wait(runners, timeout=timeout)
+        for runner in not_done:
+            runner.cancel()
@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import time
+
+from utils.cleaner import clean_expired_addresses, expiration_notification
+from utils.config import database
+from utils.logger import get_logger
+from utils.metrics import JOB_FAILURES, JOB_SECONDS
+from utils.timestamps import DAY_SECONDS
+
+logger = get_logger(__name__)
+
+# Expired codes are released this long after their expiration
+RELEASE_DELAY_SECONDS = 10 * DAY_SECONDS
+
+# Failed jobs are retried after this many seconds
+RETRY_SECONDS = 60
+
+EXPIRY, RELEASE = 'expiry', 'release'
+
+class ExpiryScheduler:
+    """
+    Notifies owners of expired codes and releases codes expired for over 10 days.
+
+    Upcoming expiry and release deadlines are kept in a min-heap, loaded from
+    the database at startup and pushed by the handlers that create, renew or
+    expire codes. A single task sleeps until the earliest deadline and then runs
+    the job of its kind. The jobs query which codes are actually due, so a
+    deadline made stale by a renewal only costs one indexed query. Handled
+    codes are marked notified or deleted, so restarts never repeat them and
+    deadlines missed while the bot was down fire right after startup.
+    """
+
+    def __init__(self, database, release_delay: float = RELEASE_DELAY_SECONDS):
+        self._database = database
+        self._release_delay = release_delay
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+        self._context = None
+
+    async def start(self, context) -> None:
+        """Load the deadlines of existing codes and start waiting for them"""
+        self._context = context
+        self._wakeup = asyncio.Event()
+        for valid_until, expiry_notified in await self._database.get_expiry_deadlines():
+            if not expiry_notified:
+                self._heap.append((valid_until, EXPIRY))
+            self._heap.append((valid_until + self._release_delay, RELEASE))
+        heapq.heapify(self._heap)
+        logger.info(f"Loaded {len(self._heap)} expiry and release deadlines")
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def schedule(self, valid_until: int) -> None:
+        """Add the deadlines of a code that was created, renewed or expired"""
+        if valid_until is None: # Codes valid indefinitely never expire
+            return
+        self._push(valid_until, EXPIRY)
+        self._push(valid_until + self._release_delay, RELEASE)
+
+    def _push(self, deadline: float, kind: str) -> None:
+        heapq.heappush(self._heap, (deadline, kind))
+        if self._wakeup is not None and self._heap[0] == (deadline, kind):
+            self._wakeup.set()
+
+    def _pop_due(self) -> set:
+        now = time.time()
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            due.add(heapq.heappop(self._heap)[1])
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due()
+            if EXPIRY in due:
+                await self._run_job(EXPIRY, expiration_notification)
+            if RELEASE in due:
+                await self._run_job(RELEASE, clean_expired_addresses)
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, kind: str, job) -> None:
+        started = time.perf_counter()
+        try:
+            await job(self._context, self._database)
+        except Exception as e:
+            JOB_FAILURES.inc(job=kind)
+            logger.error(f"Scheduled {kind} job failed, retrying in {RETRY_SECONDS} seconds: {e}")
+            heapq.heappush(self._heap, (time.time() + RETRY_SECONDS, kind))
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - started, job=kind)
+
+    async def close(self) -> None:
+        """Stop waiting for deadlines, called on shutdown"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+expiry_scheduler = ExpiryScheduler(database)
@@ -0,0 +1,94 @@
+import asyncio
+import io
+from collections import OrderedDict
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from utils.config import database, GRAPH_HOURS, GRAPH_CACHE_SIZE
+from utils.logger import get_logger
+from utils.timestamps import HOUR_SECONDS, hour_start, now, format_timestamp
+
+logger = get_logger(__name__)
+
+def render_hourly_graph(address: str, first_hour: int, counts: list) -> bytes:
+    """Render a PNG bar chart of requests per hour starting from first_hour"""
+    # A Figure without pyplot keeps no global state, so graphs can be rendered in threads
+    figure = Figure(figsize=(8, 4), dpi=100)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    hours = [format_timestamp(first_hour + i * HOUR_SECONDS, '%H') for i in range(len(counts))]
+    axes.bar(range(len(counts)), counts, color='#2a9d8f')
+    axes.set_xticks(range(len(counts)), hours, fontsize=8)
+    axes.set_xlabel("Hour")
+    axes.set_ylabel("Requests")
+    axes.set_title(f"Song requests per hour for code {address}")
+    axes.yaxis.get_major_locator().set_params(integer=True)
+    figure.tight_layout()
+
+    image = io.BytesIO()
+    figure.savefig(image, format='png')
+    return image.getvalue()
+
+class GraphCache:
+    """
+    Renders and caches the hourly request graphs of codes.
+
+    The counts of hours that have closed never change, so they are read from
+    the rollup once per (address, chat, hour range) and only the current hour
+    is queried on later calls. The rendered image is reused until the count
+    of the current hour changes, and concurrent calls for the same image
+    share one render, which runs in a thread off the event loop.
+    """
+
+    def __init__(self, database, hours: int = 24, max_entries: int = 256):
+        self._database = database
+        self._hours = hours
+        self._max_entries = max_entries
+        self._closed_counts = OrderedDict()
+        self._images = OrderedDict()
+        self._rendering = {}
+
+    def _remember(self, cache: OrderedDict, key, value) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self._max_entries:
+            cache.popitem(last=False)
+
+    async def _get_closed_counts(self, address: str, chat_id: str, first_hour: int, current_hour: int) -> list:
+        key = (address, chat_id, first_hour)
+        counts = self._closed_counts.get(key)
+        if counts is None:
+            hourly = await self._database.get_hourly_request_counts(address, chat_id, first_hour, current_hour - HOUR_SECONDS)
+            counts = [hourly.get(hour, 0) for hour in range(first_hour, current_hour, HOUR_SECONDS)]
+        self._remember(self._closed_counts, key, counts)
+        return counts
+
+    async def get_graph(self, address: str, chat_id) -> bytes:
+        """PNG graph of the requests to the address in the chat during the last hours"""
+        chat_id = str(chat_id)
+        current_hour = hour_start(now())
+        first_hour = current_hour - (self._hours - 1) * HOUR_SECONDS
+
+        closed_counts = await self._get_closed_counts(address, chat_id, first_hour, current_hour)
+        current = await self._database.get_hourly_request_counts(address, chat_id, current_hour, current_hour)
+        counts = closed_counts + [current.get(current_hour, 0)]
+
+        key = (address, chat_id, first_hour, counts[-1])
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            return image
+
+        rendering = self._rendering.get(key)
+        if rendering is None:
+            rendering = asyncio.get_running_loop().run_in_executor(None, render_hourly_graph, address, first_hour, counts)
+            self._rendering[key] = rendering
+        try:
+            image = await asyncio.shield(rendering)
+        finally:
+            self._rendering.pop(key, None)
+        self._remember(self._images, key, image)
+        return image
+
+graph_cache = GraphCache(database, hours=GRAPH_HOURS, max_entries=GRAPH_CACHE_SIZE)
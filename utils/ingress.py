@@ -0,0 +1,185 @@
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+
+from utils.cluster import MAX_LINE, encode, worker_for
+from utils.config import BOT_WORKERS, WORKER_SOCKET, UPDATE_QUEUE_SIZE
+from utils.logger import get_logger
+from utils.metrics import WORKER_QUEUE_SIZE, WORKER_RESTARTS
+
+logger = get_logger(__name__)
+
+# Seconds the workers get to handle their remaining updates, and then to exit, on shutdown
+DRAIN_TIMEOUT_SECONDS = 30
+EXIT_TIMEOUT_SECONDS = 30
+
+# A worker exiting this soon after being started again is not restarted right away
+RESTART_DELAY_SECONDS = 5
+
+class WorkerProcess:
+    """A worker started by the ingress and the lines waiting to be sent to it"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.drained = asyncio.Event()
+        # Kept over restarts, so the chats of a crashed worker continue where they were
+        self.queue = asyncio.Queue()
+        self.send_task = None
+
+class Ingress:
+    """
+    Receives the updates and routes them to the worker processes by chat.
+
+    The ingress starts the workers as copies of the bot with WORKER_INDEX set,
+    and they connect back to it over a Unix socket. Every update goes to the
+    worker owning its chat, or its user when it has no chat, through one queue
+    per worker, so each chat's updates are handled in the order they arrived.
+    Messages from the workers are relayed to the worker owning a chat or to
+    all other workers, see utils.cluster. Workers that exit are started again.
+
+    On shutdown the workers first handle the updates they have received while
+    still relaying messages between each other, then flush their buffers and exit.
+    """
+
+    def __init__(self, workers: int, socket_path: str = None, queue_size: int = 1000):
+        self._workers = [WorkerProcess(i) for i in range(workers)]
+        self._socket_path = socket_path
+        self._queue_size = queue_size
+        self._command = None
+        self._server = None
+        self._watch_task = None
+        self._closing = False
+
+    async def start(self, command: list) -> None:
+        """Listen for the workers and start them with the command"""
+        self._command = command
+        if self._socket_path is None:
+            self._socket_path = os.path.join(tempfile.mkdtemp(prefix='songrequestbot-'), 'workers.sock')
+        self._server = await asyncio.start_unix_server(self._connected, path=self._socket_path, limit=MAX_LINE)
+        for worker in self._workers:
+            WORKER_QUEUE_SIZE.set_function(worker.queue.qsize, worker=str(worker.index))
+            worker.send_task = asyncio.get_running_loop().create_task(self._send_lines(worker))
+            self._spawn(worker)
+        self._watch_task = asyncio.get_running_loop().create_task(self._watch())
+        logger.info(f"Started {len(self._workers)} workers listening on {self._socket_path}")
+
+    def _spawn(self, worker: WorkerProcess) -> None:
+        environment = {**os.environ, 'WORKER_INDEX': str(worker.index), 'WORKER_SOCKET': self._socket_path}
+        # A session of their own keeps Ctrl-C from stopping the workers before the ingress tells them to
+        worker.process = subprocess.Popen(self._command, env=environment, start_new_session=True)
+
+    async def _watch(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(1)
+            for worker in self._workers:
+                code = worker.process.poll()
+                if code is None or self._closing:
+                    continue
+                logger.error(f"Worker {worker.index} exited with code {code}, starting it again")
+                WORKER_RESTARTS.inc(worker=str(worker.index))
+                worker.connected.clear()
+                await asyncio.sleep(RESTART_DELAY_SECONDS)
+                if not self._closing:
+                    self._spawn(worker)
+
+    async def _connected(self, reader, writer) -> None:
+        try:
+            hello = json.loads(await reader.readline())
+            worker = self._workers[hello['worker']]
+        except Exception as e:
+            logger.error(f"Rejected a connection to the worker socket: {e}")
+            writer.close()
+            return
+        worker.writer = writer
+        worker.connected.set()
+        logger.info(f"Worker {worker.index} connected")
+        try:
+            while line := await reader.readline():
+                self._relay(worker, line)
+        except ConnectionError as e:
+            logger.error(f"Lost the connection to worker {worker.index}: {e}")
+        finally:
+            if worker.writer is writer:
+                worker.writer = None
+                worker.connected.clear()
+            writer.close()
+
+    def _relay(self, source: WorkerProcess, line: bytes) -> None:
+        message = json.loads(line)
+        route = message.get('route')
+        if route == 'chat':
+            self._workers[worker_for(message['chat_id'], len(self._workers))].queue.put_nowait(line)
+        elif route == 'others':
+            for worker in self._workers:
+                if worker is not source:
+                    worker.queue.put_nowait(line)
+        elif message['type'] == 'drained':
+            source.drained.set()
+        else:
+            logger.warning(f"Worker {source.index} sent a message without a route: {message['type']}")
+
+    async def _send_lines(self, worker: WorkerProcess) -> None:
+        while True:
+            line = await worker.queue.get()
+            # Lines wait in the queue while the worker is restarting
+            while True:
+                await worker.connected.wait()
+                try:
+                    worker.writer.write(line)
+                    await worker.writer.drain()
+                    break
+                except (ConnectionError, AttributeError):
+                    worker.connected.clear()
+            worker.queue.task_done()
+
+    async def forward(self, update, context) -> None:
+        """Send the update to the worker owning its chat, added as the only handler of the ingress"""
+        if update.effective_chat is not None:
+            key = update.effective_chat.id
+        elif update.effective_user is not None:
+            key = update.effective_user.id
+        else:
+            key = 0
+        worker = self._workers[worker_for(key, len(self._workers))]
+        worker.queue.put_nowait(encode({'type': 'update', 'update': update.to_dict()}))
+        # The ingress stops fetching updates while a worker falls behind
+        if worker.queue.qsize() >= self._queue_size:
+            await worker.queue.join()
+
+    async def _broadcast_and_wait(self, message: dict, event: str, timeout: float) -> None:
+        for worker in self._workers:
+            worker.queue.put_nowait(encode(message))
+        waits = [getattr(worker, event).wait() for worker in self._workers]
+        try:
+            await asyncio.wait_for(asyncio.gather(*waits), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Not every worker answered to {message['type']} in {timeout} seconds")
+
+    async def close(self) -> None:
+        """Let the workers finish their updates and exit, called on shutdown"""
+        if self._server is None:
+            return
+        self._closing = True
+        self._watch_task.cancel()
+        await self._broadcast_and_wait({'type': 'drain'}, 'drained', DRAIN_TIMEOUT_SECONDS)
+        for worker in self._workers:
+            worker.queue.put_nowait(encode({'type': 'stop'}))
+        for worker in self._workers:
+            try:
+                await asyncio.to_thread(worker.process.wait, EXIT_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Worker {worker.index} did not exit in time, terminating it")
+                worker.process.terminate()
+            worker.send_task.cancel()
+        self._server.close()
+        self._server = None
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        logger.info("All workers have exited")
+
+ingress = Ingress(BOT_WORKERS, WORKER_SOCKET, UPDATE_QUEUE_SIZE)
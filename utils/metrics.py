@@ -0,0 +1,212 @@
+import bisect
+import functools
+import threading
+import time
+
+from telegram.ext import ConversationHandler
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Seconds, from sub-millisecond lookups to slow sends waiting for flood control
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """
+    A metric with optional labels, rendered in the Prometheus text format.
+    Values are updated from the event loop and the database threads, so
+    every update holds the lock of the registry.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, registry: 'Registry', name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = registry.lock
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        """(suffix, labels, value) of every sample of the metric"""
+        for key, value in self._values.items():
+            yield '', _labels(self.label_names, key), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = list(self.samples())
+        lines.extend(f"{self.name}{suffix}{labels} {_number(value)}" for suffix, labels, value in samples)
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A value that goes up and down, either set or read from a function on every scrape"""
+
+    kind = 'gauge'
+
+    def __init__(self, registry: 'Registry', name: str, description: str, labels: tuple = ()):
+        super().__init__(registry, name, description, labels)
+        self._functions = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels) -> None:
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def samples(self):
+        yield from super().samples()
+        for key, function in self._functions.items():
+            try:
+                value = function()
+            except Exception as e:
+                logger.warning(f"Reading gauge {self.name} failed: {e}")
+                continue
+            yield '', _labels(self.label_names, key), value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry: 'Registry', name: str, description: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(registry, name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Counts per bucket, the last one is +Inf, then the sum of the values
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                yield '_bucket', _labels(self.label_names, key, f'le="{_number(bound)}"'), cumulative
+            yield '_sum', _labels(self.label_names, key), state[-1]
+            yield '_count', _labels(self.label_names, key), cumulative
+
+class Registry:
+    """The metrics of the process, rendered together for the scrape endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric: Metric) -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+registry = Registry()
+
+# --- Update handling ---
+HANDLER_SECONDS = Histogram(registry, 'songrequestbot_handler_seconds',
+                            "Time spent in handler callbacks, per conversation state",
+                            ('conversation', 'state', 'callback'))
+HANDLER_ERRORS = Counter(registry, 'songrequestbot_handler_errors_total',
+                         "Handler callbacks that raised an exception", ('conversation', 'state', 'callback'))
+THROTTLED = Counter(registry, 'songrequestbot_throttled_total',
+                    "Attempts rejected by the rate limits and lockouts of users and codes", ('limit',))
+UPDATE_QUEUE_SIZE = Gauge(registry, 'songrequestbot_update_queue_size', "Received updates waiting to be handled")
+
+# --- Database ---
+DB_QUERY_SECONDS = Histogram(registry, 'songrequestbot_db_query_seconds',
+                             "Time spent running query functions on a connection", ('query', 'connection'))
+DB_STATEMENT_SECONDS = Histogram(registry, 'songrequestbot_db_statement_seconds',
+                                 "Time spent running each SQL statement", ('statement',))
+DB_WAIT_SECONDS = Histogram(registry, 'songrequestbot_db_wait_seconds',
+                            "Time queries waited for a free connection", ('connection',))
+REQUEST_BUFFER_SIZE = Gauge(registry, 'songrequestbot_request_buffer_size', "Song requests waiting to be written")
+SONG_REQUESTS_DROPPED = Counter(registry, 'songrequestbot_song_requests_dropped_total',
+                                "Song requests dropped after failing to be written")
+
+# --- Outbound messages ---
+OUTBOUND_CALLS = Counter(registry, 'songrequestbot_outbound_calls_total',
+                         "Bot API calls made by the outbound dispatcher by result: ok, retry_after or error",
+                         ('method', 'result'))
+OUTBOUND_PENDING = Gauge(registry, 'songrequestbot_outbound_pending', "Outbound calls waiting to be sent")
+
+# --- Worker processes ---
+WORKER_QUEUE_SIZE = Gauge(registry, 'songrequestbot_worker_queue_size',
+                          "Updates and messages the ingress has not yet sent to a worker", ('worker',))
+WORKER_RESTARTS = Counter(registry, 'songrequestbot_worker_restarts_total',
+                          "Worker processes started again after exiting unexpectedly", ('worker',))
+
+# --- Scheduled jobs ---
+JOB_SECONDS = Histogram(registry, 'songrequestbot_job_seconds', "Duration of scheduled jobs", ('job',))
+JOB_FAILURES = Counter(registry, 'songrequestbot_job_failures_total', "Scheduled jobs that failed", ('job',))
+
+def _timed_callback(callback, conversation: str, state: str):
+    labels = {'conversation': conversation, 'state': state, 'callback': getattr(callback, '__name__', repr(callback))}
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(**labels)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, **labels)
+    return timed
+
+def instrument_handlers(application) -> None:
+    """
+    Time the callbacks of every handler added to the application. Callbacks of
+    conversations are labeled with the conversation and the state they handle,
+    entry points as 'entry' and fallbacks as 'fallback'.
+    """
+    def wrap(handler, conversation: str, state: str) -> None:
+        handler.callback = _timed_callback(handler.callback, conversation, state)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                wrap(handler, '', '')
+                continue
+            name = handler.name or ''
+            for entry_point in handler.entry_points:
+                wrap(entry_point, name, 'entry')
+            for state, state_handlers in handler.states.items():
+                for state_handler in state_handlers:
+                    wrap(state_handler, name, str(state))
+            for fallback in handler.fallbacks:
+                wrap(fallback, name, 'fallback')
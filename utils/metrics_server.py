@@ -0,0 +1,37 @@
+from tornado.web import Application, RequestHandler
+
+from utils.config import request_buffer, dispatcher, METRICS_PORT, METRICS_LISTEN
+from utils.logger import get_logger
+from utils.metrics import registry, OUTBOUND_PENDING, REQUEST_BUFFER_SIZE, UPDATE_QUEUE_SIZE
+
+logger = get_logger(__name__)
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(registry.render())
+
+class MetricsServer:
+    """Serves the metrics of the bot in the Prometheus text format at /metrics"""
+
+    def __init__(self, port: int, listen: str):
+        self._port = port
+        self._listen = listen
+        self._server = None
+
+    def start(self, application) -> None:
+        """Start serving on the running event loop, the queue depths are read from the application on each scrape"""
+        UPDATE_QUEUE_SIZE.set_function(application.update_queue.qsize)
+        OUTBOUND_PENDING.set_function(lambda: dispatcher.pending)
+        REQUEST_BUFFER_SIZE.set_function(lambda: request_buffer.pending)
+        if not self._port:
+            return
+        self._server = Application([(r'/metrics', MetricsHandler)]).listen(self._port, address=self._listen)
+        logger.info(f"Serving metrics at http://{self._listen}:{self._port}/metrics")
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+metrics_server = MetricsServer(METRICS_PORT, METRICS_LISTEN)
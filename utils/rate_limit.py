@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+from utils.metrics import THROTTLED
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` operations per second with bursts of up to `capacity`.
+    Not thread-safe, meant to be used from the event loop.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """Seconds until the given amount of tokens is available"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take tokens if they are available right now"""
+        if self.delay(tokens) > 0:
+            return False
+        self._tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Wait until tokens are available and take them"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for the given time, e.g. after a flood control error"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    @property
+    def idle(self) -> bool:
+        """Whether the bucket is full, i.e. equal to a freshly created one"""
+        return self.delay(self.capacity) == 0
+
+
+class KeyedRateLimiter:
+    """
+    Token bucket per key, for example per user or per code, checked without
+    touching the database. Buckets that are full again are forgotten once
+    more than max_keys exist. Rejected keys are warned only once until they
+    are allowed again, so flooding the bot does not make it flood back.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float, max_keys: int = 10000):
+        self.name = name
+        self._rate = rate
+        self._capacity = capacity
+        self._max_keys = max_keys
+        self._buckets = {}
+        self._warned = set()
+
+    def _bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_keys:
+                for idle_key in [k for k, b in self._buckets.items() if b.idle]:
+                    del self._buckets[idle_key]
+                    self._warned.discard(idle_key)
+            bucket = self._buckets[key] = TokenBucket(self._rate, self._capacity)
+        return bucket
+
+    def delay(self, key) -> float:
+        """Seconds until the key is allowed again, without taking a token"""
+        bucket = self._buckets.get(key)
+        return bucket.delay() if bucket is not None else 0.0
+
+    def acquire(self, key) -> float:
+        """Take a token of the key, returns 0 when allowed or the seconds until it is"""
+        bucket = self._bucket(key)
+        if bucket.try_acquire():
+            self._warned.discard(key)
+            return 0.0
+        THROTTLED.inc(limit=self.name)
+        return bucket.delay()
+
+    def should_warn(self, key) -> bool:
+        """Whether the key should be told it was rejected, true once per streak of rejections"""
+        if key in self._warned:
+            return False
+        self._warned.add(key)
+        return True
+
+class ExponentialLockout:
+    """
+    Locks a key out after failed attempts, for example wrong passwords. The
+    lockout doubles with each failure from base_seconds up to max_seconds.
+    Failures are forgotten after a success, or when the key has not failed
+    for max_seconds after its lockout ended.
+    """
+
+    def __init__(self, name: str, base_seconds: float, max_seconds: float, max_keys: int = 10000):
+        self.name = name
+        self._base_seconds = base_seconds
+        self._max_seconds = max_seconds
+        self._max_keys = max_keys
+        self._failures = {} # key -> (failures, locked until)
+        self._warned = set()
+
+    def remaining(self, key) -> float:
+        """Seconds the key is still locked out"""
+        failures = self._failures.get(key)
+        if failures is None:
+            return 0.0
+        remaining = failures[1] - time.monotonic()
+        if remaining <= 0:
+            self._warned.discard(key)
+            return 0.0
+        THROTTLED.inc(limit=self.name)
+        return remaining
+
+    def fail(self, key) -> float:
+        """Record a failed attempt, returns the seconds the key is locked out"""
+        now = time.monotonic()
+        failures, locked_until = self._failures.get(key, (0, 0.0))
+        if now > locked_until + self._max_seconds:
+            failures = 0
+        if key not in self._failures and len(self._failures) >= self._max_keys:
+            self._prune(now)
+        lockout = min(self._base_seconds * 2 ** failures, self._max_seconds)
+        self._failures[key] = (failures + 1, now + lockout)
+        return lockout
+
+    def succeed(self, key) -> None:
+        self._failures.pop(key, None)
+        self._warned.discard(key)
+
+    def _prune(self, now: float) -> None:
+        for key in [k for k, (_, until) in self._failures.items() if now > until + self._max_seconds]:
+            del self._failures[key]
+            self._warned.discard(key)
+
+    def should_warn(self, key) -> bool:
+        """Whether the key should be told it is locked out, true once per lockout"""
+        if key in self._warned:
+            return False
+        self._warned.add(key)
+        return True
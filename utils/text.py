@@ -0,0 +1,10 @@
+import unicodedata
+
+def normalize_text(text: str) -> str:
+    """Case, punctuation and whitespace insensitive form of a song or artist name"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = ''.join(char if char.isalnum() else ' ' for char in text)
+    return ' '.join(text.split())
+
+def normalize_song(song_name: str, artist_name: str) -> tuple:
+    return normalize_text(song_name), normalize_text(artist_name)
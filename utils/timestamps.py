@@ -0,0 +1,24 @@
+import time
+from datetime import datetime
+
+# Timestamps are stored and compared as integer UTC epoch seconds, and only
+# converted to dates when shown to users
+
+HOUR_SECONDS = 60 * 60
+DAY_SECONDS = 24 * HOUR_SECONDS
+
+def now() -> int:
+    """Current time as a UTC epoch timestamp"""
+    return int(time.time())
+
+def days_from_now(days: float) -> int:
+    """Timestamp the given amount of days from now, negative for the past"""
+    return now() + int(days * DAY_SECONDS)
+
+def hour_start(timestamp: int) -> int:
+    """Start of the UTC hour the timestamp is in"""
+    return timestamp - timestamp % HOUR_SECONDS
+
+def format_timestamp(timestamp: int, format: str = '%d.%m.%Y %H.%M') -> str:
+    """Timestamp as a date in local time for messages"""
+    return datetime.fromtimestamp(timestamp).strftime(format)
@@ -0,0 +1,58 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates PTB lets through to the processor. They only wait for their chat
+# here, the limit of concurrently handled updates is applied after that.
+MAX_WAITING_UPDATES = 1000000
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles the updates of different chats concurrently and the updates of one chat in order.
+
+    A handler waiting for the rate limits of its chat, or for the database,
+    then only holds up later updates of the same chat. The conversations
+    are kept per chat and user, so they still see their updates one at a time.
+    Updates without a chat are ordered by user.
+
+    At most max_concurrent_updates updates are handled at a time. An update
+    takes a slot only once it holds the lock of its chat, so the queued
+    updates of one busy chat never keep the updates of other chats waiting.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(MAX_WAITING_UPDATES)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # Chat id -> [lock, updates holding or waiting for it], dropped when no update needs it
+        self._chats = {}
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # The locks are taken in the order the updates were received
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass